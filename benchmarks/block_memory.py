@@ -0,0 +1,39 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blockchain
+from blockchain import Block, Blockchain
+from wire_format import build_chain
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='measure the memory and validation time of a chain held in memory')
+    parser.add_argument('--blocks', type=int, default=1000000)
+    parser.add_argument('--transactions', type=int, default=1, help='transactions per block')
+    args = parser.parse_args()
+
+    # the generated blocks aren't mined, accept any hash so the rest of
+    # the validation still runs
+    blockchain.BLOCK_DIFFICULTY = 0
+
+    # measure the chain as a miner holds it after receiving it from a peer
+    serialized = [block.serialize() for block in build_chain(args.blocks, args.transactions)]
+    tracemalloc.start()
+    chain = [Block.deserialize(data) for data in serialized]
+    size = tracemalloc.get_traced_memory()[0]
+    blocks = Blockchain(chain)
+    total = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del serialized
+    print(f'{args.blocks} blocks, {args.transactions} transactions per block')
+    print(f'memory: {size / args.blocks:.0f} bytes per block, {total / args.blocks:.0f} with the ledger')
+
+    for label in ('first validation', 'second validation'):
+        start = time.perf_counter()
+        valid = blocks.is_valid_chain()
+        elapsed = time.perf_counter() - start
+        print(f'{label}: {elapsed:.2f}s ({elapsed / args.blocks * 1e6:.2f} us per block), valid: {valid}')
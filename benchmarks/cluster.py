@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import networking
+from trader import percentile
+
+
+def free_port():
+    """
+    find a port on localhost that nothing is listening on
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start(script, arguments, log_path):
+    """
+    start one node of the cluster
+
+    arguments:
+    script -- python file of the node, relative to the repository
+    arguments -- command line arguments of the node
+    log_path -- file the node's output goes to
+
+    returns:
+    subprocess.Popen of the node, its stdin is a pipe that is kept open
+    and its log file is closed by stop()
+    """
+    log = open(log_path, 'w')
+    try:
+        process = subprocess.Popen([sys.executable, '-u', script] + [str(a) for a in arguments], cwd=ROOT,
+                                   stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+    except OSError:
+        log.close()
+        raise
+    process.log = log
+    return process
+
+
+def tip_height(port):
+    """
+    ask a miner for the height of its chain tip with a balance query
+
+    returns:
+    the height, None if the miner isn't up or has no chain yet
+    """
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=2.0) as s:
+            networking.send_custom(s, json.dumps({'type': 'balance', 'wallet': ''}), 17)
+            data, indicator = networking.FramedReader(s, retry_timeouts=False).recv()
+    except OSError:
+        return None
+    if indicator != 18:
+        return None
+    return json.loads(data).get('height')
+
+
+def wait_until(condition, timeout, interval=0.1):
+    """
+    poll condition until it returns something other than None or False
+
+    returns:
+    the last value returned by condition
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        value = condition()
+        if value or time.monotonic() > deadline:
+            return value
+        time.sleep(interval)
+
+
+def stop(process, terminate=True):
+    """
+    stop a node and collect its resource usage
+
+    arguments:
+    process -- subprocess.Popen of the node
+    terminate -- stop the node if it is still running, False to wait for
+                 it to exit by itself
+
+    returns:
+    dict with the CPU seconds and peak resident memory of the node
+    """
+    if terminate and process.poll() is None:
+        process.terminate()
+    _, status, usage = os.wait4(process.pid, 0)
+    # reaped here, so tell the Popen the node has exited
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if not process.stdin.closed:
+        process.stdin.close()
+    process.log.close()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3), 'max_rss_bytes': max_rss}
+
+
+def read_events(path):
+    """
+    read a miner's event log, see Miner.log_event
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(values):
+    """
+    count and percentiles of a list of numbers, in milliseconds for
+    durations in seconds
+    """
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+        value = percentile(values, fraction)
+        summary[f'{name}_ms'] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+def block_propagation(event_logs):
+    """
+    seconds between a block being mined and each other miner accepting it
+
+    arguments:
+    event_logs -- list of each miner's events
+    """
+    mined = {}
+    for miner, events in enumerate(event_logs):
+        for event in events:
+            if event['event'] == 'mined':
+                mined[event['hash']] = (miner, event['time'])
+    delays = []
+    for miner, events in enumerate(event_logs):
+        accepted = set()
+        for event in events:
+            if event['event'] != 'accepted' or event['hash'] in accepted:
+                continue
+            accepted.add(event['hash'])
+            origin = mined.get(event['hash'])
+            if origin is not None and origin[0] != miner:
+                delays.append(event['time'] - origin[1])
+    return delays
+
+
+def run(args, directory):
+    """
+    run the cluster once
+
+    arguments:
+    args -- parsed command line arguments
+    directory -- directory for the nodes' logs
+
+    returns:
+    dict of results
+    """
+    nodes = {}
+    tracker_port = free_port()
+    miner_arguments = ['--block-size', args.block_size, '--batch-interval', args.batch_interval]
+    try:
+        nodes['tracker'] = start('tracker.py', [tracker_port], os.path.join(directory, 'tracker.log'))
+        time.sleep(0.5)
+
+        miner_ports = []
+        for i in range(args.miners):
+            port = free_port()
+            nodes[f'miner{i}'] = start('miner.py', ['127.0.0.1', tracker_port, port,
+                                                    '--event-log', os.path.join(directory, f'miner{i}.events')]
+                                       + miner_arguments, os.path.join(directory, f'miner{i}.log'))
+            if wait_until(lambda: tip_height(port) is not None, args.startup_timeout) is not True:
+                raise RuntimeError(f'miner{i} did not start, see {directory}')
+            miner_ports.append(port)
+
+        traders = []
+        for i in range(args.traders):
+            name = f'trader{i}'
+            trader_arguments = ['127.0.0.1', tracker_port, free_port(), name, '--batch', '-', '--json',
+                                '--in-flight', args.in_flight, '--timeout', args.timeout]
+            if args.rate:
+                trader_arguments += ['--rate', args.rate / args.traders]
+            nodes[name] = start('trader.py', trader_arguments, os.path.join(directory, f'{name}.log'))
+            traders.append(name)
+        # every trader has to be registered before any transaction names
+        # it as the recipient
+        time.sleep(args.settle)
+
+        amount = round(50.0 / args.transactions, 6) or 0.000001
+        def feed(i):
+            recipient = f'trader{(i + 1) % args.traders}'
+            stdin = nodes[traders[i]].stdin
+            try:
+                for _ in range(args.transactions):
+                    stdin.write(f'{recipient} {amount}\n'.encode())
+                stdin.close()
+            except BrokenPipeError:
+                pass
+        feeders = [threading.Thread(target=feed, args=(i,)) for i in range(args.traders)]
+        for feeder in feeders:
+            feeder.start()
+        for feeder in feeders:
+            feeder.join()
+
+        usage = {}
+        trader_results = []
+        for name in traders:
+            usage[name] = stop(nodes.pop(name), terminate=False)
+            with open(os.path.join(directory, f'{name}.log')) as f:
+                lines = [line for line in f if line.startswith('{')]
+            if not lines:
+                raise RuntimeError(f'{name} did not report results, see {directory}')
+            trader_results.append(json.loads(lines[-1]))
+
+        # let the last blocks reach every miner
+        time.sleep(args.settle)
+        heights = [tip_height(port) for port in miner_ports]
+
+        late_join = None
+        answered = [h for h in heights if h is not None]
+        if args.late_join and not answered:
+            # there is no height for a new miner to catch up to
+            late_join = {'height': None, 'synced': False, 'seconds': None, 'bytes': None,
+                         'error': 'no miner answered the height query'}
+        elif args.late_join:
+            port = free_port()
+            events = os.path.join(directory, 'late_miner.events')
+            started = time.monotonic()
+            nodes['late_miner'] = start('miner.py', ['127.0.0.1', tracker_port, port, '--event-log', events]
+                                        + miner_arguments, os.path.join(directory, 'late_miner.log'))
+            target = max(answered)
+            synced = wait_until(lambda: (tip_height(port) or -1) >= target, args.startup_timeout)
+            late_join = {'height': target, 'synced': synced,
+                         'seconds': round(time.monotonic() - started, 3),
+                         'bytes': sum(e['bytes'] for e in read_events(events) if e['event'] == 'sync')}
+
+        for name in list(nodes):
+            usage[name] = stop(nodes.pop(name))
+    finally:
+        for process in nodes.values():
+            process.kill()
+            process.wait()
+            if not process.stdin.closed:
+                process.stdin.close()
+            process.log.close()
+
+    event_logs = [read_events(os.path.join(directory, f'miner{i}.events')) for i in range(args.miners)]
+    answered = sum(r['accepted'] + r['rejected'] for r in trader_results)
+    seconds = max(r['seconds'] for r in trader_results)
+    latency = {}
+    # the latency of the whole cluster is taken as the worst trader's
+    for name in ('p50', 'p90', 'p99', 'max'):
+        values = [r[f'latency_{name}'] for r in trader_results if r[f'latency_{name}'] is not None]
+        latency[f'{name}_ms'] = round(max(values) * 1000, 3) if values else None
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'transactions': {
+            'sent': sum(r['sent'] for r in trader_results),
+            'accepted': sum(r['accepted'] for r in trader_results),
+            'rejected': sum(r['rejected'] for r in trader_results),
+            'unanswered': sum(r['unanswered'] for r in trader_results),
+            'seconds': round(seconds, 3),
+            'tps': round(answered / seconds, 1) if seconds > 0 else 0.0,
+            'confirmation_latency': latency,
+        },
+        'blocks': {
+            'heights': heights,
+            'mined': sum(1 for events in event_logs for e in events if e['event'] == 'mined'),
+            'propagation': summarize(block_propagation(event_logs)),
+        },
+        'sync': {
+            'bytes': sum(e['bytes'] for events in event_logs for e in events if e['event'] == 'sync'),
+            'late_join': late_join,
+        },
+        'nodes': usage,
+        'traders': trader_results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run a tracker, miners and load-generating traders on localhost '
+                                                 'and report the results as JSON')
+    parser.add_argument('--miners', type=int, default=2)
+    parser.add_argument('--traders', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=500, help='transactions sent by each trader')
+    parser.add_argument('--rate', type=float, default=0, help='transactions per second across all traders, 0 for as fast as possible')
+    parser.add_argument('--in-flight', type=int, default=256, help='transactions each trader keeps waiting for an answer')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds a trader waits for each answer')
+    parser.add_argument('--block-size', type=int, default=64)
+    parser.add_argument('--batch-interval', type=float, default=0.5)
+    parser.add_argument('--late-join', action='store_true', help='start one more miner after the load and measure its sync')
+    parser.add_argument('--settle', type=float, default=1.5, help='seconds to wait for registrations and the last blocks')
+    parser.add_argument('--startup-timeout', type=float, default=30.0)
+    parser.add_argument('--logs', help='directory to keep the nodes\' logs in (default: a temporary directory)')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    if args.logs is not None:
+        os.makedirs(args.logs, exist_ok=True)
+        results = run(args, args.logs)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(args, directory)
+    report = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
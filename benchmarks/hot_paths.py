@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import networking
+from blockchain import Block, Blockchain, blocks_to_bytes, blocks_from_bytes
+from transaction import Transaction
+from synthetic import synthetic_chain, wallet_names
+
+SAMPLE_SIZE = 1000  # blocks or transactions timed per measurement
+
+
+def per_call(function, items, repeat):
+    """
+    time a function over a list of items, keeping the fastest of repeat
+    runs
+
+    arguments:
+    function -- function taking one item
+    items -- function returning a fresh list of items for each run, so
+             caches filled by one run don't speed up the next
+    repeat -- number of runs
+
+    returns:
+    microseconds per call
+    """
+    best = None
+    for _ in range(repeat):
+        batch = items()
+        start = time.perf_counter()
+        for item in batch:
+            function(item)
+        elapsed = (time.perf_counter() - start) / len(batch)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6
+
+
+def sample(chain):
+    """
+    up to SAMPLE_SIZE blocks spread evenly over a chain, skipping the
+    genesis block
+    """
+    step = max((len(chain) - 1) // SAMPLE_SIZE, 1)
+    return chain[1::step][:SAMPLE_SIZE]
+
+
+def transfer_time(data):
+    """
+    send one binary message with send_custom and receive it with
+    recv_custom over a socketpair
+
+    returns:
+    seconds from the start of the send to the end of the receive
+    """
+    sender, receiver = socket.socketpair()
+    try:
+        start = time.perf_counter()
+        thread = threading.Thread(target=networking.send_custom, args=(sender, data, 14))
+        thread.start()
+        received, indicator = networking.recv_custom(receiver)
+        elapsed = time.perf_counter() - start
+        thread.join()
+    finally:
+        sender.close()
+        receiver.close()
+    assert indicator == 14 and len(received) == len(data)
+    return elapsed
+
+
+def measure(chain, repeat):
+    """
+    run every microbenchmark on one chain
+
+    arguments:
+    chain -- list of blocks
+    repeat -- runs of each per-call measurement, the fastest is kept
+
+    returns:
+    dict of results, per-call times in microseconds and chain-wide times
+    in seconds
+    """
+    results = {'blocks': len(chain)}
+    blocks = sample(chain)
+    serialized = [block.serialize() for block in blocks]
+    # blocks fresh from the wire, so nothing is cached in them yet
+    fresh = lambda: [Block.deserialize(data) for data in serialized]
+
+    results['calculate_hash_us'] = per_call(Block.calculate_hash, fresh, repeat)
+    results['is_valid_block_us'] = per_call(Block.is_valid_block, fresh, repeat)
+    results['serialize_us'] = per_call(Block.serialize, fresh, repeat)
+    results['deserialize_us'] = per_call(Block.deserialize, lambda: serialized, repeat)
+
+    ledger = Blockchain(chain)
+    wallets = wallet_names()
+    present = [t.trans_id for block in blocks for t in block.parsed_transactions]
+    absent = [Transaction('wallet0', 'wallet1', 1.0).trans_id for _ in present]
+    results['transaction_exists_us'] = per_call(ledger.transaction_exists, lambda: present + absent, repeat)
+    transactions = lambda: [Transaction(f'wallet{i % 100}', f'wallet{(i + 1) % 100}', 0.5).serialize()
+                            for i in range(SAMPLE_SIZE)]
+    results['verify_transaction_us'] = per_call(lambda data: ledger.verify_transaction(data, wallets),
+                                                transactions, repeat)
+
+    # validation of a chain just received, then of the same chain again
+    # with the hashes cached in the blocks
+    data = blocks_to_bytes(chain)
+    received = Blockchain(blocks_from_bytes(data))
+    for label in ('is_valid_chain_s', 'is_valid_chain_cached_s'):
+        start = time.perf_counter()
+        valid = received.is_valid_chain()
+        results[label] = time.perf_counter() - start
+        assert valid
+    del received
+
+    results['chain_bytes'] = len(data)
+    results['send_recv_chain_s'] = min(transfer_time(data) for _ in range(repeat))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='time the hot paths of blockchain.py and networking.py '
+                                                 'on synthetic chains of growing size')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000,1000000',
+                        help='comma-separated chain sizes in blocks')
+    parser.add_argument('--transactions', type=int, default=1, help='transactions per block')
+    parser.add_argument('--difficulty', type=int, default=1, help='proof-of-work difficulty of the synthetic chain')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    start = time.perf_counter()
+    # every prefix of a valid chain is valid, so the largest chain is
+    # built once and the smaller ones are cut from it
+    chain = synthetic_chain(sizes[-1], args.transactions, args.difficulty)
+    if not args.json:
+        print(f'built {sizes[-1]} blocks in {time.perf_counter() - start:.1f}s '
+              f'(difficulty {args.difficulty}, {args.transactions} transactions per block)')
+
+    results = []
+    columns = ('calculate_hash_us', 'is_valid_block_us', 'serialize_us', 'deserialize_us',
+               'transaction_exists_us', 'verify_transaction_us', 'is_valid_chain_s', 'is_valid_chain_cached_s',
+               'send_recv_chain_s')
+    if not args.json:
+        print(f'{"blocks":>8}' + ''.join(f'{column:>{len(column) + 2}}' for column in columns))
+    for size in sizes:
+        result = measure(chain[:size], args.repeat)
+        results.append(result)
+        if not args.json:
+            print(f'{size:>8}' + ''.join(f'{result[column]:>{len(column) + 2}.4f}' for column in columns))
+            sys.stdout.flush()
+    if args.json:
+        print(json.dumps({'transactions': args.transactions, 'difficulty': args.difficulty, 'results': results}))
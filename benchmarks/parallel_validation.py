@@ -0,0 +1,94 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blockchain
+from blockchain import Blockchain, blocks_to_bytes, blocks_from_bytes, check_blocks, received_chunks
+from synthetic import synthetic_chain
+
+
+def best(function, repeat):
+    """
+    run function repeat times
+
+    returns:
+    (fastest wall time, CPU time of this process in that run), in seconds
+    """
+    result = None
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        function()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if result is None or wall < result[0]:
+            result = (wall, cpu)
+    return result
+
+
+def receive(data):
+    """
+    decode a chain the way a miner does when a peer sends it in the
+    binary wire format
+
+    returns:
+    (Blockchain, (data, positions))
+    """
+    positions = []
+    return Blockchain(blocks_from_bytes(data, 0, positions)), (data, positions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compare validating a received chain serially and across a '
+                                                 'process pool')
+    parser.add_argument('--blocks', type=int, default=40000)
+    parser.add_argument('--transactions', type=int, default=1, help='transactions per block')
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated pool sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    data = blocks_to_bytes(synthetic_chain(args.blocks, args.transactions))
+    results = {'blocks': args.blocks, 'transactions': args.transactions, 'cpus': os.cpu_count()}
+
+    # every run validates freshly decoded blocks, so no cached hash helps
+    chains = [receive(data) for _ in range(args.repeat)]
+    runs = iter(chains)
+    results['serial_s'] = best(lambda: next(runs)[0].is_valid_chain(), args.repeat)[0]
+
+    # what the workers do, all of it in this process: checking the
+    # chunks cut from the received bytes, against decoding and checking
+    # blocks encoded again as the pool did before
+    chain, received = chains[0]
+    chunks = list(received_chunks(received, 1, len(chain.blockchain)))
+    results['cut_chunks_s'] = best(lambda: list(received_chunks(received, 1, len(chain.blockchain))),
+                                   args.repeat)[0]
+    results['check_chunks_s'] = best(lambda: [check_blocks(chunk) for chunk in chunks], args.repeat)[0]
+    results['encode_chunks_s'] = best(lambda: [blocks_to_bytes(chain.blockchain[i:i + blockchain.VALIDATION_CHUNK_SIZE])
+                                               for i in range(1, len(chain.blockchain),
+                                                              blockchain.VALIDATION_CHUNK_SIZE)], args.repeat)[0]
+    results['decode_and_check_chunks_s'] = best(lambda: [all(block.is_valid_block() for block in
+                                                             blocks_from_bytes(chunk)) for chunk in chunks],
+                                                args.repeat)[0]
+
+    results['pool'] = []
+    for workers in sorted(int(w) for w in args.workers.split(',')):
+        # forked workers inherit the synthetic chain's difficulty
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            # the pooled path never reads the decoded blocks' caches
+            wall, cpu = best(lambda: chain.is_valid_chain(pool, received), args.repeat)
+        results['pool'].append({'workers': workers, 'wall_s': wall, 'parent_cpu_s': cpu})
+
+    if args.json:
+        print(json.dumps(results))
+        sys.exit()
+    print(f'{args.blocks} blocks, {args.transactions} transactions per block, {results["cpus"]} CPUs')
+    print(f'serial validation:              {results["serial_s"]:.3f}s')
+    print(f'worker side, in one process:    {results["check_chunks_s"]:.3f}s to check the received chunks '
+          f'({results["cut_chunks_s"]:.3f}s to cut them)')
+    print(f'  encoding the blocks again:    {results["encode_chunks_s"]:.3f}s, then '
+          f'{results["decode_and_check_chunks_s"]:.3f}s to decode and check them')
+    for run in results['pool']:
+        print(f'pool of {run["workers"]}: {run["wall_s"]:.3f}s, {run["parent_cpu_s"]:.3f}s of it busy in this process')
@@ -0,0 +1,58 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blockchain
+from blockchain import Block
+from transaction import Transaction
+
+
+def synthetic_chain(length, transactions_per_block=1, difficulty=1, wallets=100):
+    """
+    build a valid chain quickly for benchmarks: every block is solved, but
+    at a low difficulty, and the transactions are small transfers between
+    a fixed set of wallets so no balance runs out
+
+    The difficulty is also set as blockchain.BLOCK_DIFFICULTY, so the chain
+    validates in this process. It is 1 by default (16 hashes per block on
+    average), 0 skips proof of work altogether.
+
+    arguments:
+    length -- number of blocks, including the genesis block
+    transactions_per_block -- transactions in each block
+    difficulty -- leading zeroes the block hashes need
+    wallets -- number of wallets sending money to each other
+
+    returns:
+    list of blocks, from the genesis block to the tip
+    """
+    blockchain.BLOCK_DIFFICULTY = difficulty
+    names = [f'wallet{i}' for i in range(wallets)]
+    genesis = Block(0, 0, ['GENESIS'], '')
+    genesis.solve()
+    chain = [genesis]
+    count = 0
+    for i in range(1, length):
+        transactions = []
+        for j in range(transactions_per_block):
+            count += 1
+            # a different amount for every transaction keeps the IDs unique
+            transactions.append(Transaction(names[count % wallets], names[(count * 7 + 1) % wallets],
+                                            count / 1e6))
+        block = Block(i, 0, transactions, chain[-1].hash)
+        if difficulty:
+            block.solve()
+        chain.append(block)
+    return chain
+
+
+def wallet_names(wallets=100):
+    """
+    addresses of the wallets used by synthetic_chain
+
+    returns:
+    (set of every wallet, set of active wallets), in the form
+    Blockchain.verify_transaction expects
+    """
+    names = {f'wallet{i}' for i in range(wallets)}
+    return names, set(names)
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from blockchain import Block, blocks_to_bytes, blocks_from_bytes
+from transaction import Transaction
+
+
+def build_chain(length, transactions_per_block):
+    """
+    build a chain of blocks with random-looking transactions, without
+    proof of work since only the encoding is measured
+
+    arguments:
+    length -- number of blocks
+    transactions_per_block -- transactions in each block
+    """
+    chain = [Block(0, 0, ['GENESIS'], '')]
+    for i in range(1, length):
+        transactions = [Transaction(f'trader{i % 97}', f'trader{(i + j) % 89}', round(i * 0.37 + j, 2)).serialize()
+                        for j in range(transactions_per_block)]
+        chain.append(Block(i, i * 7919, transactions, chain[-1].hash))
+    return chain
+
+
+def best_time(function, repeat):
+    """
+    run function repeat times and return the fastest run in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compare the JSON and binary chain wire formats')
+    parser.add_argument('--blocks', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=4, help='transactions per block')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    chain = build_chain(args.blocks, args.transactions)
+
+    json_data = json.dumps([block.serialize() for block in chain]).encode()
+    binary_data = blocks_to_bytes(chain)
+    assert [b.serialize() for b in blocks_from_bytes(binary_data)] == [b.serialize() for b in chain]
+
+    json_encode = best_time(lambda: json.dumps([block.serialize() for block in chain]).encode(), args.repeat)
+    json_decode = best_time(lambda: [Block.deserialize(block) for block in json.loads(json_data)], args.repeat)
+    binary_encode = best_time(lambda: blocks_to_bytes(chain), args.repeat)
+    binary_decode = best_time(lambda: blocks_from_bytes(binary_data), args.repeat)
+
+    print(f'{args.blocks} blocks, {args.transactions} transactions per block')
+    print(f'{"format":<8}{"bytes":>14}{"encode (s)":>14}{"decode (s)":>14}')
+    print(f'{"json":<8}{len(json_data):>14}{json_encode:>14.3f}{json_decode:>14.3f}')
+    print(f'{"binary":<8}{len(binary_data):>14}{binary_encode:>14.3f}{binary_decode:>14.3f}')
+    print(f'binary is {len(binary_data) / len(json_data):.0%} of the JSON size')
@@ -1,49 +1,242 @@
 import json
+from json.encoder import encode_basestring_ascii
 import hashlib
+import math
+import struct
 import time
 import random
+import threading
+import bisect
+from array import array
+from collections import deque
 from transaction import Transaction
+import mining
 import sys
 
 BLOCK_DIFFICULTY = 4  # Number of leading zeroes for a valid block
 STARTING_WALLET_AMOUNT = 100.0 # amount of money that new traders begin with
+MAX_UNDO_DEPTH = 1000  # number of recent blocks whose ledger changes are kept to undo, older ones are undone from the wallet history
+CHECKPOINT_INTERVAL = 1000  # blocks between ledger checkpoints of a chain kept on disk
+PARALLEL_VALIDATION_THRESHOLD = 2000  # blocks before validation is split across a process pool
+VALIDATION_CHUNK_SIZE = 500  # blocks sent to a validation worker at a time
+BINARY_TRANSACTION = 0  # transaction stored with Transaction.to_bytes
+RAW_TRANSACTION = 1  # transaction stored as its length-prefixed string
+HEADER_FIELDS = frozenset(('index', 'nonce', 'merkle_root', 'prev_hash'))  # fields the block hash covers
+BLOCK_HEADER = struct.Struct('>QQ32s32s32sI')  # index, nonce, previous hash, Merkle root, hash, transaction count
+RAW_LENGTH = struct.Struct('>BI')  # kind and length of a transaction stored as its string
+
+
+def calculate_merkle_root(transactions):
+    """
+    Calculate the Merkle root of a list of transactions
+
+    Each transaction string is hashed into a leaf, then pairs of hashes are
+    hashed together level by level (the last hash of an odd level is paired
+    with itself) until one hash is left.
+
+    arguments:
+    transactions -- list of transaction strings
+
+    returns:
+    hex string of the root hash
+    """
+    level = [hashlib.sha256(t.encode()).digest() for t in transactions]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+def format_header(index, nonce, merkle_root, prev_hash):
+    """
+    Serialize the hashed fields of a block with an int index and nonce and
+    str hashes, formatted directly instead of through json.dumps
+
+    returns:
+    bytes that Block.calculate_hash hashes
+    """
+    return ('{"index": %d, "merkle_root": %s, "nonce": %d, "prev_hash": %s}' % (
+        index, encode_basestring_ascii(merkle_root), nonce, encode_basestring_ascii(prev_hash))).encode()
+
+
+def parse_transaction(data):
+    """
+    Parse a transaction for storing in a block
+
+    arguments:
+    data -- transaction string, or an already parsed Transaction
+
+    returns:
+    (entry, transaction): what the block stores, the Transaction if its
+    binary encoding decodes back to exactly the string the Merkle root
+    covers (so the string can be rebuilt with serialize()), otherwise the
+    string itself; and the parsed Transaction, None if the string isn't
+    one (e.g. 'GENESIS')
+    """
+    if not isinstance(data, str):
+        if data.has_binary_encoding():
+            return data, data
+        return data.serialize(), data
+    try:
+        transaction = Transaction.deserialize(data)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return data, None
+    # only floats serialize back the way they were read
+    if transaction.has_binary_encoding() and transaction.serialize() == data:
+        return transaction, transaction
+    return data, transaction
 
 
 class Block:
-    def __init__(self, index, nonce, transaction, prev_hash, hash=None):
+    # no per-instance dict. _transactions holds each transaction once: as
+    # a Transaction when its string can be rebuilt from it exactly,
+    # otherwise as the string. _parsed holds the Transactions only for the
+    # blocks with strings in _transactions, None otherwise. _digest and
+    # _root cache the hash and Merkle root calculated from the current
+    # fields.
+    __slots__ = ('index', 'nonce', 'merkle_root', 'prev_hash', 'hash', '_transactions', '_parsed',
+                 '_digest', '_root')
+
+    def __init__(self, index, nonce, transactions, prev_hash, hash=None, merkle_root=None):
         """
         Constructor for Block class
 
         Args:
             index (int): Index of the block in the blockchain
             nonce (int): Nonce used in mining to satisfy the proof-of-work condition
-            transaction (str): Transaction data stored in the block
+            transactions (list): Transaction strings (or Transactions) stored in the block
             prev_hash (str): Hash of the previous block in the blockchain
             hash (str): Hash of the block
+            merkle_root (str): Merkle root of the transactions, calculated if not given
         """
         self.index = index 
         self.nonce = nonce
-        self.transaction = transaction
+        self.transactions = transactions
+        self.merkle_root = merkle_root
+        if self.merkle_root is None:
+            self.merkle_root = self.calculate_merkle_root()
+        elif self._root == merkle_root:
+            # keep one copy of the string
+            self._root = merkle_root
         self.prev_hash = prev_hash
         self.hash = hash
         if self.hash is None:
             self.hash = self.calculate_hash()
 
+    def __setattr__(self, name, value):
+        # the cached hash is only good for the fields it was calculated from,
+        # setting a field to an equal value (e.g. to share one copy of a
+        # string) keeps it
+        if name in HEADER_FIELDS and getattr(self, name, None) != value:
+            object.__setattr__(self, '_digest', None)
+        object.__setattr__(self, name, value)
 
-    def calculate_hash(self):
+    @property
+    def transactions(self):
         """
-        Calculate the hash of the block
+        the block's transaction strings, rebuilt from the Transactions they
+        were parsed into. Only the Merkle root (which is cached) and the
+        JSON wire format need them.
+        """
+        return tuple(t if type(t) is str else t.serialize() for t in self._transactions)
+
+    @transactions.setter
+    def transactions(self, transactions):
+        entries = [parse_transaction(data) for data in transactions]
+        self._transactions = tuple(entry[0] for entry in entries)
+        self._parsed = None
+        if any(type(entry[0]) is str for entry in entries):
+            self._parsed = tuple(entry[1] for entry in entries if entry[1] is not None)
+        # strings received from a peer are at hand now, hash them for the
+        # Merkle root instead of rebuilding them from the Transactions later
+        self._root = None
+        if all(type(data) is str for data in transactions):
+            self._root = calculate_merkle_root(transactions)
+
+    @property
+    def parsed_transactions(self):
+        """
+        the block's transactions as Transaction objects, parsed once when
+        the block was built. Strings that aren't transactions are left out.
+        """
+        if self._parsed is None:
+            return self._transactions
+        return self._parsed
+
+    def header(self):
+        """
+        Hashed fields of the block, excluding the nonce
 
         Returns:
-            str: Hash of the block
+            dict: Fields that the proof of work commits to
         """
-        block_string = json.dumps({
+        return {
             'index': self.index,
-            'nonce': self.nonce,
-            'transaction': self.transaction,
+            'merkle_root': self.merkle_root,
             'prev_hash': self.prev_hash,
-        }, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        }
+
+    def calculate_hash(self):
+        """
+        Calculate the hash of the block, cached until one of the hashed
+        fields changes
+
+        Returns:
+            str: Hash of the block
+        """
+        if self._digest is None:
+            digest = hashlib.sha256(self.serialize_header()).hexdigest()
+            # keep one copy of the string when it matches the stored hash
+            object.__setattr__(self, '_digest', self.hash if digest == self.hash else digest)
+        return self._digest
+
+    def serialize_header(self):
+        """
+        Canonical serialization of the hashed fields, the same as
+        json.dumps(..., sort_keys=True) of the header and nonce. Formatted
+        directly for the usual field types.
+
+        Returns:
+            bytes: the serialized header
+        """
+        if type(self.index) is int and type(self.nonce) is int and type(self.merkle_root) is str and type(self.prev_hash) is str:
+            return format_header(self.index, self.nonce, self.merkle_root, self.prev_hash)
+        fields = self.header()
+        fields['nonce'] = self.nonce
+        return json.dumps(fields, sort_keys=True).encode()
+
+    def calculate_merkle_root(self):
+        """
+        Calculate the Merkle root of the block's transactions, cached until
+        the transactions are replaced
+
+        Returns:
+            str: Merkle root of the transactions
+        """
+        if self._root is None:
+            root = calculate_merkle_root(self.transactions)
+            self._root = self.merkle_root if root == self.merkle_root else root
+        return self._root
+
+    def solve(self, start=0, cancel=None, search=mining.search):
+        """
+        Search for a nonce that satisfies the proof-of-work condition and
+        store it in the block
+
+        Args:
+            start (int): First nonce to try
+            cancel (function): Optional function, the search gives up once it returns True
+            search (function): Search to run, mining.search or a parallel search with the same signature
+
+        Returns:
+            int: Number of nonces tried
+        """
+        nonce, hash, attempts = search(self.header(), BLOCK_DIFFICULTY, start, cancel=cancel)
+        if nonce is not None:
+            self.nonce = nonce
+            self.hash = hash
+        return attempts
 
     def is_valid_block(self):
         """
@@ -53,7 +246,9 @@ class Block:
             bool: True if the block is valid, False otherwise
         """
         return (self.hash[:BLOCK_DIFFICULTY] == '0' * BLOCK_DIFFICULTY and
-                self.hash == self.calculate_hash())
+                len(self._transactions) > 0 and
+                self.hash == self.calculate_hash() and
+                self.merkle_root == self.calculate_merkle_root())
     
     def serialize(self):
         """
@@ -62,7 +257,8 @@ class Block:
         return json.dumps({
             'index': self.index,
             'nonce': self.nonce,
-            'transaction': self.transaction,
+            'transactions': list(self.transactions),
+            'merkle_root': self.merkle_root,
             'prev_hash': self.prev_hash,
             'hash': self.hash,
         })
@@ -77,7 +273,57 @@ class Block:
         """
         data = json.loads(block_data)
         # Create a new Block object using the data extracted from the JSON
-        return Block(data['index'], data['nonce'], data['transaction'], data['prev_hash'], data['hash'])
+        return Block(data['index'], data['nonce'], data['transactions'], data['prev_hash'], data['hash'], data['merkle_root'])
+
+    def to_bytes(self):
+        """
+        Encode the block in the compact binary wire format: fixed-width
+        index and nonce, raw 32-byte hashes, then the transactions.
+        Transactions are stored with Transaction.to_bytes when that
+        reproduces their exact string (which the Merkle root covers), and
+        as length-prefixed strings otherwise.
+        """
+        parts = [BLOCK_HEADER.pack(self.index, self.nonce,
+                                   bytes.fromhex(self.prev_hash) if self.prev_hash else bytes(32),
+                                   bytes.fromhex(self.merkle_root), bytes.fromhex(self.hash),
+                                   len(self._transactions))]
+        binary = bytes([BINARY_TRANSACTION])
+        for transaction in self._transactions:
+            if type(transaction) is str:
+                raw = transaction.encode()
+                parts.append(RAW_LENGTH.pack(RAW_TRANSACTION, len(raw)))
+                parts.append(raw)
+            else:
+                parts.append(binary)
+                parts.append(transaction.to_bytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """
+        Decode a block from the binary wire format
+
+        arguments:
+        data: bytes holding the block
+        offset: position of the block in data
+
+        returns:
+        (block, position after the block)
+        """
+        index, nonce, prev_hash, merkle_root, hash, count = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        prev_hash = prev_hash.hex() if any(prev_hash) else ''
+        transactions = []
+        for _ in range(count):
+            if data[offset] == BINARY_TRANSACTION:
+                transaction, offset = Transaction.from_bytes(data, offset + 1)
+                transactions.append(transaction)
+            else:
+                _, length = RAW_LENGTH.unpack_from(data, offset)
+                offset += RAW_LENGTH.size
+                transactions.append(str(data[offset:offset + length], 'utf-8'))
+                offset += length
+        return Block(index, nonce, transactions, prev_hash, hash.hex(), merkle_root.hex()), offset
 
     def print_block(self):
         """
@@ -85,55 +331,481 @@ class Block:
         """
         print(f"INDEX: {self.index}")
         print(f"NONCE: {self.nonce}")
-        print(f"TRANSACTION: {self.transaction}")
+        for transaction in self.transactions:
+            print(f"TRANSACTION: {transaction}")
+        print(f"MERKLE ROOT: {self.merkle_root}")
         print(f"PREV HASH: {self.prev_hash}")
         print(f"HASH: {self.hash}")
 
 
+def blocks_to_bytes(blocks):
+    """
+    Encode a list of blocks in the binary wire format, a block count
+    followed by each block
+
+    arguments:
+    blocks -- list of blocks
+    """
+    return struct.pack('>I', len(blocks)) + b''.join(block.to_bytes() for block in blocks)
+
+
+def blocks_from_bytes(data, offset=0, positions=None):
+    """
+    Decode a list of blocks encoded with blocks_to_bytes
+
+    arguments:
+    data -- bytes holding the blocks
+    offset -- position of the block count in data
+    positions -- optional list, the position of each block in data is
+                 appended to it, then the position after the last one
+    """
+    count, = struct.unpack_from('>I', data, offset)
+    offset += 4
+    blocks = []
+    for _ in range(count):
+        if positions is not None:
+            positions.append(offset)
+        block, offset = Block.from_bytes(data, offset)
+        blocks.append(block)
+    if positions is not None:
+        positions.append(offset)
+    return blocks
+
+
+def received_chunks(received, start, stop):
+    """
+    Cut blocks out of a list received in the binary wire format into
+    chunks for validate_chunks, copying their bytes instead of encoding
+    the decoded blocks again
+
+    arguments:
+    received -- (data, positions) of the list, see blocks_from_bytes
+    start -- number of the first block in the list
+    stop -- number of the block to stop before
+    """
+    data, positions = received
+    for first in range(start, stop, VALIDATION_CHUNK_SIZE):
+        last = min(first + VALIDATION_CHUNK_SIZE, stop)
+        yield struct.pack('>I', last - first) + bytes(data[positions[first]:positions[last]])
+
+
+def check_blocks(data):
+    """
+    Check the hash, proof of work and Merkle root of every block in a
+    chunk, and that each block extends the one before it. Run by the
+    workers of a validation pool, straight from the encoded blocks: the
+    hashed header and the transaction strings are rebuilt from their
+    fields without building Blocks or Transactions.
+
+    arguments:
+    data -- the blocks, encoded with blocks_to_bytes
+
+    returns:
+    ((index, prev_hash) of the first block, (index, hash) of the last),
+    None if a block is invalid or doesn't extend the one before it
+    """
+    try:
+        count, = struct.unpack_from('>I', data)
+        offset = 4
+        first = last = None
+        for _ in range(count):
+            index, nonce, prev_hash, merkle_root, hash, transactions = BLOCK_HEADER.unpack_from(data, offset)
+            offset += BLOCK_HEADER.size
+            prev_hash = prev_hash.hex() if any(prev_hash) else ''
+            merkle_root = merkle_root.hex()
+            hash = hash.hex()
+            strings = []
+            for _ in range(transactions):
+                if data[offset] == BINARY_TRANSACTION:
+                    string, offset = Transaction.serialized_from_bytes(data, offset + 1)
+                else:
+                    _, length = RAW_LENGTH.unpack_from(data, offset)
+                    offset += RAW_LENGTH.size
+                    string = str(data[offset:offset + length], 'utf-8')
+                    offset += length
+                strings.append(string)
+            if (not strings or hash[:BLOCK_DIFFICULTY] != '0' * BLOCK_DIFFICULTY or
+                    hash != hashlib.sha256(format_header(index, nonce, merkle_root, prev_hash)).hexdigest() or
+                    merkle_root != calculate_merkle_root(strings)):
+                return None
+            if last is None:
+                first = (index, prev_hash)
+            elif prev_hash != last[1] or index != last[0] + 1:
+                return None
+            last = (index, hash)
+    except (ValueError, IndexError, struct.error):
+        # cut off or not UTF-8
+        return None
+    if last is None:
+        return None
+    return first, last
+
+
+def validate_chunks(chunks, prev, pool):
+    """
+    Validate blocks in parallel: every chunk is checked by check_blocks in
+    a pool worker, then the chunks' links to each other are checked in
+    order here
+
+    arguments:
+    chunks -- iterable of encoded chunks of blocks, in chain order
+    prev -- (index, hash) of the block before the first one, None to not
+            check the first block's link
+    pool -- multiprocessing.Pool to check the chunks in
+
+    returns:
+    True if every block is valid and extends the one before it
+    """
+    for ends in pool.imap(check_blocks, chunks):
+        if ends is None:
+            return False
+        (index, prev_hash), last = ends
+        if prev is not None and (prev_hash != prev[1] or index != prev[0] + 1):
+            return False
+        prev = last
+    return True
+
+
+class AccountHistory:
+    def __init__(self):
+        """
+        Constructor for AccountHistory class
+
+        Wallet -> [heights, balances, counts]: the heights of the blocks
+        holding its transactions (oldest first), its balance after each of
+        those blocks, and how many of its transactions the chain holds up
+        to and including each of them. Lookups bisect these lists instead
+        of scanning the chain. A BlockStore keeps a HistoryIndex with the
+        same methods on disk instead. The lists are arrays of machine
+        numbers, which take a fraction of the memory of lists of objects.
+        """
+        self.wallets = {}
+
+    def append(self, wallet, height, balance, transactions):
+        """
+        record a block holding transactions of a wallet
+
+        arguments:
+        wallet -- wallet address
+        height -- height of the block, above the wallet's last one
+        balance -- balance of the wallet after the block
+        transactions -- number of the wallet's transactions in the block
+        """
+        entry = self.wallets.get(wallet)
+        if entry is None:
+            self.wallets[wallet] = [array('q', (height,)), array('d', (balance,)), array('q', (transactions,))]
+            return
+        heights, balances, counts = entry
+        # counts last, lookups only read as many entries as counts holds
+        heights.append(height)
+        balances.append(balance)
+        counts.append(counts[-1] + transactions)
+
+    def remove(self, wallet, height):
+        """
+        forget a block that is being removed from the end of the chain
+
+        arguments:
+        wallet -- wallet address
+        height -- height of the block
+        """
+        entry = self.wallets.get(wallet)
+        if entry is None or entry[0][-1] != height:
+            return
+        if len(entry[0]) == 1:
+            del self.wallets[wallet]
+            return
+        heights, balances, counts = entry
+        counts.pop()
+        balances.pop()
+        heights.pop()
+
+    def count(self, wallet):
+        """
+        number of a wallet's transactions in the chain
+        """
+        entry = self.wallets.get(wallet)
+        return entry[2][-1] if entry is not None else 0
+
+    def balance_at(self, wallet, height):
+        """
+        balance of a wallet after the block at a height
+
+        returns:
+        the balance, None if the wallet has no transactions up to that height
+        """
+        entry = self.wallets.get(wallet)
+        if entry is None:
+            return None
+        heights, balances, counts = entry
+        i = bisect.bisect_right(heights, height, 0, len(counts))
+        return balances[i - 1] if i else None
+
+    def blocks(self, wallet, start, stop):
+        """
+        find the blocks holding a range of a wallet's transactions
+
+        arguments:
+        wallet -- wallet address
+        start -- number of the first transaction, counting from the oldest
+        stop -- number of the transaction to stop before
+
+        returns:
+        list of (height, number of the wallet's transactions up to and
+        including the block), oldest first
+        """
+        entry = self.wallets.get(wallet)
+        if entry is None or start >= stop:
+            return []
+        heights, _, counts = entry
+        end = len(counts)
+        first = bisect.bisect_right(counts, start, 0, end)
+        last = bisect.bisect_left(counts, stop, first, end)
+        return list(zip(heights[first:last + 1], counts[first:last + 1]))
+
+    def clear(self):
+        self.wallets.clear()
+
+
 class Blockchain:
-    def __init__(self, chain=None):
+    def __init__(self, chain=None, store=None):
         """
         Constructor for Blockchain class
 
         Initializes the blockchain with a genesis block.
+
+        arguments:
+        chain -- list of blocks to start from instead of a new genesis block
+        store -- optional BlockStore to keep the chain on disk in, a chain
+                 already in the store is loaded along with its last ledger
+                 checkpoint
         """
-        if chain is not None:
+        if store is not None:
+            self.blockchain = store
+        elif chain is not None:
             self.blockchain = chain
+            # each block's prev_hash can share the previous block's hash string
+            for i in range(1, len(chain)):
+                if chain[i].prev_hash == chain[i - 1].hash:
+                    chain[i].prev_hash = chain[i - 1].hash
         else:
             self.blockchain = []
-            block = Block(0, 0, 'GENESIS', '')
-            while not block.is_valid_block():
-                block.nonce = random.randint(0, 2**32)
-                block.hash = block.calculate_hash()
+        if chain is None and not self.blockchain:
+            block = Block(0, 0, ['GENESIS'], '')
+            block.solve(random.randint(0, mining.MAX_NONCE))
             self.blockchain.append(block)
+        self.store = store
+        # height of the block the store's ledger checkpoint was taken at
+        self.checkpoint_height = -1
+        # wallet -> balance, kept up to date as blocks are appended
+        self.balances = {}
+        # transaction ID -> index of the block holding it, kept on disk
+        # with the chain when there is a store
+        self.transaction_ids = store.transaction_ids if store is not None else {}
+        # wallet -> heights of the blocks holding its transactions, with
+        # its balance after each
+        self.history = store.history if store is not None else AccountHistory()
+        # (block hash, previous balances, transaction IDs) of recent blocks,
+        # used to undo their ledger changes when the chain forks
+        self.undo_log = deque(maxlen=MAX_UNDO_DEPTH)
+        self.lock = threading.RLock()
+        # hashes computed by the last proof-of-work search, and hashes per
+        # second
+        self.attempts = 0
+        self.hash_rate = 0.0
+        if store is None or not self.load_checkpoint():
+            self.rebuild_ledger()
+
+    def rebuild_ledger(self):
+        """
+        Rebuild the balance ledger and transaction ID index by replaying
+        every block in the chain
+        """
+        with self.lock:
+            self.balances = {}
+            self.transaction_ids.clear()
+            self.history.clear()
+            self.undo_log.clear()
+            for i in range(1, len(self.blockchain)):
+                self.update_ledger(self.blockchain[i])
+
+    def load_checkpoint(self):
+        """
+        Load the ledger from the store's last checkpoint and replay only the
+        blocks after it
+
+        returns:
+        False if there is no usable checkpoint
+        """
+        checkpoint = self.store.load_checkpoint()
+        if checkpoint is None:
+            return False
+        with self.lock:
+            height, self.balances = checkpoint
+            self.checkpoint_height = height
+            self.undo_log.clear()
+            for i in range(height + 1, len(self.blockchain)):
+                self.update_ledger(self.blockchain[i])
+        return True
 
-    def verify_transaction(self, data, wallets):
+    def save_checkpoint(self, force=False):
+        """
+        Checkpoint the ledger of a chain kept on disk, every
+        CHECKPOINT_INTERVAL blocks
+
+        arguments:
+        force -- checkpoint now, whatever the height
+        """
+        if self.store is not None and (force or len(self.blockchain) % CHECKPOINT_INTERVAL == 0):
+            with self.lock:
+                self.store.save_checkpoint(self.balances)
+                self.checkpoint_height = len(self.blockchain) - 1
+
+    def persist(self, store):
+        """
+        Move the chain into a BlockStore, replacing what it held, and
+        checkpoint the ledger. The transaction ID index and wallet history
+        move into the store's ledger database too, so they are rebuilt
+        there before the checkpoint commits them.
+
+        arguments:
+        store -- the BlockStore
+        """
+        with self.lock:
+            del store[0:]
+            store.extend(self.blockchain)
+            self.transaction_ids = store.transaction_ids
+            self.history = store.history
+            # replayed from the blocks still in memory
+            self.rebuild_ledger()
+            self.blockchain = store
+            self.store = store
+            self.save_checkpoint(force=True)
+
+    def update_ledger(self, block):
+        """
+        Apply the transactions stored in a block to the balance ledger,
+        transaction ID index and wallet history
+
+        arguments:
+        block -- block that was just appended to the chain
+        """
+        previous = {}
+        # wallet -> number of its transactions in the block
+        counts = {}
+        ids = []
+        for t in block.parsed_transactions:
+            for wallet in (t.sender, t.recipient):
+                if wallet not in previous:
+                    previous[wallet] = self.balances.get(wallet)
+            counts[t.sender] = counts.get(t.sender, 0) + 1
+            if t.recipient != t.sender:
+                counts[t.recipient] = counts.get(t.recipient, 0) + 1
+            self.balances[t.sender] = self.get_balance(t.sender) - t.amount
+            self.balances[t.recipient] = self.get_balance(t.recipient) + t.amount
+            self.transaction_ids[t.trans_id] = block.index
+            ids.append(t.trans_id)
+        for wallet, count in counts.items():
+            self.history.append(wallet, block.index, self.balances[wallet], count)
+        self.undo_log.append((block.hash, previous, ids))
+
+    def revert_ledger(self, block):
+        """
+        Undo the ledger, transaction ID index and wallet history changes of
+        the last block applied to them
+
+        arguments:
+        block -- block that is being removed from the end of the chain
+
+        returns:
+        True if the changes were undone, False if the undo log doesn't end
+        with the block
+        """
+        if not self.undo_log:
+            # the log is lost on restart and only holds the last
+            # MAX_UNDO_DEPTH blocks, the wallet history still has the
+            # balances from before the block
+            self.revert_from_history(block)
+            return True
+        if self.undo_log[-1][0] != block.hash:
+            return False
+        _, previous, ids = self.undo_log.pop()
+        for wallet, balance in previous.items():
+            self.history.remove(wallet, block.index)
+            if balance is None:
+                del self.balances[wallet]
+            else:
+                self.balances[wallet] = balance
+        for trans_id in ids:
+            del self.transaction_ids[trans_id]
+        return True
+
+    def revert_from_history(self, block):
+        """
+        Undo the ledger, transaction ID index and wallet history changes of
+        the last block of the chain without its undo log entry, looking up
+        each of its wallets' balances before it in the wallet history
+
+        arguments:
+        block -- block that is being removed from the end of the chain
+        """
+        wallets = set()
+        for t in block.parsed_transactions:
+            wallets.add(t.sender)
+            wallets.add(t.recipient)
+            # a transaction also mined in an earlier block keeps its height
+            if self.transaction_ids.get(t.trans_id) == block.index:
+                del self.transaction_ids[t.trans_id]
+        for wallet in wallets:
+            self.history.remove(wallet, block.index)
+            balance = self.history.balance_at(wallet, block.index - 1)
+            if balance is None:
+                self.balances.pop(wallet, None)
+            else:
+                self.balances[wallet] = balance
+
+    def get_balance(self, wallet):
+        """
+        Look up the current balance of a wallet
+
+        arguments:
+        wallet -- wallet address
+
+        returns:
+        balance of the wallet, STARTING_WALLET_AMOUNT if it has never been used
+        """
+        return self.balances.get(wallet, STARTING_WALLET_AMOUNT)
+
+    def verify_transaction(self, data, wallets, mempool=None):
         """
         verifies if a transaction is valid
 
         args:
         data -- the transaction
-        wallets -- the known wallets
+        wallets -- (set of every registered wallet, set of active wallets)
+        mempool -- optional mempool of transactions waiting to be mined,
+                   their spending is taken out of the sender's balance
 
         returns:
         0 if valid
         else returns statement describing error
         """
         transaction = Transaction.deserialize(data)
+        # NaN and infinite amounts would slip past the balance check
+        if type(transaction.amount) not in (int, float) or not math.isfinite(transaction.amount):
+            return 'TRANSACTION FAILED: invalid amount.\n'
         # check for duplicates
-        if self.transaction_exists(transaction.id):
+        if self.transaction_exists(transaction.trans_id):
             return 'TRANSACTION FAILED: transaction already on chain'
+        if mempool is not None and mempool.contains(transaction.trans_id):
+            return 'TRANSACTION FAILED: transaction already pending'
         # check to ensure recepient is in known wallets
         if transaction.recipient in wallets[0]:
             if transaction.recipient in wallets[1]:
-                # iterate through chain, check to see if sender has enough money
-                money = STARTING_WALLET_AMOUNT
-                for i in range(1, len(self.blockchain)):
-                    t = Transaction.deserialize(self.blockchain[i].transaction)
-                    if t.sender == transaction.sender:
-                        money -= t.amount
-                    if t.recipient == transaction.sender:
-                        money += t.amount
+                # check the ledger to see if sender has enough money
+                money = self.get_balance(transaction.sender)
+                if mempool is not None:
+                    money -= mempool.pending_spend(transaction.sender)
                 if transaction.amount > money:
                     return f'TRANSACTION FAILED: {transaction.sender} only has ${money} in their account.\n'
                 else:
@@ -151,49 +823,237 @@ class Blockchain:
         arguments:
         trans_id -- ID of the transaction to check.
         """
-        for block in self.blockchain:
-            if block.transaction == "GENESIS":
+        return trans_id in self.transaction_ids
+
+    def get_transaction_height(self, trans_id):
+        """
+        Look up the block holding a transaction
+
+        arguments:
+        trans_id -- ID of the transaction
+
+        returns:
+        height of the block, None if the transaction isn't in the chain
+        """
+        return self.transaction_ids.get(trans_id)
+
+    def get_balance_at(self, wallet, height):
+        """
+        Look up the balance a wallet had after the block at a height, from
+        the wallet history instead of replaying the chain
+
+        arguments:
+        wallet -- wallet address
+        height -- height of the block
+
+        returns:
+        balance of the wallet, STARTING_WALLET_AMOUNT if it hadn't been used yet
+        """
+        balance = self.history.balance_at(wallet, height)
+        return balance if balance is not None else STARTING_WALLET_AMOUNT
+
+    def get_history(self, wallet, offset=0, limit=10):
+        """
+        Find the transactions a wallet sent or received, newest first. The
+        wallet history gives the blocks holding the page directly, so only
+        those blocks are read.
+
+        arguments:
+        wallet -- wallet address
+        offset -- number of the newest transactions to skip
+        limit -- maximum number of transactions to return
+
+        returns:
+        (list of (height, Transaction), True if there are older transactions)
+        """
+        # the page holds the wallet's transactions number start to stop - 1,
+        # counting from its oldest
+        stop = self.history.count(wallet) - offset
+        start = max(stop - limit, 0)
+        found = []
+        for height, count in reversed(self.history.blocks(wallet, start, stop)):
+            try:
+                block = self.blockchain[height]
+            except IndexError:
+                # the end of the chain was replaced while reading
                 continue
-            if Transaction.deserialize(block.transaction).id == trans_id:
-                return True
-        return False
+            for t in reversed(block.parsed_transactions):
+                if wallet != t.sender and wallet != t.recipient:
+                    continue
+                count -= 1
+                if start <= count < stop:
+                    found.append((height, t))
+        return found, start > 0
+
+    def select_transactions(self, transactions):
+        """
+        Check a batch of pending transactions against the current chain,
+        keeping the ones that can still go in the next block
+
+        arguments:
+        transactions -- transaction strings in the order they should be mined
+
+        returns:
+        (list of transactions to mine,
+         list of (transaction, error) for transactions that can't be mined)
+        """
+        selected = []
+        rejected = []
+        spent = {}
+        ids = set()
+        for data in transactions:
+            t = Transaction.deserialize(data)
+            money = self.get_balance(t.sender) - spent.get(t.sender, 0.0)
+            if self.transaction_exists(t.trans_id) or t.trans_id in ids:
+                rejected.append((data, 'TRANSACTION FAILED: transaction already on chain'))
+            elif t.amount > money:
+                rejected.append((data, f'TRANSACTION FAILED: {t.sender} only has ${money} in their account.\n'))
+            else:
+                selected.append(data)
+                spent[t.sender] = spent.get(t.sender, 0.0) + t.amount
+                ids.add(t.trans_id)
+        return selected, rejected
     
 
-    def mine(self, data):
+    def mine(self, transactions, search=mining.search, cancel=None):
         """
-        Mine a new block with the provided data
+        Mine a new block with the provided transactions
 
         Args:
-            data (str): Data to be stored in the new block
+            transactions (list): Transaction strings to be stored in the new block
+            search (function): Proof-of-work search to run, see Block.solve
+            cancel (function): Optional function, mining is aborted once it returns True
 
         Returns:
-            block and boolean describing if mined block was added
+            block and boolean describing if mined block was added,
+            block is None if mining was cancelled
         """
         index = len(self.blockchain)
         prev_hash = self.blockchain[-1].hash if self.blockchain else ''
         nonce = 0
         # create block
-        block = Block(index, nonce, data, prev_hash)
-        # check diff nonces to find valid block
-        while not block.is_valid_block():
-            block.nonce = random.randint(0, 2**32)
-            block.hash = block.calculate_hash()
+        block = Block(index, nonce, transactions, prev_hash)
+        # try sequential nonces from a random starting point to find valid block
+        start = time.time()
+        self.attempts = block.solve(random.randint(0, mining.MAX_NONCE), cancel, search)
+        self.hash_rate = self.attempts / max(time.time() - start, 1e-9)
+        if cancel is not None and cancel():
+            return None, False
         added = self.add_block(block)
         return block, added
 
-    def is_valid_chain(self):
+    def is_valid_chain(self, pool=None, received=None):
         """
         Check if the blockchain is valid
 
+        Args:
+            pool (multiprocessing.Pool): Optional pool to check the blocks of
+                a long chain in, in chunks, see validate_chunks. The chunks
+                are read from the store's files, or cut from the chain as it
+                was received; a chain that is neither is checked here, since
+                encoding it costs about as much as checking it.
+            received (tuple): (data, positions) of the chain as received in
+                the binary wire format, see blocks_from_bytes
+
         Returns:
             bool: True if the blockchain is valid, False otherwise
         """
+        if (pool is not None and len(self.blockchain) >= PARALLEL_VALIDATION_THRESHOLD and
+                (self.store is not None or received is not None)):
+            genesis = self.blockchain[0]
+            if self.store is not None:
+                chunks = (self.store.encode_blocks(start, start + VALIDATION_CHUNK_SIZE)
+                          for start in range(1, len(self.blockchain), VALIDATION_CHUNK_SIZE))
+            else:
+                chunks = received_chunks(received, 1, len(self.blockchain))
+            return validate_chunks(chunks, (genesis.index, genesis.hash), pool)
         # iterate over chain, checking to see if indexes or hashes are off
         for i in range(1, len(self.blockchain)):
             if not self.blockchain[i].is_valid_block() or self.blockchain[i].prev_hash != self.blockchain[i - 1].hash or self.blockchain[i].index != self.blockchain[i-1].index + 1:
                 return False
         return True    
 
+    def encode_blocks(self, start, stop):
+        """
+        Encode part of the chain with blocks_to_bytes, read straight from
+        the store's files when the chain is on disk
+
+        arguments:
+        start -- height of the first block
+        stop -- height to stop before
+        """
+        if self.store is not None:
+            return self.store.encode_blocks(start, stop)
+        return blocks_to_bytes(self.blockchain[start:stop])
+
+    def replace_suffix(self, start, blocks, pool=None, received=None):
+        """
+        Replace the end of the chain with a peer's blocks. The fork point is
+        found by comparing hashes from the end of the overlap backward, only
+        the blocks after it are validated, and the ledger is updated by
+        undoing the removed blocks and applying the new ones.
+
+        arguments:
+        start -- height of the first of the peer's blocks
+        blocks -- the peer's blocks from start to its tip
+        pool -- optional multiprocessing.Pool to validate a long suffix in,
+                from slices of received
+        received -- (data, positions) of the blocks as received in the
+                    binary wire format, see blocks_from_bytes
+
+        returns:
+        number of blocks removed from the end of the chain,
+        None if the blocks were invalid
+        """
+        with self.lock:
+            chain = self.blockchain
+            # the blocks must continue our chain, not start past its end
+            if start > len(chain):
+                return None
+            # find the last block both chains share
+            fork = min(len(chain), start + len(blocks))
+            while fork > start and self.block_hash(fork - 1) != blocks[fork - 1 - start].hash:
+                fork -= 1
+            suffix = blocks[fork - start:]
+
+            # validate only the blocks after the fork point
+            prev = chain[fork - 1] if fork > 0 else None
+            if pool is not None and received is not None and len(suffix) >= PARALLEL_VALIDATION_THRESHOLD:
+                chunks = received_chunks(received, fork - start, len(blocks))
+                if not validate_chunks(chunks, (prev.index, prev.hash) if prev is not None else None, pool):
+                    return None
+                for block in suffix:
+                    if prev is not None:
+                        block.prev_hash = prev.hash
+                    prev = block
+            else:
+                for block in suffix:
+                    if prev is not None and (not block.is_valid_block() or
+                                             block.prev_hash != prev.hash or
+                                             block.index != prev.index + 1):
+                        return None
+                    if prev is not None:
+                        block.prev_hash = prev.hash
+                    prev = block
+
+            # undo the ledger changes of the replaced blocks, newest first
+            removed = len(chain) - fork
+            rebuild = False
+            for block in reversed(chain[fork:]):
+                if not self.revert_ledger(block):
+                    rebuild = True
+                    break
+            del chain[fork:]
+            chain.extend(suffix)
+            if rebuild or fork == 0:
+                self.rebuild_ledger()
+            else:
+                for block in suffix:
+                    self.update_ledger(block)
+            # a checkpoint taken at a replaced block can't be used anymore
+            self.save_checkpoint(force=fork <= self.checkpoint_height)
+            return removed
+
     def add_block(self, block):
         """
         Add block to the end of the chain IF it is valid
@@ -201,11 +1061,63 @@ class Blockchain:
         arguments:
         block -- block to add
         """
-        if block.prev_hash == self.blockchain[-1].hash and block.is_valid_block():
-            self.blockchain.append(block)
-            return True
+        with self.lock:
+            if block.prev_hash == self.blockchain[-1].hash and block.is_valid_block():
+                block.prev_hash = self.blockchain[-1].hash
+                self.blockchain.append(block)
+                self.update_ledger(block)
+                self.save_checkpoint()
+                return True
         return False
     
+    def block_hash(self, height):
+        """
+        Hash of the block at a height, read from the store's index without
+        loading the block when the chain is on disk
+
+        arguments:
+        height -- height of the block
+        """
+        if self.store is not None:
+            return self.store.hash(height)
+        return self.blockchain[height].hash
+
+    def get_locator(self):
+        """
+        Build a block locator: [height, hash] pairs walking back from the
+        tip, one step at a time for the first few blocks and then doubling
+        the step, always ending with the genesis block. A peer uses it to
+        find the last block both chains have in common.
+
+        returns:
+        list of [height, hash] pairs, highest first
+        """
+        locator = []
+        height = len(self.blockchain) - 1
+        step = 1
+        while height > 0:
+            locator.append([height, self.block_hash(height)])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append([0, self.block_hash(0)])
+        return locator
+
+    def find_start(self, locator):
+        """
+        Find where a peer's chain stops matching this one
+
+        arguments:
+        locator -- block locator from the peer, see get_locator
+
+        returns:
+        height of the first block the peer is missing
+        """
+        for height, hash in locator:
+            if height < len(self.blockchain) and self.block_hash(height) == hash:
+                return height + 1
+        return 0
+
     def print_chain(self):
         """
         prints out each block in the chain
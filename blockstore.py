@@ -0,0 +1,355 @@
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from blockchain import Block
+
+SEGMENT_FILE = 'blocks.dat'  # blocks in the binary wire format, one after another
+INDEX_FILE = 'blocks.idx'  # one INDEX_ENTRY per block, in height order
+LEDGER_FILE = 'ledger.db'  # transaction ID and wallet history indexes, and the balances at the last checkpoint
+INDEX_ENTRY = struct.Struct('>QI32s')  # offset and size in the segment file, block hash
+BLOCK_CACHE_SIZE = 1024  # decoded blocks kept in memory
+
+
+class TransactionIndex:
+    def __init__(self, db, lock):
+        """
+        Constructor for TransactionIndex class
+
+        Transaction ID -> height of its block, kept in the store's ledger
+        database instead of memory. It can be used in place of the dict in
+        Blockchain.transaction_ids. Changes are committed together with the
+        balances when the store saves a checkpoint.
+
+        arguments:
+        db -- sqlite3 connection to the ledger database
+        lock -- lock serializing use of the connection
+        """
+        self.db = db
+        self.lock = lock
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+
+    def __contains__(self, trans_id):
+        return self.get(trans_id) is not None
+
+    def __getitem__(self, trans_id):
+        height = self.get(trans_id)
+        if height is None:
+            raise KeyError(trans_id)
+        return height
+
+    def __setitem__(self, trans_id, height):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO transactions VALUES (?, ?)', (trans_id, height))
+
+    def __delitem__(self, trans_id):
+        with self.lock:
+            self.db.execute('DELETE FROM transactions WHERE id = ?', (trans_id,))
+
+    def get(self, trans_id, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT height FROM transactions WHERE id = ?', (trans_id,)).fetchone()
+        return row[0] if row is not None else default
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM transactions')
+
+
+class HistoryIndex:
+    def __init__(self, db, lock):
+        """
+        Constructor for HistoryIndex class
+
+        Wallet -> the blocks holding its transactions, with its balance and
+        number of transactions after each, kept in the store's ledger
+        database. It can be used in place of the AccountHistory in
+        Blockchain.history, and is committed with the checkpoints like the
+        TransactionIndex.
+
+        arguments:
+        db -- sqlite3 connection to the ledger database
+        lock -- lock serializing use of the connection
+        """
+        self.db = db
+        self.lock = lock
+
+    def append(self, wallet, height, balance, transactions):
+        with self.lock:
+            # blocks replayed after a checkpoint may already be recorded
+            row = self.db.execute('SELECT count FROM history WHERE wallet = ? AND height < ? '
+                                  'ORDER BY height DESC LIMIT 1', (wallet, height)).fetchone()
+            count = (row[0] if row is not None else 0) + transactions
+            self.db.execute('INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)', (wallet, height, balance, count))
+
+    def remove(self, wallet, height):
+        with self.lock:
+            self.db.execute('DELETE FROM history WHERE wallet = ? AND height = ?', (wallet, height))
+
+    def count(self, wallet):
+        with self.lock:
+            row = self.db.execute('SELECT count FROM history WHERE wallet = ? '
+                                  'ORDER BY height DESC LIMIT 1', (wallet,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def balance_at(self, wallet, height):
+        with self.lock:
+            row = self.db.execute('SELECT balance FROM history WHERE wallet = ? AND height <= ? '
+                                  'ORDER BY height DESC LIMIT 1', (wallet, height)).fetchone()
+        return row[0] if row is not None else None
+
+    def blocks(self, wallet, start, stop):
+        if start >= stop:
+            return []
+        # every block holds at least one of the wallet's transactions
+        with self.lock:
+            rows = self.db.execute('SELECT height, count FROM history WHERE wallet = ? AND count > ? '
+                                   'ORDER BY count LIMIT ?', (wallet, start, stop - start)).fetchall()
+        for i, (_, count) in enumerate(rows):
+            if count >= stop:
+                return rows[:i + 1]
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM history')
+
+
+class BlockStore:
+    def __init__(self, directory, cache_size=BLOCK_CACHE_SIZE):
+        """
+        Constructor for BlockStore class
+
+        Keeps a chain on disk in an append-only segment file, with an index
+        of fixed-size entries giving each block's position. Only the most
+        recently used blocks are kept in memory. It can be used in place of
+        the list in Blockchain.blockchain: it supports len(), indexing,
+        slicing, iteration, append(), extend() and deleting the end of the
+        chain with del store[height:]. The transaction ID index, wallet
+        history and checkpoints of the balances are kept in an SQLite
+        database next to the blocks.
+
+        A write that was cut off (e.g. the miner was killed while appending)
+        is dropped when the store is opened.
+
+        arguments:
+        directory -- directory holding the store's files, created if needed
+        cache_size -- number of decoded blocks kept in memory
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.cache_size = cache_size
+        self.segment = open(os.path.join(directory, SEGMENT_FILE), 'a+b')
+        self.index = open(os.path.join(directory, INDEX_FILE), 'a+b')
+        # height -> decoded block, least recently used first
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+
+        # drop a partly written index entry and any block data past the
+        # last complete entry
+        self.length = os.path.getsize(self.index.name) // INDEX_ENTRY.size
+        self.index.truncate(self.length * INDEX_ENTRY.size)
+        self.end = 0
+        if self.length:
+            offset, size, _ = self.entry(self.length - 1)
+            self.end = offset + size
+        self.segment.truncate(self.end)
+
+        self.db = sqlite3.connect(os.path.join(directory, LEDGER_FILE), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS transactions (id TEXT PRIMARY KEY, height INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS balances (wallet TEXT PRIMARY KEY, balance REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS checkpoint (height INTEGER, hash TEXT)')
+        if 'count' not in [row[1] for row in self.db.execute('PRAGMA table_info(history)')]:
+            # a store written before the wallet history (or its balances)
+            # was kept, its checkpoint can't be used to rebuild the history
+            self.db.execute('DELETE FROM checkpoint')
+            self.db.execute('DROP TABLE IF EXISTS history')
+            self.db.execute('CREATE TABLE history (wallet TEXT, height INTEGER, balance REAL, count INTEGER, '
+                            'PRIMARY KEY (wallet, height)) WITHOUT ROWID')
+            self.db.execute('CREATE INDEX history_count ON history (wallet, count)')
+        self.db.commit()
+        self.transaction_ids = TransactionIndex(self.db, self.lock)
+        self.history = HistoryIndex(self.db, self.lock)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.get(height) for height in range(*key.indices(self.length))]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('block height out of range')
+        return self.get(key)
+
+    def __delitem__(self, key):
+        if not isinstance(key, slice) or key.stop is not None or key.step is not None:
+            raise TypeError('only the end of the chain can be deleted, use del store[height:]')
+        self.truncate(key.indices(self.length)[0])
+
+    def __iter__(self):
+        for height in range(self.length):
+            yield self.get(height)
+
+    def entry(self, height):
+        """
+        read a block's index entry
+
+        arguments:
+        height -- height of the block
+
+        returns:
+        (offset, size, raw hash)
+        """
+        with self.lock:
+            self.index.seek(height * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+
+    def hash(self, height):
+        """
+        hash of the block at a height, read from the index without loading
+        the block
+
+        arguments:
+        height -- height of the block
+        """
+        if height < 0:
+            height += self.length
+        return self.entry(height)[2].hex()
+
+    def get(self, height):
+        """
+        load the block at a height, from the cache if it was used recently
+
+        arguments:
+        height -- height of the block
+        """
+        with self.lock:
+            block = self.cache.get(height)
+            if block is not None:
+                self.cache.move_to_end(height)
+                return block
+            offset, size, _ = self.entry(height)
+            self.segment.seek(offset)
+            block = Block.from_bytes(self.segment.read(size))[0]
+            self.remember(height, block)
+            return block
+
+    def encode_blocks(self, start, stop):
+        """
+        read a range of blocks in the format of blocks_to_bytes without
+        decoding them, the segment file already holds them back to back
+
+        arguments:
+        start -- height of the first block
+        stop -- height to stop before
+        """
+        with self.lock:
+            stop = min(stop, self.length)
+            if start >= stop:
+                return struct.pack('>I', 0)
+            offset = self.entry(start)[0]
+            last_offset, last_size, _ = self.entry(stop - 1)
+            self.segment.seek(offset)
+            return struct.pack('>I', stop - start) + self.segment.read(last_offset + last_size - offset)
+
+    def remember(self, height, block):
+        self.cache[height] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def append(self, block):
+        """
+        add a block to the end of the chain
+
+        arguments:
+        block -- the block, its index must be the next height
+        """
+        with self.lock:
+            data = block.to_bytes()
+            # block data goes first so a complete index entry always points
+            # at complete data
+            self.segment.write(data)
+            self.segment.flush()
+            self.index.write(INDEX_ENTRY.pack(self.end, len(data), bytes.fromhex(block.hash)))
+            self.index.flush()
+            self.end += len(data)
+            self.remember(self.length, block)
+            self.length += 1
+
+    def extend(self, blocks):
+        """
+        add blocks to the end of the chain
+
+        arguments:
+        blocks -- the blocks, in height order
+        """
+        for block in blocks:
+            self.append(block)
+
+    def truncate(self, height):
+        """
+        remove every block from a height to the end of the chain, used when
+        the end of the chain is replaced by a fork
+
+        arguments:
+        height -- height of the first block to remove
+        """
+        with self.lock:
+            if height >= self.length:
+                return
+            offset = self.entry(height)[0]
+            self.index.truncate(height * INDEX_ENTRY.size)
+            self.segment.truncate(offset)
+            self.length = height
+            self.end = offset
+            for cached in [h for h in self.cache if h >= height]:
+                del self.cache[cached]
+
+    def save_checkpoint(self, balances):
+        """
+        save the balances for the current tip and commit the transaction ID
+        index and wallet history, so the ledger doesn't have to be rebuilt
+        from the whole chain on restart. The blocks are synced to disk
+        first, and the checkpoint is written in one database transaction.
+
+        arguments:
+        balances -- wallet -> balance
+        """
+        with self.lock:
+            os.fsync(self.segment.fileno())
+            os.fsync(self.index.fileno())
+            height = self.length - 1
+            self.db.execute('DELETE FROM balances')
+            self.db.executemany('INSERT INTO balances VALUES (?, ?)', balances.items())
+            self.db.execute('DELETE FROM checkpoint')
+            self.db.execute('INSERT INTO checkpoint VALUES (?, ?)', (height, self.hash(height)))
+            self.db.commit()
+
+    def load_checkpoint(self):
+        """
+        load the last checkpoint if it still matches the chain
+
+        returns:
+        (height, balances), None if there is no checkpoint or the block it
+        was taken at has been replaced
+        """
+        with self.lock:
+            row = self.db.execute('SELECT height, hash FROM checkpoint').fetchone()
+            if row is None:
+                return None
+            height, hash = row
+            if height >= self.length or self.hash(height) != hash:
+                return None
+            return height, dict(self.db.execute('SELECT wallet, balance FROM balances'))
+
+    def close(self):
+        with self.lock:
+            self.segment.close()
+            self.index.close()
+            self.db.close()
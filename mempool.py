@@ -0,0 +1,119 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from transaction import Transaction
+
+
+class Mempool:
+    def __init__(self):
+        """
+        Constructor for Mempool class
+
+        Holds verified transactions that are waiting to be mined, in the
+        order they arrived
+        """
+        # transaction ID -> [data, sender, amount, conn, response, arrival time]
+        self.transactions = OrderedDict()
+        # sender -> [total amount, number] of their pending transactions
+        self.spending = {}
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def add(self, data, conn, response):
+        """
+        add a verified transaction to the pool
+
+        arguments:
+        data -- serialized transaction
+        conn -- connection of the trader waiting on the transaction
+        response -- message to send the trader once the transaction is mined
+
+        returns:
+        False if the transaction was already pending
+        """
+        t = Transaction.deserialize(data)
+        with self.condition:
+            # a second copy would count against the sender's balance twice
+            if t.trans_id in self.transactions:
+                return False
+            self.transactions[t.trans_id] = [data, t.sender, t.amount, conn, response, time.time()]
+            spending = self.spending.setdefault(t.sender, [0.0, 0])
+            spending[0] += t.amount
+            spending[1] += 1
+            self.condition.notify_all()
+            return True
+
+    def remove(self, trans_id):
+        """
+        remove a transaction from the pool
+
+        arguments:
+        trans_id -- ID of the transaction
+
+        returns:
+        (conn, response) stored with the transaction, None if it wasn't pending
+        """
+        with self.condition:
+            entry = self.transactions.pop(trans_id, None)
+            if entry is None:
+                return None
+            _, sender, amount, conn, response, _ = entry
+            spending = self.spending[sender]
+            spending[0] -= amount
+            spending[1] -= 1
+            if spending[1] == 0:
+                del self.spending[sender]
+            return conn, response
+
+    def contains(self, trans_id):
+        """
+        check if a transaction is pending
+
+        arguments:
+        trans_id -- ID of the transaction
+        """
+        return trans_id in self.transactions
+
+    def pending_spend(self, wallet):
+        """
+        total amount a wallet is sending in pending transactions
+
+        arguments:
+        wallet -- wallet address
+        """
+        spending = self.spending.get(wallet)
+        return spending[0] if spending is not None else 0.0
+
+    def ids(self):
+        """
+        IDs of every pending transaction
+        """
+        with self.condition:
+            return list(self.transactions)
+
+    def wait_for_batch(self, block_size, batch_interval):
+        """
+        block until a batch is ready to be mined: either block_size
+        transactions are pending, or the oldest one has waited batch_interval
+        seconds
+
+        arguments:
+        block_size -- maximum number of transactions in a block
+        batch_interval -- seconds to wait for a batch to fill up
+
+        returns:
+        list of up to block_size transactions, oldest first
+        """
+        with self.condition:
+            while True:
+                if self.transactions:
+                    oldest = next(iter(self.transactions.values()))[5]
+                    waited = time.time() - oldest
+                    if len(self.transactions) >= block_size or waited >= batch_interval:
+                        return [entry[0] for entry in itertools.islice(self.transactions.values(), block_size)]
+                    self.condition.wait(batch_interval - waited)
+                else:
+                    self.condition.wait()
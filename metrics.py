@@ -0,0 +1,302 @@
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    """
+    format a sample value for the text exposition format
+    """
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def format_labels(label, label_value):
+    """
+    format the labels of a sample, '' for an unlabeled sample
+    """
+    if label is None:
+        return ''
+    escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{{{label}="{escaped}"}}'
+
+
+class Registry:
+    def __init__(self):
+        """
+        Constructor for Registry class
+
+        Holds the metrics of one process and renders them in the
+        Prometheus text exposition format
+        """
+        # name -> metric, in the order they were registered
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        add a metric, replacing any metric registered under the same name
+
+        arguments:
+        metric -- Counter, Gauge or Histogram
+
+        returns:
+        the metric
+        """
+        self.lock.acquire()
+        self.metrics[metric.name] = metric
+        self.lock.release()
+        return metric
+
+    def render(self):
+        """
+        returns:
+        every metric in the Prometheus text exposition format, leaving out
+        metrics whose values can't be read
+        """
+        self.lock.acquire()
+        registered = list(self.metrics.values())
+        self.lock.release()
+        lines = []
+        for metric in registered:
+            try:
+                samples = [f'{name}{labels} {format_value(value)}' for name, labels, value in metric.samples()]
+            except Exception:
+                # e.g. a gauge function failing, the other metrics are
+                # still worth scraping
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process, served by serve()
+REGISTRY = Registry()
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, label=None, registry=REGISTRY):
+        """
+        Constructor for Counter class
+
+        A value that only goes up, optionally split by one label
+
+        arguments:
+        name -- metric name, ending in _total
+        help -- description of the metric
+        label -- name of the label the counts are split by, None for one count
+        registry -- Registry to add the counter to
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        # label value -> count, the unlabeled count is under None
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, label_value=None):
+        """
+        add to the count
+
+        arguments:
+        amount -- how much to add
+        label_value -- value of the label, for a labeled counter
+        """
+        self.lock.acquire()
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+        self.lock.release()
+
+    def value(self, label_value=None):
+        """
+        returns:
+        the current count
+        """
+        return self.values.get(label_value, 0)
+
+    def samples(self):
+        """
+        returns:
+        list of (sample name, labels, value)
+        """
+        self.lock.acquire()
+        values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        self.lock.release()
+        if not values and self.label is None:
+            values = [(None, 0)]
+        return [(self.name, format_labels(self.label, label_value), value) for label_value, value in values]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, function=None, label=None, registry=REGISTRY):
+        """
+        Constructor for Gauge class
+
+        A value that goes up and down. It is either set by the code that
+        changes it, or read from function whenever the metrics are scraped,
+        which costs nothing between scrapes.
+
+        arguments:
+        name -- metric name
+        help -- description of the metric
+        function -- returns the current value (a dict of label value ->
+                    value for a labeled gauge), None to set the value instead
+        label -- name of the label the values are split by
+        registry -- Registry to add the gauge to
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+        self.label = label
+        # label value -> value, the unlabeled value is under None
+        self.values = {}
+        registry.register(self)
+
+    def set(self, value, label_value=None):
+        """
+        set the value
+
+        arguments:
+        value -- the new value
+        label_value -- value of the label, for a labeled gauge
+        """
+        self.values[label_value] = value
+
+    def samples(self):
+        """
+        returns:
+        list of (sample name, labels, value)
+        """
+        if self.function is not None:
+            values = self.function()
+            if self.label is None:
+                values = {None: values}
+        else:
+            values = dict(self.values)
+        if not values and self.label is None:
+            values = {None: 0}
+        return [(self.name, format_labels(self.label, label_value), value)
+                for label_value, value in sorted(values.items(), key=lambda item: str(item[0]))]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        """
+        Constructor for Histogram class
+
+        Counts observations, e.g. latencies, in buckets. Each observation
+        only increments its own bucket, the cumulative counts Prometheus
+        expects are added up when the metrics are scraped.
+
+        arguments:
+        name -- metric name, ending in the unit (e.g. _seconds)
+        help -- description of the metric
+        buckets -- sorted upper bounds of the buckets, +Inf is added
+        registry -- Registry to add the histogram to
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value):
+        """
+        record one observation
+
+        arguments:
+        value -- the observed value
+        """
+        bucket = bisect.bisect_left(self.buckets, value)
+        self.lock.acquire()
+        self.counts[bucket] += 1
+        self.sum += value
+        self.lock.release()
+
+    def count(self):
+        """
+        returns:
+        number of observations
+        """
+        return sum(self.counts)
+
+    def samples(self):
+        """
+        returns:
+        list of (sample name, labels, value)
+        """
+        self.lock.acquire()
+        counts = list(self.counts)
+        total = self.sum
+        self.lock.release()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket', format_labels('le', format_value(bound)), cumulative))
+        samples.append((f'{self.name}_sum', '', total))
+        samples.append((f'{self.name}_count', '', cumulative))
+        return samples
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    registry = REGISTRY
+
+    def do_GET(self):
+        """
+        answer a scrape of /metrics
+        """
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are too frequent to print
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    serve the metrics over HTTP at /metrics from a daemon thread
+
+    arguments:
+    port -- port to listen on, 0 picks a free one
+    host -- address to listen on, localhost by default so the metrics
+            aren't exposed to the network
+    registry -- Registry to serve
+
+    returns:
+    the HTTPServer, its server_address holds the port
+    """
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
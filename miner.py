@@ -1,80 +1,612 @@
-from blockchain import Blockchain, Block
+from blockchain import Blockchain, Block, blocks_to_bytes, blocks_from_bytes
+from blockstore import BlockStore
+from mempool import Mempool
+from orphans import OrphanPool, ORPHAN_TIMEOUT
+from transaction import Transaction
 import networking
+import metrics
+import mining
 import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import queue
 import socket
+import struct
 import sys
 import threading
 import json
 import time
 
+QUERY_CACHE_SIZE = 4096  # query answers kept for the current chain tip
+MAX_PAGE_SIZE = 100  # most transactions returned by one history query
+FORK_DEPTH_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)  # buckets of the fork depth histogram, in blocks
+
+class ParallelMiner:
+    def __init__(self, workers):
+        """
+        Constructor for ParallelMiner class
+
+        Starts a pool of worker processes that split the nonce space
+        between them when searching for a valid block
+
+        arguments:
+        workers -- number of worker processes
+        """
+        self.workers = workers
+        self.found = multiprocessing.Event()
+        self.pool = multiprocessing.Pool(workers, initializer=mining.init_worker, initargs=(self.found,))
+        # the pool works on one block at a time
+        self.search_lock = threading.Lock()
+
+    def search(self, header, difficulty, start=0, stop=None, cancel=None):
+        """
+        Parallel version of mining.search. The nonces from start are split
+        into one contiguous range per worker, and the search returns as soon
+        as the first worker finds a valid nonce, cancelling the others.
+
+        arguments:
+        header -- dict of the hashed block fields, without the nonce
+        difficulty -- number of leading zero hex digits required
+        start -- first nonce to try
+        stop -- nonce to stop before, None to search until found
+        cancel -- optional function, the search gives up once it returns True
+
+        returns:
+        (nonce, hash, attempts), nonce and hash are None if no nonce was found
+        """
+        # released even if the pool fails, or every later search would block
+        self.search_lock.acquire()
+        try:
+            nonce, hash, attempts = None, None, 0
+            window = start
+            while nonce is None and (stop is None or window < stop):
+                end = window + mining.MAX_NONCE if stop is None else stop
+                span = -(-(end - window) // self.workers)
+                self.found.clear()
+                results = queue.Queue()
+                for i in range(self.workers):
+                    self.pool.apply_async(mining.search_range,
+                                          (header, difficulty, window + i * span, min(window + (i + 1) * span, end)),
+                                          callback=results.put,
+                                          error_callback=lambda e: results.put((None, None, 0)))
+                # wait for every worker to stop so the pool is idle for the next search
+                cancelled = False
+                for _ in range(self.workers):
+                    while True:
+                        try:
+                            result = results.get(timeout=0.05)
+                            break
+                        except queue.Empty:
+                            if cancel is not None and not cancelled and cancel():
+                                cancelled = True
+                                self.found.set()
+                    attempts += result[2]
+                    if result[0] is not None and nonce is None:
+                        nonce, hash = result[0], result[1]
+                        self.found.set()
+                if cancelled:
+                    break
+                window = end
+        finally:
+            self.search_lock.release()
+        return nonce, hash, attempts
+
+
 class Miner:
-    def __init__(self, client_port):
+    def __init__(self, client_port, workers=1, block_size=16, batch_interval=0.5, data_dir=None,
+                 validation_workers=1, verify_store=False):
         """
         Constructor for Miner class
 
         Initializes a miner node, waits to create blockchain
         until after it checks peer list
+
+        arguments:
+        client_port -- port to listen for peers on
+        workers -- number of processes to mine with
+        block_size -- maximum number of transactions in a block
+        batch_interval -- seconds to wait for a block to fill up before mining it
+        data_dir -- directory to keep the blockchain in, None to keep it in memory only
+        validation_workers -- number of processes to validate long chains with
+        verify_store -- validate the chain loaded from data_dir
         """
         self.blockchain = None
+        # long chains received from peers (or loaded from disk) are
+        # validated in chunks across these processes
+        self.validation_pool = None
+        # on a single CPU the workers would only take turns with this process
+        if validation_workers > 1 and (os.cpu_count() or 1) > 1:
+            self.validation_pool = multiprocessing.Pool(validation_workers)
+        # chain saved by an earlier run is loaded right away, and only the
+        # blocks mined since are fetched from peers
+        self.store = None
+        if data_dir is not None:
+            self.store = BlockStore(data_dir)
+            if len(self.store):
+                self.blockchain = Blockchain(store=self.store)
+                print(f"Loaded {len(self.store)} blocks from {data_dir}")
+                if verify_store and not self.blockchain.is_valid_chain(self.validation_pool):
+                    print("Stored chain is invalid, fetching the chain from peers")
+                    del self.store[0:]
+                    self.blockchain = None
+        self.mempool = Mempool()
+        self.block_size = block_size
+        self.batch_interval = batch_interval
+        # proof-of-work search used when mining blocks
+        self.search = mining.search
+        if workers > 1:
+            self.search = ParallelMiner(workers).search
         self.peer_list = []
         self.peer_list_lock = threading.Lock()
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         self.connections = []
-        self.wallets = [[None],[None]]
+        # connections to peers that understand the binary wire format
+        self.binary_peers = set()
+        # (every registered wallet, wallets of connected traders), kept in
+        # sync with the tracker's registry, and the registry version they
+        # reflect
+        self.wallets = (set(), set())
+        self.wallet_version = 0
+        self.wallet_snapshot_requested = False
+        # held while the chain is being replaced or extended by a peer's blocks
+        self.chain_lock = threading.Lock()
+        # cancel events of the mining jobs currently running
+        self.mining_jobs = set()
+        self.mining_jobs_lock = threading.Lock()
+        # hashes of blocks we relayed and tips we announced to all peers,
+        # so each is only sent out once
+        self.seen_blocks = networking.SeenCache()
+        self.seen_tips = networking.SeenCache()
+        # blocks received before their parent
+        self.orphans = OrphanPool()
+        # (tip hash, query -> answer), answers are only reused until the
+        # chain tip moves
+        self.query_cache = (None, {})
+        # file that blocks and sync messages are logged to, for benchmarks
+        self.event_log = None
+        self.event_log_lock = threading.Lock()
+        self.register_metrics()
+
+    def register_metrics(self):
+        """
+        create the miner's metrics, served with metrics.serve. Counters and
+        histograms are updated where things happen, gauges are read from
+        the miner's state when the metrics are scraped.
+        """
+        self.hashes = metrics.Counter('miner_hashes_total', 'proof-of-work hashes computed')
+        self.blocks_mined = metrics.Counter('miner_blocks_mined_total', 'blocks mined and added to the chain')
+        self.mining_cancelled = metrics.Counter('miner_mining_cancelled_total',
+                                                'mining jobs aborted because the chain tip moved')
+        self.blocks_accepted = metrics.Counter('miner_blocks_accepted_total',
+                                               'blocks received from peers and added to the chain')
+        self.blocks_rejected = metrics.Counter('miner_blocks_rejected_total',
+                                               'blocks received from peers that did not extend the chain')
+        self.chains_rejected = metrics.Counter('miner_chains_rejected_total', 'invalid chains received from peers')
+        self.chain_replacements = metrics.Counter('miner_chain_replacements_total',
+                                                  'forks resolved by replacing the end of the chain')
+        self.fork_depth = metrics.Histogram('miner_fork_depth_blocks', 'blocks removed from the chain by each fork',
+                                            FORK_DEPTH_BUCKETS)
+        self.transactions_received = metrics.Counter('miner_transactions_received_total',
+                                                     'transactions received from traders, by result', 'result')
+        self.verify_seconds = metrics.Histogram('miner_verify_transaction_seconds',
+                                                'time to verify a received transaction')
+        metrics.Gauge('miner_hash_rate', 'hashes per second of the last proof-of-work search',
+                      lambda: self.blockchain.hash_rate if self.blockchain is not None else 0.0)
+        metrics.Gauge('miner_chain_height', 'index of the chain tip',
+                      lambda: self.blockchain.blockchain[-1].index if self.blockchain is not None else -1)
+        metrics.Gauge('miner_peers', 'connected peers', lambda: len(self.connections))
+        metrics.Gauge('miner_mempool_transactions', 'transactions waiting to be mined', lambda: len(self.mempool))
+        metrics.Gauge('miner_orphan_blocks', 'blocks waiting for their parent', lambda: len(self.orphans))
+        metrics.Gauge('miner_outbound_queue_messages', 'messages waiting to be sent to peers',
+                      lambda: sum(conn.queue.qsize() for conn in list(self.connections)))
+        metrics.Gauge('miner_mining_jobs', 'mining jobs running', lambda: len(self.mining_jobs))
         
     def handle_connection(self, conn):
         """
         target function for thread that handles connected peers
         """
+        reader = networking.FramedReader(conn.socket)
         while True:
             sys.stdout.flush()
             # receive from socket connection
-            data, indicator = networking.recv_custom(conn)
+            data, indicator = reader.recv()
             if indicator == 0:
                 # CLOSED CONNECTION ACK
-                if conn in self.connections:
-                    self.connections.remove(conn)
-                conn.close()
+                self.close_connection(conn)
                 break
-            elif indicator == 1:
-                # INCOMING BLOCK
-                block = Block.deserialize(data)
-                if self.blockchain.add_block(block):
-                    # broadcast it to all peers
-                    self.broadcast_block(block)
-                else:
-                    self.request_chain()
-            elif indicator == 2:
-                #INCOMING CHAIN
-                self.handle_chain(data)
-            elif indicator == 3:
-                # INCOMING TRANSACTION
-                valid = miner.blockchain.verify_transaction(data, self.wallets)
-                if 'TRANSACTION FAILED' not in valid:
-                    print('Received transaction')
-                    new_block, added = miner.blockchain.mine(data)
-                    if added:
-                        print("New block mined")
-                    else:
-                        print("Block received from peer")
-                    miner.broadcast_block(new_block)
-                # if the error was a duplicate transaction, don't send a failed notice
-                if 'transaction already on chain' not in valid:
-                    networking.send_custom(conn, valid, 7)
-            elif indicator == 6:
-                # CHAIN REQUEST
-                if self.blockchain is not None:
-                    self.broadcast_chain(self.blockchain.blockchain)
-            else:
-                print("unknown indicator: " + str(indicator))
+            self.handle_message(conn, data, indicator)
             sys.stdout.flush()
             # no data, connection was closed
             if not data:
-                if conn in self.connections:
-                    self.connections.remove(conn)
-                conn.close()
+                self.close_connection(conn)
                 break
 
+    def handle_message(self, conn, data, indicator):
+        """
+        handle one message received from a peer or trader
+
+        arguments:
+        conn -- connection the message was received on
+        data -- data received
+        indicator -- type of data
+        """
+        if indicator in (2, 12, 14, 15):
+            self.log_event('sync', indicator=indicator, bytes=len(data))
+        if indicator == 1:
+            # INCOMING BLOCK
+            self.handle_block(conn, Block.deserialize(data))
+        elif indicator == 2:
+            #INCOMING CHAIN
+            self.handle_chain(data)
+        elif indicator == 3:
+            # INCOMING TRANSACTION
+            if self.blockchain is not None:
+                self.receive_transaction(conn, data)
+        elif indicator == 6:
+            # CHAIN REQUEST
+            if self.blockchain is not None:
+                self.broadcast_chain(self.blockchain.blockchain, conn)
+        elif indicator == 10:
+            # TIP ANNOUNCEMENT
+            self.handle_tip(conn, data)
+        elif indicator == 11:
+            # BLOCKS REQUEST
+            if self.blockchain is not None:
+                self.send_blocks(conn, data)
+        elif indicator == 12:
+            # INCOMING BLOCKS
+            self.handle_blocks(conn, data)
+        elif indicator == 13:
+            # INCOMING BLOCK (BINARY)
+            self.handle_block(conn, Block.from_bytes(data)[0])
+        elif indicator == 14:
+            # INCOMING CHAIN (BINARY)
+            positions = []
+            blocks = blocks_from_bytes(data, 0, positions)
+            self.receive_blocks(0, blocks, (data, positions))
+        elif indicator == 15:
+            # INCOMING BLOCKS (BINARY)
+            start, = struct.unpack_from('>Q', data)
+            positions = []
+            blocks = blocks_from_bytes(data, 8, positions)
+            self.receive_blocks(start, blocks, (data, positions))
+        elif indicator == 16:
+            # PEER SUPPORTS BINARY WIRE FORMAT
+            self.handle_hello(conn)
+        elif indicator == 17:
+            # WALLET QUERY
+            networking.send_custom(conn, self.answer_query(data), 18)
+        else:
+            print("unknown indicator: " + str(indicator))
+
+    def close_connection(self, conn):
+        """
+        forget a closed connection and close its socket
+
+        arguments:
+        conn -- the closed connection
+        """
+        if conn in self.connections:
+            self.connections.remove(conn)
+        self.binary_peers.discard(conn)
+        conn.close()
+
+    def handle_block(self, conn, block):
+        """
+        add a block received from a peer to the chain if it extends our tip.
+        A block that arrived ahead of its parent is held until the parent
+        comes, otherwise we fetch the blocks we are missing from that peer
+
+        arguments:
+        conn -- connection the block was received on
+        block -- the received block
+        """
+        if self.blockchain is None:
+            return
+        # only marked seen once valid, so an invalid block carrying the hash
+        # of a valid one can't get the valid one dropped
+        if not self.seen_blocks.check(block.hash):
+            # already received (and relayed) this block from another peer
+            return
+        if self.blockchain.add_block(block):
+            self.seen_blocks.add(block.hash)
+            self.blocks_accepted.inc()
+            self.log_event('accepted', hash=block.hash, height=block.index)
+            # chain tip moved, stop mining on the old one
+            self.cancel_mining()
+            # broadcast it to all peers
+            self.broadcast_block(block)
+            self.attach_orphans()
+            self.update_mempool()
+        elif block.index > self.blockchain.blockchain[-1].index + 1 and block.is_valid_block():
+            # the blocks in between are probably still on their way, only
+            # fetch them if they don't show up in time
+            self.seen_blocks.add(block.hash)
+            if self.orphans.add(block):
+                timer = threading.Timer(ORPHAN_TIMEOUT, self.check_orphan, args=(conn, block.hash, block.index))
+                timer.daemon = True
+                timer.start()
+        elif block.index < len(self.blockchain.blockchain) and self.blockchain.block_hash(block.index) == block.hash:
+            # another connection's thread added it between the check and now
+            return
+        else:
+            # we are missing blocks, fetch only those from this peer
+            self.blocks_rejected.inc()
+            self.request_blocks(conn)
+
+    def attach_orphans(self):
+        """
+        add the orphan blocks that extend our new tip, one after another,
+        and relay them
+        """
+        while True:
+            tip = self.blockchain.blockchain[-1]
+            children = self.orphans.pop_children(tip.hash)
+            if not children:
+                return
+            # if siblings are waiting for the same parent, the first valid
+            # one wins and the others are dropped
+            added = None
+            for child in children:
+                if self.blockchain.add_block(child):
+                    added = child
+                    break
+            if added is None:
+                return
+            self.blocks_accepted.inc()
+            self.log_event('accepted', hash=added.hash, height=added.index)
+            self.broadcast_block(added)
+
+    def check_orphan(self, conn, block_hash, height):
+        """
+        called ORPHAN_TIMEOUT seconds after an orphan arrived, fetch the
+        missing blocks from the peer that sent it if its parent never came
+
+        arguments:
+        conn -- connection the orphan was received on
+        block_hash -- hash of the orphan
+        height -- height of the orphan
+        """
+        # no longer held if it was attached, or evicted by newer orphans,
+        # only the chain tells the two apart
+        self.orphans.remove(block_hash)
+        if height > self.blockchain.blockchain[-1].index:
+            self.request_blocks(conn)
+
+    def handle_hello(self, conn):
+        """
+        mark a peer as understanding the binary wire format, and answer
+        in kind the first time so it knows we do too
+
+        arguments:
+        conn -- connection the hello was received on
+        """
+        if conn not in self.binary_peers:
+            self.binary_peers.add(conn)
+            networking.send_custom(conn, '1', 16)
+
+    def receive_transaction(self, conn, data):
+        """
+        verify an incoming transaction and add it to the mempool. The
+        trader is answered once the transaction is on chain, or right away
+        if it is invalid.
+
+        arguments:
+        conn -- connection the transaction was received on
+        data -- serialized transaction
+        """
+        start = time.perf_counter()
+        valid = self.blockchain.verify_transaction(data, self.wallets, self.mempool)
+        self.verify_seconds.observe(time.perf_counter() - start)
+        if 'TRANSACTION FAILED' not in valid:
+            print('Received transaction')
+            self.transactions_received.inc(1, 'accepted')
+            self.mempool.add(data, conn, valid)
+        # if the error was a duplicate transaction, don't send a failed notice
+        elif 'transaction already' not in valid:
+            self.transactions_received.inc(1, 'rejected')
+            self.send_response(conn, Transaction.deserialize(data).trans_id, valid)
+        else:
+            self.transactions_received.inc(1, 'duplicate')
+
+    def send_response(self, conn, trans_id, message):
+        """
+        answer a trader about one of its transactions. The answer carries
+        the transaction ID, so a trader with many transactions in flight on
+        one connection can match it up.
+
+        arguments:
+        conn -- connection of the trader
+        trans_id -- ID of the transaction
+        message -- the answer
+        """
+        networking.send_custom(conn, json.dumps({'id': trans_id, 'message': message}), 7)
+
+    def answer_query(self, data):
+        """
+        answer a read-only query about a wallet or transaction. Answers
+        come from the ledger, transaction ID index and wallet history, and
+        are cached until the chain tip moves.
+
+        arguments:
+        data -- JSON query, one of
+                {"type": "balance", "wallet": ..., "height": ... (optional)}
+                {"type": "history", "wallet": ..., "page": ..., "page_size": ...}
+                {"type": "status", "id": ...}
+
+        returns:
+        JSON answer, {"error": ...} if the query is invalid
+        """
+        blockchain = self.blockchain
+        if blockchain is None:
+            return json.dumps({'error': 'no blockchain yet'})
+        tip = blockchain.blockchain[-1]
+        tip_hash, cache = self.query_cache
+        if tip_hash != tip.hash:
+            cache = {}
+            self.query_cache = (tip.hash, cache)
+        answer = cache.get(data)
+        if answer is not None:
+            return answer
+
+        cacheable = True
+        try:
+            query = json.loads(data)
+            if query['type'] == 'balance':
+                wallet = query['wallet']
+                height = query.get('height')
+                if height is None:
+                    result = {'wallet': wallet, 'balance': blockchain.get_balance(wallet), 'height': tip.index}
+                else:
+                    height = min(int(height), tip.index)
+                    if height < 0:
+                        raise ValueError('invalid height')
+                    result = {'wallet': wallet, 'balance': blockchain.get_balance_at(wallet, height),
+                              'height': height}
+            elif query['type'] == 'history':
+                wallet = query['wallet']
+                page = int(query.get('page', 0))
+                page_size = min(int(query.get('page_size', 10)), MAX_PAGE_SIZE)
+                if page < 0 or page_size < 1:
+                    raise ValueError('invalid page')
+                transactions, more = blockchain.get_history(wallet, page * page_size, page_size)
+                result = {'wallet': wallet, 'page': page, 'page_size': page_size, 'height': tip.index,
+                          'transactions': [{'height': height, 'id': t.trans_id, 'sender': t.sender,
+                                            'recipient': t.recipient, 'amount': t.amount,
+                                            'timestamp': t.timestamp}
+                                           for height, t in transactions],
+                          'more': more}
+            elif query['type'] == 'status':
+                trans_id = query['id']
+                height = blockchain.get_transaction_height(trans_id)
+                if height is not None:
+                    result = {'id': trans_id, 'status': 'confirmed', 'height': height,
+                              'confirmations': tip.index - height + 1}
+                else:
+                    # pending transactions can be mined without the tip
+                    # we cached for moving yet
+                    cacheable = False
+                    status = 'pending' if self.mempool.contains(trans_id) else 'unknown'
+                    result = {'id': trans_id, 'status': status}
+            else:
+                return json.dumps({'error': f"unknown query type: {query['type']}"})
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            return json.dumps({'error': f'invalid query: {e}'})
+
+        answer = json.dumps(result)
+        if cacheable and len(cache) < QUERY_CACHE_SIZE:
+            cache[data] = answer
+        return answer
+
+    def open_event_log(self, path):
+        """
+        start logging mined and accepted blocks, and received sync
+        messages, to a file of JSON lines with timestamps. The cluster
+        benchmark reads it to measure block propagation and sync traffic.
+
+        arguments:
+        path -- file to append the events to
+        """
+        self.event_log = open(path, 'a')
+
+    def log_event(self, event, **fields):
+        """
+        append an event to the event log, if there is one
+
+        arguments:
+        event -- kind of event
+        fields -- details of the event
+        """
+        if self.event_log is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields) + '\n'
+        self.event_log_lock.acquire()
+        self.event_log.write(line)
+        self.event_log.flush()
+        self.event_log_lock.release()
+
+    def mining_loop(self):
+        """
+        target function for thread that mines batches of transactions from
+        the mempool. Each batch is mined as a cancellable job: if the chain
+        tip moves while mining, the search is aborted, transactions a peer
+        already put on chain are dropped from the mempool, and the rest are
+        mined again on the new tip.
+        """
+        while True:
+            batch = self.mempool.wait_for_batch(self.block_size, self.batch_interval)
+            blockchain = self.blockchain
+            if blockchain is None:
+                time.sleep(self.batch_interval)
+                continue
+            transactions, rejected = blockchain.select_transactions(batch)
+            for data, error in rejected:
+                trans_id = Transaction.deserialize(data).trans_id
+                self.finish_transaction(trans_id, None if 'transaction already' in error else error)
+            if not transactions:
+                continue
+            job = threading.Event()
+            self.mining_jobs_lock.acquire()
+            self.mining_jobs.add(job)
+            self.mining_jobs_lock.release()
+            new_block, added = blockchain.mine(transactions, self.search, job.is_set)
+            self.mining_jobs_lock.acquire()
+            self.mining_jobs.discard(job)
+            self.mining_jobs_lock.release()
+            self.hashes.inc(blockchain.attempts)
+            if new_block is None:
+                self.mining_cancelled.inc()
+                print("Mining cancelled, chain tip moved")
+            elif added:
+                self.blocks_mined.inc()
+                print(f"New block mined with {len(transactions)} transactions ({blockchain.hash_rate:.0f} hashes/sec)")
+                self.log_event('mined', hash=new_block.hash, height=new_block.index, transactions=len(transactions))
+                self.update_mempool()
+                self.seen_blocks.add(new_block.hash)
+                self.broadcast_block(new_block)
+            sys.stdout.flush()
+
+    def update_mempool(self):
+        """
+        remove transactions that are now on chain from the mempool and
+        answer the traders waiting on them
+        """
+        blockchain = self.blockchain
+        for trans_id in self.mempool.ids():
+            if blockchain.transaction_exists(trans_id):
+                self.finish_transaction(trans_id)
+
+    def finish_transaction(self, trans_id, error=None):
+        """
+        remove a transaction from the mempool and answer the trader
+
+        arguments:
+        trans_id -- ID of the transaction
+        error -- message to send instead of the stored response, None to
+                 send the stored response
+        """
+        entry = self.mempool.remove(trans_id)
+        if entry is None:
+            return
+        conn, response = entry
+        try:
+            self.send_response(conn, trans_id, error if error is not None else response)
+        except OSError:
+            # trader already disconnected
+            pass
+
+    def cancel_mining(self):
+        """
+        abort every mining job in progress, called whenever the chain tip moves
+        """
+        self.mining_jobs_lock.acquire()
+        for job in self.mining_jobs:
+            job.set()
+        self.mining_jobs_lock.release()
 
     def connect_to_peers(self):
         """
@@ -95,11 +627,11 @@ class Miner:
                 # connect to peer
                 peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 peer_socket.connect(peer)
-                self.connections.append(peer_socket)
-                threading.Thread(target=self.handle_connection, args=(peer_socket,)).start()
+                conn = networking.PeerWriter(peer_socket)
+                self.connections.append(conn)
+                threading.Thread(target=self.handle_connection, args=(conn,)).start()
                 print('Connected to peer')
-                # immediately request peer's chain
-                self.request_chain()
+                self.greet_peer(conn)
                 sys.stdout.flush()
             except:
                 print(f'Error connecting to peer: {peer}')
@@ -107,6 +639,22 @@ class Miner:
 
         self.peer_list_lock.release()
 
+    def greet_peer(self, conn):
+        """
+        first messages sent to a peer we connected to
+
+        arguments:
+        conn -- connection to the peer
+        """
+        # offer the binary wire format, JSON is used until the peer answers
+        networking.send_custom(conn, '1', 16)
+        # immediately tell the peer where our chain is, or ask for
+        # its chain if we don't have one
+        if self.blockchain is None:
+            self.request_blocks(conn)
+        else:
+            self.announce_tip(conn)
+
     def listen_for_peers(self, client_port):
         """
         target function for thread that listens for peers requesting a
@@ -121,27 +669,51 @@ class Miner:
 
         while True:
             peer_socket, peer_addr = self.socket.accept()
-            # start thread for each connected peer
-            threading.Thread(target=self.handle_connection, args=(peer_socket,)).start()
+            # start thread for each connected peer, sends go through its
+            # own writer thread
+            conn = networking.PeerWriter(peer_socket)
+            threading.Thread(target=self.handle_connection, args=(conn,)).start()
     
-    def update_wallets(self, wallet_addreses):
+    def load_wallets(self, data):
         """
-        uses wallet list sent from tracker to update wallets
+        replace the wallet registry with a snapshot sent by the tracker
 
         args:
-        list of wallets
+        JSON snapshot: version, all wallets and active wallets
         """
-        all_wallets, cur_wallets = wallet_addreses.split(';')
+        snapshot = json.loads(data)
+        if snapshot['version'] < self.wallet_version:
+            return
+        self.wallets = (set(snapshot['wallets']), set(snapshot['active']))
+        self.wallet_version = snapshot['version']
+        self.wallet_snapshot_requested = False
 
-        self.wallets[1] = []
-        for wallet in cur_wallets.split(','):
-            if wallet != '':
-                self.wallets[1].append(wallet)
+    def update_wallets(self, data):
+        """
+        apply a versioned update of the wallet registry sent by the
+        tracker, asking for a snapshot if an earlier update was missed
 
-        self.wallets[0] = []
-        for wallet in all_wallets.split(','):
-            if wallet != '':
-                self.wallets[0].append(wallet)
+        args:
+        JSON update: version and list of [change, wallet]
+        """
+        update = json.loads(data)
+        if update['version'] <= self.wallet_version:
+            # already part of the snapshot we loaded
+            return
+        if update['version'] != self.wallet_version + 1:
+            if not self.wallet_snapshot_requested:
+                self.wallet_snapshot_requested = True
+                networking.send_custom(self.tracker_socket, str(self.wallet_version), 21)
+            return
+        known, active = self.wallets
+        for change, wallet in update['changes']:
+            if change == 'add':
+                known.add(wallet)
+            elif change == 'active':
+                active.add(wallet)
+            else:
+                active.discard(wallet)
+        self.wallet_version = update['version']
     
     def handle_tracker(self, tracker_ip, tracker_port, client_port):
         """
@@ -158,14 +730,23 @@ class Miner:
         # send port number
         networking.send_custom(self.tracker_socket, str(client_port), 5)
 
+        reader = networking.FramedReader(self.tracker_socket)
         while True:
             # receive from tracker
-            payload, indicator = networking.recv_custom(self.tracker_socket)
+            payload, indicator = reader.recv()
 
-            if indicator == 9:
-                # TRACKER SENT WALLET ADDRESSES
-                # print('INCOMING WALLET ADDRESSES')
+            if indicator == 0:
+                # TRACKER CLOSED CONNECTION
+                print("Lost connection to tracker")
                 sys.stdout.flush()
+                break
+
+            elif indicator == 19:
+                # TRACKER SENT WALLET REGISTRY SNAPSHOT
+                self.load_wallets(payload)
+
+            elif indicator == 20:
+                # TRACKER SENT WALLET REGISTRY UPDATE
                 self.update_wallets(payload)
 
             elif indicator == 4:
@@ -176,7 +757,7 @@ class Miner:
                 # we only need to if the peer list only contains
                 # ourself and the blockchain hasn't been created
                 if len(peer_list) == 1 and self.blockchain is None:
-                    self.blockchain = Blockchain()
+                    self.blockchain = Blockchain(store=self.store)
                     print("No peers. Blockchain created.")
 
                 # reset peer_list
@@ -207,59 +788,309 @@ class Miner:
         data -- data received over socket
         """
 
-        new_chain = Blockchain([Block.deserialize(block) for block in json.loads(data)])
+        self.receive_blocks(0, [Block.deserialize(block) for block in json.loads(data)])
+
+    def receive_blocks(self, start, blocks, received=None):
+        """
+        check if blocks received from a peer should overwrite current chain
+
+        arguments:
+        start -- height of the first of the peer's blocks
+        blocks -- the peer's blocks from start to its tip
+        received -- (data, positions) of the blocks as received in the
+                    binary wire format, long chains are validated from it
+        """
+        if not blocks:
+            return
+        self.chain_lock.acquire()
+        self.adopt_chain(start, blocks, received)
+        self.chain_lock.release()
+        sys.stdout.flush()
+
+    def adopt_chain(self, start, blocks, received=None):
+        """
+        Check if a peer's chain should overwrite current chain, and
+        announce the resulting tip to all peers. Only the part of the peer's
+        chain after the last block it shares with ours is validated and
+        spliced in.
 
+        arguments:
+        start -- height of the first of the peer's blocks
+        blocks -- the peer's blocks from start to its tip
+        received -- (data, positions) of the blocks as received in the
+                    binary wire format, None if they came as JSON
+        """
         # if the chain is none, it is the first chain received from a peer
         if self.blockchain is None:
+            new_chain = Blockchain(blocks)
+            if start != 0 or not new_chain.is_valid_chain(self.validation_pool, received):
+                self.chains_rejected.inc()
+                return
             print("Initial chain received from peer")
+            self.blocks_accepted.inc(len(blocks))
+            if self.store is not None:
+                new_chain.persist(self.store)
             self.blockchain = new_chain
-            self.broadcast_chain(new_chain.blockchain)
+            self.cancel_mining()
+            self.update_mempool()
+            self.announce_tip()
+            return
 
-        # if new chain is longer, overwrite it
-        elif len(new_chain.blockchain) > len(self.blockchain.blockchain) and new_chain.is_valid_chain():
-            print("Chain overwritten")
-            self.blockchain = new_chain
-            self.broadcast_chain(new_chain.blockchain)
+        length = len(self.blockchain.blockchain)
+        tip = self.blockchain.blockchain[-1]
+        new_length = start + len(blocks)
+        new_tip = blocks[-1]
 
-        # if blockchain and new_chain are same lengths, take one with lower hash
-        elif (self.blockchain.blockchain[-1].hash != new_chain.blockchain[-1].hash and
-              len(new_chain.blockchain) == len(self.blockchain.blockchain) and new_chain.is_valid_chain()):
-            if self.blockchain.blockchain[-1].hash < new_chain.blockchain[-1].hash:
-                self.broadcast_chain(self.blockchain.blockchain)
+        # if new chain is longer, overwrite it
+        # if blockchain and new chain are same lengths, take one with lower hash
+        if new_length > length or (new_length == length and new_tip.hash < tip.hash):
+            removed = self.blockchain.replace_suffix(start, blocks, self.validation_pool, received)
+            if removed is None:
+                self.chains_rejected.inc()
+                return
+            if removed:
+                print(f"Chain overwritten, fork depth {removed}")
+                self.chain_replacements.inc()
+                self.fork_depth.observe(removed)
             else:
-                self.blockchain = new_chain
-                self.broadcast_chain(new_chain.blockchain)
-                print("Chain overwritten")
-        sys.stdout.flush()
+                print(f"{new_length - length} blocks received from peer")
+            # blocks the peer sent that we already had aren't counted
+            self.blocks_accepted.inc(new_length - length + removed)
+            for block in blocks:
+                self.log_event('accepted', hash=block.hash, height=block.index)
+            self.attach_orphans()
+            self.cancel_mining()
+            self.update_mempool()
+            self.announce_tip()
+        elif new_length == length and new_tip.hash != tip.hash:
+            self.announce_tip()
+
+    def handle_tip(self, conn, data):
+        """
+        Compare a peer's tip announcement with our chain, and request the
+        blocks we are missing if the peer's chain wins
+
+        arguments:
+        conn -- connection the announcement was received on
+        data -- "height,hash" of the peer's tip
+        """
+        height, hash = data.split(',')
+        height = int(height)
+        if self.blockchain is None:
+            self.request_blocks(conn)
+            return
+        tip = self.blockchain.blockchain[-1]
+        if hash == tip.hash:
+            return
+        if height > tip.index or (height == tip.index and hash < tip.hash):
+            self.request_blocks(conn)
+        else:
+            # the peer is behind, let it know where we are
+            self.announce_tip(conn)
+
+    def send_blocks(self, conn, data):
+        """
+        Answer a blocks request with every block after the last one the
+        peer has in common with us
+
+        arguments:
+        conn -- connection the request was received on
+        data -- block locator from the peer, JSON encoded
+        """
+        chain = self.blockchain.blockchain
+        start = self.blockchain.find_start(json.loads(data))
+        if conn in self.binary_peers:
+            # read straight from the store's files when the chain is on disk
+            blocks = self.blockchain.encode_blocks(start, len(chain))
+            networking.send_custom(conn, struct.pack('>Q', start) + blocks, 15)
+        else:
+            blocks = [block.serialize() for block in chain[start:]]
+            networking.send_custom(conn, json.dumps({'start': start, 'blocks': blocks}), 12)
+
+    def handle_blocks(self, conn, data):
+        """
+        Deserialize the blocks a peer sent in answer to a blocks request and
+        check if they should overwrite the end of current chain
+
+        arguments:
+        conn -- connection the blocks were received on
+        data -- data received over socket
+        """
+        message = json.loads(data)
+        self.receive_blocks(message['start'], [Block.deserialize(block) for block in message['blocks']])
 
     def broadcast_block(self, block):
         """
-        broadcasts block to all peers
+        broadcasts block to all peers, serializing it once per wire format
 
         arguments:
         block -- chain to broadcast
         """
-        for conn in self.connections:
-            networking.send_custom(conn, block.serialize(), 1)
+        binary, json_peers = self.split_peers()
+        if binary:
+            networking.broadcast(binary, block.to_bytes(), 13)
+        if json_peers:
+            networking.broadcast(json_peers, block.serialize(), 1)
 
-    def broadcast_chain(self, chain):
+    def broadcast_chain(self, chain, conn=None):
         """
-        broadcasts chain to all peers
+        broadcasts chain to all peers, serializing it once per wire format
 
         arguments:
         chain -- chain to broadcast
+        conn -- peer to send it to, all peers if None
+        """
+        binary, json_peers = self.split_peers([conn] if conn is not None else None)
+        if binary:
+            networking.broadcast(binary, blocks_to_bytes(chain), 14)
+        if json_peers:
+            networking.broadcast(json_peers, json.dumps([block.serialize() for block in chain]), 2)
+
+    def split_peers(self, connections=None):
         """
-        serialized_chain = json.dumps([block.serialize() for block in chain])
-        for conn in self.connections:
-            networking.send_custom(conn, serialized_chain, 2)
+        split peers by the wire format they understand
+
+        arguments:
+        connections -- peers to split, all connected peers if None
 
+        returns:
+        (binary peers, JSON peers)
+        """
+        binary = []
+        json_peers = []
+        for conn in (connections if connections is not None else list(self.connections)):
+            if conn in self.binary_peers:
+                binary.append(conn)
+            else:
+                json_peers.append(conn)
+        return binary, json_peers
 
     def request_chain(self):
         """
         Request all peers' blockchains
         """
-        for conn in self.connections:
-            networking.send_custom(conn, "request", 6)
+        networking.broadcast(list(self.connections), "request", 6)
+
+    def announce_tip(self, conn=None):
+        """
+        Tell peers the height and hash of our chain tip, a tip is only
+        announced to all peers once
+
+        arguments:
+        conn -- peer to tell, all peers if None
+        """
+        tip = self.blockchain.blockchain[-1]
+        if conn is None and not self.seen_tips.add(tip.hash):
+            return
+        announcement = f'{tip.index},{tip.hash}'
+        networking.broadcast([conn] if conn is not None else list(self.connections), announcement, 10)
+
+    def request_blocks(self, conn):
+        """
+        Ask a peer for the blocks we are missing, sending a block locator
+        so it can find where our chains split
+
+        arguments:
+        conn -- peer to ask
+        """
+        locator = self.blockchain.get_locator() if self.blockchain is not None else []
+        networking.send_custom(conn, json.dumps(locator), 11)
+
+class AsyncMiner(Miner):
+    def __init__(self, client_port, workers=1, block_size=16, batch_interval=0.5, data_dir=None,
+                 validation_workers=1, verify_store=False, handler_threads=4):
+        """
+        Constructor for AsyncMiner class
+
+        Miner node that runs every peer connection on one asyncio event loop
+        instead of a thread per connection. Each peer gets an outbound queue
+        with a bounded size so a slow peer can't stall the others, and
+        messages are handled in a small thread pool so validation doesn't
+        block the loop. Mining runs in its own executor.
+
+        arguments:
+        client_port -- port to listen for peers on
+        workers -- number of processes to mine with
+        block_size -- maximum number of transactions in a block
+        batch_interval -- seconds to wait for a block to fill up before mining it
+        data_dir -- directory to keep the blockchain in, None to keep it in memory only
+        validation_workers -- number of processes to validate long chains with
+        verify_store -- validate the chain loaded from data_dir
+        handler_threads -- number of threads handling received messages
+        """
+        super().__init__(client_port, workers, block_size, batch_interval, data_dir, validation_workers, verify_store)
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(handler_threads)
+        self.mining_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def handle_peer(self, reader, writer, outgoing=False):
+        """
+        coroutine that handles one connected peer or trader
+
+        arguments:
+        reader -- asyncio.StreamReader of the connection
+        writer -- asyncio.StreamWriter of the connection
+        outgoing -- True if we connected to the peer
+        """
+        peer = networking.AsyncPeer(self.loop, writer)
+        write_task = self.loop.create_task(peer.write_loop())
+        try:
+            if outgoing:
+                self.connections.append(peer)
+                print('Connected to peer')
+                self.greet_peer(peer)
+            while True:
+                data, indicator = await networking.recv_custom_async(reader)
+                if indicator == 0:
+                    # CLOSED CONNECTION ACK
+                    break
+                await self.loop.run_in_executor(self.executor, self.handle_message, peer, data, indicator)
+                sys.stdout.flush()
+                # no data, connection was closed
+                if not data:
+                    break
+        finally:
+            self.close_connection(peer)
+            await write_task
+
+    def connect_to_peers(self):
+        """
+        use the peer list sent from the tracker to connect to each peer,
+        called from the tracker thread
+        """
+        asyncio.run_coroutine_threadsafe(self.connect_to_peers_async(), self.loop)
+
+    async def connect_to_peers_async(self):
+        """
+        coroutine that opens a connection to each peer we aren't connected to
+        """
+        self.peer_list_lock.acquire()
+        peer_list = list(self.peer_list)
+        self.peer_list_lock.release()
+        for peer in peer_list:
+            if any(conn.getpeername() == peer for conn in self.connections):
+                continue
+            try:
+                reader, writer = await asyncio.open_connection(peer[0], peer[1])
+            except OSError:
+                print(f'Error connecting to peer: {peer}')
+                continue
+            self.loop.create_task(self.handle_peer(reader, writer, outgoing=True))
+        sys.stdout.flush()
+
+    def listen_for_peers(self, client_port):
+        """
+        target function for thread that runs the event loop: accepts peers,
+        handles every connection, and starts mining in its executor
+
+        arguments:
+        client_port -- port to bind
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_server(self.handle_peer, '', client_port, backlog=1024))
+        self.loop.run_in_executor(self.mining_executor, self.mining_loop)
+        self.loop.run_forever()
+
 
 if __name__ == "__main__":
     # accepts commandline arguments
@@ -267,10 +1098,28 @@ if __name__ == "__main__":
     parser.add_argument('tracker_ip', type=str)
     parser.add_argument('tracker_port', type=int)
     parser.add_argument('client_port', type=int)
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to mine with')
+    parser.add_argument('--block-size', type=int, default=16, help='maximum number of transactions in a block')
+    parser.add_argument('--batch-interval', type=float, default=0.5, help='seconds to wait for a block to fill up before mining it')
+    parser.add_argument('--data-dir', help='directory to keep the blockchain in across restarts')
+    parser.add_argument('--validation-workers', type=int, default=1, help='number of processes to validate long chains with')
+    parser.add_argument('--verify-store', action='store_true', help='validate the chain loaded from --data-dir at startup')
+    parser.add_argument('--asyncio', action='store_true', help='handle all peers on one asyncio event loop')
+    parser.add_argument('--event-log', help='file to log mined and accepted blocks and sync traffic to, for benchmarks')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics in the Prometheus text format on this localhost port')
     args = parser.parse_args()
 
     # initialize Miner class
-    miner = Miner(args.client_port)
+    if args.asyncio:
+        miner = AsyncMiner(args.client_port, args.workers, args.block_size, args.batch_interval, args.data_dir,
+                           args.validation_workers, args.verify_store)
+    else:
+        miner = Miner(args.client_port, args.workers, args.block_size, args.batch_interval, args.data_dir,
+                      args.validation_workers, args.verify_store)
+    if args.event_log is not None:
+        miner.open_event_log(args.event_log)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
 
     #start thread to communicate with tracker
     tracker_thread = threading.Thread(target=miner.handle_tracker, args=(args.tracker_ip, args.tracker_port, args.client_port))
@@ -280,7 +1129,14 @@ if __name__ == "__main__":
     peer_thread = threading.Thread(target=miner.listen_for_peers, args=(args.client_port,))
     peer_thread.start()
 
+    #start thread to mine transactions from the mempool
+    #(the asyncio node mines in an executor of its event loop)
+    if not args.asyncio:
+        mining_thread = threading.Thread(target=miner.mining_loop)
+        mining_thread.start()
+
     time.sleep(1)
     while True:
         input("\nPress Enter to Print Blockchain\n")
-        miner.blockchain.print_chain()
\ No newline at end of file
+        miner.blockchain.print_chain()
+        print(f'Duplicates suppressed: {miner.seen_blocks.suppressed} blocks, {miner.seen_tips.suppressed} tip announcements')
\ No newline at end of file
@@ -0,0 +1,92 @@
+import hashlib
+import json
+
+MAX_NONCE = 2**32  # size of the nonce space a search is started in
+CHECK_INTERVAL = 4096  # nonces tried between checks for cancellation
+
+
+def split_header(header):
+    """
+    Serialize the fixed part of a block header once, split around the nonce.
+
+    The pieces are laid out exactly like json.dumps(..., sort_keys=True) in
+    Block.calculate_hash, so prefix + str(nonce) + suffix hashes to the same
+    value that Block.is_valid_block computes.
+
+    arguments:
+    header -- dict of the hashed block fields, without the nonce
+
+    returns:
+    (prefix, suffix) bytes that go before and after the nonce
+    """
+    fields = [f'{json.dumps(key)}: {json.dumps(header[key])}' for key in sorted(header)]
+    # number of fields that sort ahead of the nonce
+    split = sum(1 for key in header if key < 'nonce')
+    prefix = '{' + ''.join(field + ', ' for field in fields[:split]) + '"nonce": '
+    suffix = ''.join(', ' + field for field in fields[split:]) + '}'
+    return prefix.encode(), suffix.encode()
+
+
+def search(header, difficulty, start=0, stop=None, cancel=None):
+    """
+    Search sequential nonces for a hash with enough leading zeroes
+
+    The hash of the serialized prefix is computed once and copied for every
+    nonce, and the target is checked on the raw digest instead of the hex
+    string.
+
+    arguments:
+    header -- dict of the hashed block fields, without the nonce
+    difficulty -- number of leading zero hex digits required
+    start -- first nonce to try
+    stop -- nonce to stop before, None to search until found
+    cancel -- optional function, the search gives up once it returns True
+
+    returns:
+    (nonce, hash, attempts), nonce and hash are None if no nonce was found
+    """
+    prefix, suffix = split_header(header)
+    midstate = hashlib.sha256(prefix)
+    full_bytes, half_byte = divmod(difficulty, 2)
+    zeroes = bytes(full_bytes)
+
+    nonce = start
+    while stop is None or nonce < stop:
+        h = midstate.copy()
+        h.update(b'%d' % nonce + suffix)
+        digest = h.digest()
+        if digest[:full_bytes] == zeroes and (not half_byte or digest[full_bytes] < 16):
+            return nonce, digest.hex(), nonce - start + 1
+        nonce += 1
+        if cancel is not None and (nonce - start) % CHECK_INTERVAL == 0 and cancel():
+            break
+    return None, None, nonce - start
+
+
+# set in each worker process of a parallel search pool
+found = None
+
+
+def init_worker(found_event):
+    """
+    Initializer for the worker processes of a parallel search pool
+
+    arguments:
+    found_event -- multiprocessing.Event set once any worker finds a nonce
+    """
+    global found
+    found = found_event
+
+
+def search_range(header, difficulty, start, stop):
+    """
+    Search one nonce range inside a pool worker, giving up as soon as
+    another worker has found a nonce
+
+    arguments:
+    header -- dict of the hashed block fields, without the nonce
+    difficulty -- number of leading zero hex digits required
+    start -- first nonce of the range
+    stop -- nonce to stop before
+    """
+    return search(header, difficulty, start, stop, cancel=found.is_set)
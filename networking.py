@@ -1,43 +1,444 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import OrderedDict
+from socket import SHUT_RDWR
+import metrics
+
+# indicators whose payload is binary, recv_custom returns them as bytes
+BINARY_INDICATORS = {13, 14, 15}
+MAX_FRAME_SIZE = 256 * 1024 * 1024  # largest payload a FramedReader accepts
+INITIAL_BUFFER_SIZE = 4096  # starting size of a FramedReader's payload buffer
+MAX_KEPT_BUFFER_SIZE = 1024 * 1024  # larger buffers are dropped after one message instead of kept per connection
+OUTBOUND_QUEUE_SIZE = 256  # messages a peer can have waiting to be sent
+SEND_TIMEOUT = 10.0  # seconds a PeerWriter waits on a stalled send before dropping the peer
+SEEN_CACHE_SIZE = 4096  # hashes a SeenCache remembers
+SEEN_CACHE_TTL = 600.0  # seconds a SeenCache remembers a hash for
+
+# traffic of this process, headers included
+BYTES_SENT = metrics.Counter('network_sent_bytes_total', 'bytes sent, by message indicator', 'indicator')
+BYTES_RECEIVED = metrics.Counter('network_received_bytes_total', 'bytes received, by message indicator', 'indicator')
+MESSAGES_SENT = metrics.Counter('network_sent_messages_total', 'messages sent, by message indicator', 'indicator')
+MESSAGES_RECEIVED = metrics.Counter('network_received_messages_total', 'messages received, by message indicator',
+                                    'indicator')
+
+
+def count_traffic(sent, indicator, size, messages=1):
+    """
+    add messages to the traffic metrics
+
+    arguments:
+    sent -- True for sent messages, False for received ones
+    indicator -- type of the messages
+    size -- bytes of each message, header included
+    messages -- number of messages
+    """
+    if sent:
+        BYTES_SENT.inc(size * messages, indicator)
+        MESSAGES_SENT.inc(messages, indicator)
+    else:
+        BYTES_RECEIVED.inc(size * messages, indicator)
+        MESSAGES_RECEIVED.inc(messages, indicator)
+
+
+class FramedReader:
+    def __init__(self, socket, max_frame_size=MAX_FRAME_SIZE, retry_timeouts=True):
+        """
+        Constructor for FramedReader class
+
+        Reads messages with the custom 5-byte header from one socket. The
+        header and payload are received straight into preallocated buffers
+        with recv_into, so large messages are read without building them up
+        chunk by chunk. A buffer grown past MAX_KEPT_BUFFER_SIZE for a large
+        message (e.g. a whole chain) is dropped on the next call, so it
+        isn't held for the life of the connection.
+
+        arguments:
+        socket -- the connected socket
+        max_frame_size -- largest payload accepted, larger messages close the connection
+        retry_timeouts -- keep waiting when the socket times out, False treats
+                          a timeout like a closed connection
+        """
+        self.socket = socket
+        self.max_frame_size = max_frame_size
+        self.retry_timeouts = retry_timeouts
+        self.header = bytearray(5)
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+    def recv_exact(self, view):
+        """
+        fill a memoryview from the socket
+
+        arguments:
+        view -- memoryview to fill
+
+        returns:
+        False if the connection was closed before the view was filled
+        """
+        while len(view):
+            try:
+                received = self.socket.recv_into(view)
+            except TimeoutError:
+                # the socket has a send timeout set by a PeerWriter, an
+                # idle connection is not a closed one
+                if self.retry_timeouts:
+                    continue
+                return False
+            except OSError:
+                return False
+            if received == 0:
+                return False
+            view = view[received:]
+        return True
+
+    def recv(self):
+        """
+        receives the next message
+
+        returns:
+        (data, indicator), ('', 0) if the connection was closed or the
+        message was larger than max_frame_size. The data of binary
+        indicators is a memoryview of the reader's buffer, which is only
+        valid until the next call.
+        """
+        if len(self.buffer) > MAX_KEPT_BUFFER_SIZE:
+            # the last message may still be using the old buffer
+            self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        if not self.recv_exact(memoryview(self.header)):
+            return '', 0
+        indicator = self.header[0]
+        data_len = int.from_bytes(self.header[1:5], byteorder="big")
+        if data_len > self.max_frame_size:
+            return '', 0
+        if data_len > len(self.buffer):
+            self.buffer = bytearray(min(max(data_len, 2 * len(self.buffer)), self.max_frame_size))
+        data = memoryview(self.buffer)[:data_len]
+        if not self.recv_exact(data):
+            return '', 0
+        count_traffic(False, indicator, data_len + 5)
+        if indicator in BINARY_INDICATORS:
+            return data, indicator
+        return str(data, 'utf-8'), indicator
+
+
 def recv_custom(socket):
     """
-    receives message, parses size and type, reads data in chunks
+    receives one message, parses size and type, reads data
+
+    use a FramedReader to receive many messages from the same socket
 
     arguments:
     socket -- the connected socket
     """
-    # Receive and parse size header
-    try:
-        header = socket.recv(5)
-    except (ConnectionResetError, ConnectionAbortedError):
-        return '', 0
+    data, indicator = FramedReader(socket).recv()
+    if indicator in BINARY_INDICATORS:
+        return bytes(data), indicator
+    return data, indicator
+
+
+async def recv_custom_async(reader, max_frame_size=MAX_FRAME_SIZE):
+    """
+    asyncio version of recv_custom, receives one message from a stream
 
-    # To handle empty messsage from closed connections from trader after transaction is sent.
-    if not header:
+    arguments:
+    reader -- asyncio.StreamReader of the connection
+    max_frame_size -- largest payload accepted, larger messages close the connection
+
+    returns:
+    (data, indicator), ('', 0) if the connection was closed or the message
+    was too large
+    """
+    try:
+        header = await reader.readexactly(5)
+        indicator = header[0]
+        data_len = int.from_bytes(header[1:5], byteorder="big")
+        if data_len > max_frame_size:
+            return '', 0
+        data = await reader.readexactly(data_len)
+    except (asyncio.IncompleteReadError, OSError):
         return '', 0
-    
-    indicator = int(header[0])
-    data_len = int.from_bytes(header[1:5], byteorder = "big")
-    # Receive the rest of data based on size
-    data = b""
-    data_recv = 0
-    while data_recv < data_len:
-        chunk = socket.recv(min(data_len - data_recv, 1024))
-        data += chunk
-        data_recv += len(chunk)
+    count_traffic(False, indicator, data_len + 5)
+    if indicator in BINARY_INDICATORS:
+        return data, indicator
     return data.decode(), indicator
-    
+
+
+class AsyncPeer:
+    def __init__(self, loop, writer, queue_size=OUTBOUND_QUEUE_SIZE):
+        """
+        Constructor for AsyncPeer class
+
+        Connection to a peer in an asyncio node. It can be passed to
+        send_custom from any thread like a socket: sendall never blocks, it
+        queues the message for the peer's writer task. A peer whose queue
+        fills up is too slow to keep up and is closed.
+
+        arguments:
+        loop -- event loop the connection belongs to
+        writer -- asyncio.StreamWriter of the connection
+        queue_size -- number of messages that can wait to be sent
+        """
+        self.loop = loop
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.closed = False
+
+    def sendall(self, data):
+        """
+        queue data to be sent to the peer, safe to call from any thread
+
+        arguments:
+        data -- bytes to send
+        """
+        if not self.closed:
+            self.loop.call_soon_threadsafe(self.enqueue, data)
+
+    def enqueue(self, data):
+        """
+        put data on the outbound queue, closing the peer if it is full
+        """
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.close()
+
+    async def write_loop(self):
+        """
+        writer task: sends queued messages until the peer is closed
+        """
+        try:
+            while True:
+                data = await self.queue.get()
+                if data is None:
+                    break
+                self.writer.write(data)
+                await self.writer.drain()
+        except OSError:
+            pass
+        self.close()
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')[:2]
+
+    def close(self):
+        """
+        close the connection, safe to call more than once and from any thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.shutdown)
+
+    def shutdown(self):
+        """
+        close the stream and wake the writer task so it exits, runs on the
+        event loop
+        """
+        self.writer.close()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class PeerWriter:
+    def __init__(self, socket, queue_size=OUTBOUND_QUEUE_SIZE, send_timeout=SEND_TIMEOUT):
+        """
+        Constructor for PeerWriter class
+
+        Connection to a peer in a threaded node. Like AsyncPeer it can be
+        passed to send_custom like a socket: sendall never blocks, it queues
+        the message for the peer's writer thread. A peer whose queue fills
+        up, or that doesn't accept a message within send_timeout seconds, is
+        closed so it can't hold up sending to the others.
+
+        arguments:
+        socket -- the connected socket
+        queue_size -- number of messages that can wait to be sent
+        send_timeout -- seconds a send may stall before the peer is dropped
+        """
+        self.socket = socket
+        self.socket.settimeout(send_timeout)
+        self.peername = socket.getpeername()
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def sendall(self, data):
+        """
+        queue data to be sent to the peer, closing the peer if its queue is
+        full
+
+        arguments:
+        data -- bytes to send
+        """
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.close()
+
+    def write_loop(self):
+        """
+        target function for the writer thread: sends queued messages until
+        the peer is closed
+        """
+        while True:
+            data = self.queue.get()
+            if data is None or self.closed:
+                break
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                # stalled past the send timeout or disconnected
+                break
+        self.close()
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        """
+        close the connection, safe to call more than once and from any
+        thread. The reader of the socket sees the connection as closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        # wake the writer thread if it is waiting for a message
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class SeenCache:
+    def __init__(self, max_size=SEEN_CACHE_SIZE, ttl=SEEN_CACHE_TTL):
+        """
+        Constructor for SeenCache class
+
+        Remembers recently seen keys (block or tip hashes) so a node relays
+        each one at most once. The least recently seen keys are evicted once
+        there are more than max_size, and keys not seen for ttl seconds are
+        forgotten.
+
+        arguments:
+        max_size -- number of keys to remember
+        ttl -- seconds a key is remembered after it was last seen
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> time it was last seen, least recently seen first
+        self.seen = OrderedDict()
+        # number of duplicates add() and check() reported
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def expire(self, now):
+        """
+        forget expired keys, they are at the front. Called with the lock held.
+        """
+        while self.seen:
+            oldest, seen_at = next(iter(self.seen.items()))
+            if now - seen_at < self.ttl:
+                break
+            del self.seen[oldest]
+
+    def check(self, key):
+        """
+        check if a key was seen without marking it, for keys that are only
+        marked once they turn out to be valid
+
+        arguments:
+        key -- the key, e.g. a block hash
+
+        returns:
+        True if the key is new, False if it is a duplicate
+        """
+        with self.lock:
+            self.expire(time.monotonic())
+            if key in self.seen:
+                self.suppressed += 1
+                return False
+            return True
+
+    def add(self, key):
+        """
+        mark a key as seen
+
+        arguments:
+        key -- the key, e.g. a block hash
+
+        returns:
+        True if the key is new, False if it is a duplicate
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            duplicate = key in self.seen
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            if duplicate:
+                self.suppressed += 1
+                return False
+            if len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+            return True
+
+
+def frame(data, indicator):
+    """
+    build a message with the custom 5-byte header
+
+    arguments:
+    data -- the data being sent, a string or bytes for binary indicators
+    indicator -- type of data
+
+    returns:
+    header and data as bytes
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    return indicator.to_bytes(1, byteorder="big") + len(data).to_bytes(4, byteorder="big") + data
+
+
+def broadcast(connections, data, indicator):
+    """
+    send one message to many connections, framing it once. Connections
+    are PeerWriters or AsyncPeers, so a slow peer only delays itself.
+
+    arguments:
+    connections -- the connections to send to
+    data -- the data being sent
+    indicator -- type of data
+    """
+    message = frame(data, indicator)
+    for conn in connections:
+        conn.sendall(message)
+    count_traffic(True, indicator, len(message), len(connections))
+
+
 def send_custom(socket, data, indicator):
     """
     sends data with custom 5-byte header
-    data must be a string
+    data must be a string, or bytes for binary indicators
 
     arguments:
     socket --  the connected socket
     data -- the data being sent
     indicator -- type of data
     """
-    data = data.encode()
-    data_len = len(data)
-    indicator_bytes = indicator.to_bytes(1, byteorder="big")
-    size_bytes = data_len.to_bytes(4, byteorder="big")
-    socket.sendall(indicator_bytes + size_bytes + data)
\ No newline at end of file
+    message = frame(data, indicator)
+    socket.sendall(message)
+    count_traffic(True, indicator, len(message))
\ No newline at end of file
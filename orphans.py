@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+MAX_ORPHANS = 256  # blocks an OrphanPool holds before evicting the oldest
+ORPHAN_TIMEOUT = 2.0  # seconds to wait for an orphan's parent before fetching the gap
+
+
+class OrphanPool:
+    def __init__(self, max_size=MAX_ORPHANS):
+        """
+        Constructor for OrphanPool class
+
+        Holds blocks that arrived before their parent, keyed by the hash of
+        the parent they are waiting for
+
+        arguments:
+        max_size -- number of blocks to hold, the oldest is evicted first
+        """
+        self.max_size = max_size
+        # block hash -> block, oldest first
+        self.blocks = OrderedDict()
+        # parent hash -> hashes of the blocks waiting for it
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def add(self, block):
+        """
+        hold a block until its parent arrives
+
+        arguments:
+        block -- the orphan block
+
+        returns:
+        False if the block was already held
+        """
+        with self.lock:
+            if block.hash in self.blocks:
+                return False
+            if len(self.blocks) >= self.max_size:
+                self._remove(next(iter(self.blocks)))
+            self.blocks[block.hash] = block
+            self.children.setdefault(block.prev_hash, []).append(block.hash)
+            return True
+
+    def remove(self, block_hash):
+        """
+        stop holding a block
+
+        arguments:
+        block_hash -- hash of the block
+
+        returns:
+        the block, None if it wasn't held
+        """
+        with self.lock:
+            return self._remove(block_hash)
+
+    def pop_children(self, prev_hash):
+        """
+        take every block waiting for a parent out of the pool
+
+        arguments:
+        prev_hash -- hash of the parent
+
+        returns:
+        list of the blocks, oldest first
+        """
+        with self.lock:
+            hashes = self.children.pop(prev_hash, [])
+            return [self.blocks.pop(block_hash) for block_hash in hashes]
+
+    def _remove(self, block_hash):
+        block = self.blocks.pop(block_hash, None)
+        if block is not None:
+            siblings = self.children[block.prev_hash]
+            siblings.remove(block_hash)
+            if not siblings:
+                del self.children[block.prev_hash]
+        return block
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blockchain
+from transaction import Transaction
+
+
+@pytest.fixture(autouse=True)
+def low_difficulty(monkeypatch):
+    """
+    mine at difficulty 1 so tests build chains in milliseconds
+    """
+    monkeypatch.setattr(blockchain, 'BLOCK_DIFFICULTY', 1)
+
+
+def transfer(sender, recipient, amount):
+    """
+    serialized transaction, the form miners put in blocks
+    """
+    return Transaction(sender, recipient, amount).serialize()
+
+
+class FakeConnection:
+    """
+    stands in for a peer connection, recording the messages sent to it
+    """
+    def __init__(self, peername=('127.0.0.1', 0)):
+        self.sent = []
+        self.peername = peername
+
+    def sendall(self, data):
+        self.sent.append((data[0], data[5:]))
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        pass
+
+    def indicators(self):
+        return [indicator for indicator, _ in self.sent]
+
+
+@pytest.fixture
+def miner():
+    from miner import Miner
+    node = Miner(0)
+    yield node
+    node.socket.close()
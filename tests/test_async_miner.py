@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from blockchain import Blockchain
+from miner import AsyncMiner
+from conftest import transfer
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+async def shutdown(server):
+    """
+    stop accepting peers and end every connection's tasks, so the
+    streams are closed before the loop is
+    """
+    server.close()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # let the closed transports run their callbacks
+    await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def nodes():
+    """
+    two AsyncMiners, each running its event loop in a thread and accepting
+    peers on a localhost port. Mining isn't started, the tests mine by hand.
+    """
+    started = []
+
+    def start():
+        node = AsyncMiner(0)
+        thread = threading.Thread(target=node.loop.run_forever, daemon=True)
+        thread.start()
+        server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(node.handle_peer, '127.0.0.1', 0), node.loop).result(5)
+        node.port = server.sockets[0].getsockname()[1]
+        started.append((node, thread, server))
+        return node
+
+    yield start
+    for node, thread, server in started:
+        asyncio.run_coroutine_threadsafe(shutdown(server), node.loop).result(5)
+        node.loop.call_soon_threadsafe(node.loop.stop)
+        thread.join(5)
+        node.loop.close()
+        node.executor.shutdown()
+        node.mining_executor.shutdown()
+        node.socket.close()
+
+
+def test_two_async_miners_exchange_blocks(nodes):
+    a, b = nodes(), nodes()
+    a.blockchain = Blockchain()
+    a.blockchain.mine([transfer('alice', 'bob', 1.0)])
+
+    # b has no chain yet, so it asks a for one when it connects
+    b.peer_list = [('127.0.0.1', a.port)]
+    b.connect_to_peers()
+    wait_until(lambda: b.blockchain is not None)
+    assert [block.hash for block in b.blockchain.blockchain] == [block.hash for block in a.blockchain.blockchain]
+
+    block, added = b.blockchain.mine([transfer('bob', 'carol', 2.0)])
+    assert added
+    b.broadcast_block(block)
+    wait_until(lambda: len(a.blockchain.blockchain) == 3)
+    assert a.blockchain.blockchain[-1].hash == block.hash
+    assert a.blocks_accepted.value() == 1
+    assert a.blockchain.get_balance('carol') == 102.0
@@ -0,0 +1,198 @@
+import hashlib
+import multiprocessing
+
+import pytest
+
+import blockchain
+from blockchain import Block, Blockchain, blocks_from_bytes, blocks_to_bytes, check_blocks, validate_chunks
+from transaction import Transaction
+from conftest import transfer
+
+
+def extend(chain, *amounts, sender='alice', recipient='bob'):
+    """
+    mine one block per amount onto a chain
+
+    returns:
+    IDs of the mined transactions
+    """
+    ids = []
+    for amount in amounts:
+        data = transfer(sender, recipient, amount)
+        block, added = chain.mine([data])
+        assert added
+        ids.append(Transaction.deserialize(data).trans_id)
+    return ids
+
+
+def fork_of(chain, height):
+    """
+    new chain sharing the blocks of chain up to height
+    """
+    return Blockchain(list(chain.blockchain[:height + 1]))
+
+
+def assert_ledger_matches_replay(chain):
+    replayed = Blockchain(list(chain.blockchain))
+    assert chain.balances == replayed.balances
+    assert dict(chain.transaction_ids) == dict(replayed.transaction_ids)
+    for wallet in ('alice', 'bob', 'carol'):
+        assert chain.history.count(wallet) == replayed.history.count(wallet)
+        assert ([(h, t.trans_id) for h, t in chain.get_history(wallet, 0, 100)[0]] ==
+                [(h, t.trans_id) for h, t in replayed.get_history(wallet, 0, 100)[0]])
+
+
+def test_replace_suffix_undoes_the_removed_blocks():
+    ours = Blockchain()
+    extend(ours, 1.0)
+    replaced = extend(ours, 2.0, 3.0)
+    theirs = fork_of(ours, 1)
+    kept = extend(theirs, 4.0, 5.0, 6.0, sender='bob', recipient='carol')
+
+    removed = ours.replace_suffix(0, theirs.blockchain)
+    assert removed == 2
+    assert [b.hash for b in ours.blockchain] == [b.hash for b in theirs.blockchain]
+    assert not any(ours.transaction_exists(trans_id) for trans_id in replaced)
+    assert all(ours.transaction_exists(trans_id) for trans_id in kept)
+    assert ours.get_balance('alice') == 99.0
+    assert ours.get_balance('carol') == 115.0
+    assert_ledger_matches_replay(ours)
+
+
+def test_replace_suffix_with_only_the_peers_new_blocks():
+    ours = Blockchain()
+    extend(ours, 1.0, 2.0)
+    theirs = fork_of(ours, 2)
+    extend(theirs, 3.0)
+    # the peer sends only the blocks after the ones it knows we have
+    assert ours.replace_suffix(2, theirs.blockchain[2:]) == 0
+    assert len(ours.blockchain) == 4
+    assert ours.get_balance('alice') == 94.0
+    assert_ledger_matches_replay(ours)
+
+
+def test_replace_suffix_reverts_from_the_history_when_the_undo_log_is_exhausted(monkeypatch):
+    ours = Blockchain()
+    extend(ours, 1.0, 2.0)
+    theirs = fork_of(ours, 1)
+    extend(theirs, 4.0, 5.0, sender='bob', recipient='carol')
+    ours.undo_log.clear()
+    monkeypatch.setattr(ours, 'rebuild_ledger', None)
+    assert ours.replace_suffix(0, theirs.blockchain) == 1
+    assert_ledger_matches_replay(ours)
+
+
+def test_replace_suffix_rejects_blocks_past_the_tip():
+    ours = Blockchain()
+    extend(ours, 1.0)
+    theirs = fork_of(ours, 1)
+    extend(theirs, 2.0, 3.0, 4.0)
+    before = [b.hash for b in ours.blockchain]
+    # a gap between our tip (height 1) and the peer's first block
+    assert ours.replace_suffix(3, theirs.blockchain[3:]) is None
+    assert [b.hash for b in ours.blockchain] == before
+
+
+def test_replace_suffix_rejects_an_invalid_suffix():
+    ours = Blockchain()
+    extend(ours, 1.0)
+    theirs = fork_of(ours, 1)
+    extend(theirs, 2.0, 3.0)
+    theirs.blockchain[2].nonce += 1
+    before = [b.hash for b in ours.blockchain]
+    assert ours.replace_suffix(0, theirs.blockchain) is None
+    assert [b.hash for b in ours.blockchain] == before
+    assert_ledger_matches_replay(ours)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(blockchain, 'PARALLEL_VALIDATION_THRESHOLD', 1)
+    monkeypatch.setattr(blockchain, 'VALIDATION_CHUNK_SIZE', 2)
+    # workers forked after the difficulty is lowered inherit it
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        yield pool
+
+
+def received(chain):
+    """
+    the chain's blocks as a peer receives them in the binary wire format
+    """
+    positions = []
+    data = blocks_to_bytes(chain.blockchain)
+    return blocks_from_bytes(data, 0, positions), (data, positions)
+
+
+def test_replace_suffix_validates_in_parallel(pool, monkeypatch):
+    checked = []
+    monkeypatch.setattr(blockchain, 'validate_chunks',
+                        lambda chunks, prev, pool: checked.append(prev) or validate_chunks(chunks, prev, pool))
+    ours = Blockchain()
+    extend(ours, 1.0)
+    theirs = fork_of(ours, 1)
+    extend(theirs, 2.0, 3.0, 4.0)
+    blocks, data = received(theirs)
+    assert ours.replace_suffix(0, blocks, pool, data) == 0
+    # only the blocks after the shared ones went to the pool
+    assert checked == [(1, ours.blockchain[1].hash)]
+    assert_ledger_matches_replay(ours)
+
+    other = fork_of(ours, 2)
+    extend(other, 5.0, 6.0, 7.0)
+    other.blockchain[4].nonce += 1
+    blocks, data = received(other)
+    assert ours.replace_suffix(0, blocks, pool, data) is None
+
+    # valid blocks, but starting past our tip
+    longer = fork_of(ours, 4)
+    extend(longer, 8.0, 9.0, 10.0)
+    before = [b.hash for b in ours.blockchain]
+    assert len(before) == 5 and len(longer.blockchain[7:]) == 1
+    assert ours.replace_suffix(7, longer.blockchain[7:], pool) is None
+    assert [b.hash for b in ours.blockchain] == before
+
+
+def test_check_blocks_checks_links_inside_a_chunk():
+    chain = Blockchain()
+    extend(chain, 1.0, 2.0, 3.0)
+    blocks = chain.blockchain
+    assert check_blocks(blocks_to_bytes(blocks[1:])) == ((1, blocks[0].hash), (3, blocks[3].hash))
+    # each block is valid, but 3 doesn't follow 1
+    assert check_blocks(blocks_to_bytes([blocks[1], blocks[3]])) is None
+    data = bytearray(blocks_to_bytes(blocks[1:]))
+    data[-1] ^= 1
+    assert check_blocks(bytes(data)) is None
+    assert check_blocks(blocks_to_bytes(blocks[1:])[:-10]) is None
+    assert check_blocks(blocks_to_bytes([])) is None
+
+
+def test_is_valid_chain_in_parallel_from_the_received_bytes(pool):
+    chain = Blockchain()
+    extend(chain, 1.0, 2.0, 3.0, 4.0)
+    blocks, data = received(chain)
+    assert Blockchain(blocks).is_valid_chain(pool, data)
+    blocks[3].nonce += 1
+    tampered = bytes(blocks_to_bytes(blocks))
+    positions = []
+    assert not Blockchain(blocks_from_bytes(tampered, 0, positions)).is_valid_chain(pool, (tampered, positions))
+
+
+def test_merkle_root_changes_with_the_transactions():
+    transfers = [transfer('alice', 'bob', float(i)) for i in range(1, 4)]
+    root = blockchain.calculate_merkle_root(transfers)
+    assert blockchain.calculate_merkle_root(transfers[:2]) != root
+    assert blockchain.calculate_merkle_root(transfers + [transfer('bob', 'carol', 1.0)]) != root
+    assert blockchain.calculate_merkle_root([transfers[1], transfers[0], transfers[2]]) != root
+    # an odd level pairs its last hash with itself
+    assert blockchain.calculate_merkle_root(transfers + [transfers[2]]) == root
+    assert blockchain.calculate_merkle_root(transfers[:1]) == hashlib.sha256(transfers[0].encode()).hexdigest()
+
+
+def test_block_with_changed_transactions_is_invalid():
+    chain = Blockchain()
+    extend(chain, 1.0)
+    block = chain.blockchain[1]
+    assert block.is_valid_block()
+    tampered = Block(block.index, block.nonce, [transfer('alice', 'mallory', 1.0)], block.prev_hash,
+                     block.hash, block.merkle_root)
+    assert not tampered.is_valid_block()
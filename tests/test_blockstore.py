@@ -0,0 +1,178 @@
+import os
+
+import blockchain
+from blockchain import Blockchain, blocks_to_bytes
+from blockstore import BlockStore, INDEX_ENTRY, INDEX_FILE, SEGMENT_FILE
+from transaction import Transaction
+from conftest import transfer
+
+
+def mine_chain(transfers):
+    """
+    in-memory chain with one block per transfer
+    """
+    chain = Blockchain()
+    for data in transfers:
+        block, added = chain.mine([data])
+        assert added
+    return chain
+
+
+def test_persist_moves_ledger_into_store(tmp_path):
+    data = transfer('alice', 'bob', 10.0)
+    trans_id = Transaction.deserialize(data).trans_id
+    chain = mine_chain([data])
+
+    store = BlockStore(str(tmp_path))
+    chain.persist(store)
+    store.close()
+
+    reopened = Blockchain(store=BlockStore(str(tmp_path)))
+    assert reopened.get_balance('alice') == 90.0
+    assert reopened.get_balance('bob') == 110.0
+    assert reopened.transaction_exists(trans_id)
+    assert reopened.get_transaction_height(trans_id) == 1
+    assert reopened.history.count('alice') == 1
+    history, more = reopened.get_history('alice')
+    assert [(height, t.trans_id) for height, t in history] == [(1, trans_id)]
+    assert not more
+
+
+def store_chain(directory, amounts):
+    """
+    chain kept in a BlockStore with one block per amount sent from alice to bob
+    """
+    chain = Blockchain(store=BlockStore(directory))
+    for amount in amounts:
+        block, added = chain.mine([transfer('alice', 'bob', amount)])
+        assert added
+    return chain
+
+
+def assert_same_ledger(chain, expected):
+    assert chain.balances == expected.balances
+    assert len(chain.transaction_ids) == len(expected.transaction_ids)
+    for trans_id, height in expected.transaction_ids.items():
+        assert chain.get_transaction_height(trans_id) == height
+    for wallet in ('alice', 'bob', 'carol'):
+        assert chain.history.count(wallet) == expected.history.count(wallet)
+        for height in range(len(chain.blockchain)):
+            assert chain.get_balance_at(wallet, height) == expected.get_balance_at(wallet, height)
+
+
+def test_blocks_survive_reopening(tmp_path):
+    chain = mine_chain([transfer('alice', 'bob', float(i)) for i in range(1, 6)])
+    store = BlockStore(str(tmp_path))
+    store.extend(chain.blockchain)
+    store.close()
+
+    # a cache of one block makes every other read come from disk
+    store = BlockStore(str(tmp_path), cache_size=1)
+    assert len(store) == 6
+    assert [block.hash for block in store] == [block.hash for block in chain.blockchain]
+    assert [store.hash(height) for height in range(6)] == [block.hash for block in chain.blockchain]
+    assert [block.hash for block in store[2:4]] == [block.hash for block in chain.blockchain[2:4]]
+    assert store[-1].transactions == chain.blockchain[-1].transactions
+    assert store.encode_blocks(1, 4) == blocks_to_bytes(chain.blockchain[1:4])
+    store.close()
+
+
+def test_truncate_then_append_survives_reopening(tmp_path):
+    chain = mine_chain([transfer('alice', 'bob', float(i)) for i in range(1, 6)])
+    fork = Blockchain(list(chain.blockchain[:3]))
+    fork.mine([transfer('bob', 'carol', 7.0)])
+
+    store = BlockStore(str(tmp_path))
+    store.extend(chain.blockchain)
+    del store[3:]
+    store.append(fork.blockchain[3])
+    store.close()
+
+    store = BlockStore(str(tmp_path))
+    assert [block.hash for block in store] == [block.hash for block in fork.blockchain]
+    store.close()
+
+
+def test_partial_write_is_dropped_on_open(tmp_path):
+    chain = mine_chain([transfer('alice', 'bob', 1.0), transfer('alice', 'bob', 2.0)])
+    store = BlockStore(str(tmp_path))
+    store.extend(chain.blockchain)
+    store.close()
+    # a block and half an index entry written when the miner was killed
+    with open(os.path.join(str(tmp_path), SEGMENT_FILE), 'ab') as f:
+        f.write(b'\x00' * 50)
+    with open(os.path.join(str(tmp_path), INDEX_FILE), 'ab') as f:
+        f.write(b'\x00' * (INDEX_ENTRY.size // 2))
+
+    store = BlockStore(str(tmp_path))
+    assert len(store) == 3
+    assert store[-1].hash == chain.blockchain[-1].hash
+    store.append(mine_chain([]).blockchain[0])
+    store.close()
+    assert os.path.getsize(os.path.join(str(tmp_path), INDEX_FILE)) == 4 * INDEX_ENTRY.size
+
+
+def test_ledger_restored_from_checkpoint_and_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(blockchain, 'CHECKPOINT_INTERVAL', 3)
+    chain = store_chain(str(tmp_path), [1.0, 2.0, 3.0, 4.0])
+    assert chain.checkpoint_height == 2
+    expected = Blockchain(list(chain.blockchain))
+    chain.store.close()
+
+    reopened = Blockchain(store=BlockStore(str(tmp_path)))
+    assert reopened.checkpoint_height == 2
+    assert_same_ledger(reopened, expected)
+
+
+def test_fork_below_the_checkpoint_survives_reopening(tmp_path, monkeypatch):
+    monkeypatch.setattr(blockchain, 'CHECKPOINT_INTERVAL', 3)
+    chain = store_chain(str(tmp_path), [1.0, 2.0, 3.0, 4.0])
+    fork = Blockchain(list(chain.blockchain[:2]))
+    for amount in (5.0, 6.0, 7.0, 8.0):
+        fork.mine([transfer('bob', 'carol', amount)])
+    assert chain.replace_suffix(0, fork.blockchain) == 3
+    assert_same_ledger(chain, fork)
+    chain.store.close()
+
+    reopened = Blockchain(store=BlockStore(str(tmp_path)))
+    assert [block.hash for block in reopened.blockchain] == [block.hash for block in fork.blockchain]
+    assert_same_ledger(reopened, fork)
+
+
+def test_short_fork_after_reopening_reverts_from_the_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(blockchain, 'CHECKPOINT_INTERVAL', 5)
+    chain = store_chain(str(tmp_path), [1.0, 2.0, 3.0, 4.0])
+    chain.store.close()
+    fork = Blockchain(list(chain.blockchain[:4]))
+    for amount in (5.0, 6.0):
+        fork.mine([transfer('bob', 'carol', amount)])
+
+    # checkpointed at the tip, so nothing is replayed into the undo log
+    reopened = Blockchain(store=BlockStore(str(tmp_path)))
+    assert reopened.checkpoint_height == 4
+    assert not reopened.undo_log
+
+    def rebuild_ledger():
+        raise AssertionError('a one-block fork replayed the whole chain')
+    monkeypatch.setattr(reopened, 'rebuild_ledger', rebuild_ledger)
+    assert reopened.replace_suffix(4, fork.blockchain[4:]) == 1
+    assert_same_ledger(reopened, fork)
+    reopened.store.close()
+
+
+def test_locators_are_read_from_the_index(tmp_path, monkeypatch):
+    chain = store_chain(str(tmp_path), [float(i) for i in range(1, 13)])
+    expected = Blockchain(list(chain.blockchain))
+    chain.store.close()
+
+    reopened = Blockchain(store=BlockStore(str(tmp_path)))
+
+    def get(height):
+        raise AssertionError('block loaded from disk')
+    monkeypatch.setattr(reopened.store, 'get', get)
+    locator = reopened.get_locator()
+    assert locator == expected.get_locator()
+    assert reopened.find_start(locator) == 13
+    assert reopened.find_start([[5, expected.blockchain[5].hash], [0, 'other']]) == 6
+    assert reopened.encode_blocks(6, 13) == blocks_to_bytes(expected.blockchain[6:])
+    reopened.store.close()
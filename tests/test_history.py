@@ -0,0 +1,120 @@
+import json
+import random
+
+import pytest
+
+from blockchain import AccountHistory, Blockchain, STARTING_WALLET_AMOUNT
+from blockstore import BlockStore
+from conftest import transfer
+
+WALLETS = ('alice', 'bob', 'carol', 'dave')
+
+
+def random_blocks(chain, blocks, seed):
+    """
+    mine blocks of one to three transfers between WALLETS, including
+    transfers to oneself
+    """
+    rng = random.Random(seed)
+    for _ in range(blocks):
+        transactions = [transfer(rng.choice(WALLETS), rng.choice(WALLETS), rng.randint(1, 100) / 100)
+                        for _ in range(rng.randint(1, 3))]
+        block, added = chain.mine(transactions)
+        assert added
+
+
+def naive_history(chain, wallet):
+    """
+    (height, transaction ID) of every transaction of a wallet, newest first
+    """
+    found = []
+    for block in chain.blockchain[1:]:
+        for t in block.parsed_transactions:
+            if wallet in (t.sender, t.recipient):
+                found.append((block.index, t.trans_id))
+    return found[::-1]
+
+
+def naive_balance(chain, wallet, height):
+    balance = STARTING_WALLET_AMOUNT
+    for block in chain.blockchain[1:height + 1]:
+        for t in block.parsed_transactions:
+            if t.sender == wallet:
+                balance -= t.amount
+            if t.recipient == wallet:
+                balance += t.amount
+    return balance
+
+
+def assert_history_matches_scan(chain):
+    for wallet in WALLETS + ('nobody',):
+        expected = naive_history(chain, wallet)
+        for page_size in (1, 3, 10):
+            pages = []
+            offset = 0
+            while True:
+                page, more = chain.get_history(wallet, offset, page_size)
+                pages.extend((height, t.trans_id) for height, t in page)
+                offset += page_size
+                assert more == (offset < len(expected))
+                if not more:
+                    break
+            assert pages == expected
+        for height in range(len(chain.blockchain)):
+            assert chain.get_balance_at(wallet, height) == pytest.approx(naive_balance(chain, wallet, height))
+
+
+@pytest.fixture(params=['memory', 'store'])
+def chain(request, tmp_path):
+    if request.param == 'memory':
+        yield Blockchain()
+    else:
+        store = BlockStore(str(tmp_path))
+        yield Blockchain(store=store)
+        store.close()
+
+
+def test_history_matches_a_scan_of_the_chain(chain):
+    random_blocks(chain, 25, seed=1)
+    assert_history_matches_scan(chain)
+
+
+def test_history_after_a_fork(chain):
+    random_blocks(chain, 10, seed=2)
+    fork = Blockchain(list(chain.blockchain[:6]))
+    random_blocks(fork, 8, seed=3)
+    assert chain.replace_suffix(0, fork.blockchain) == 5
+    assert_history_matches_scan(chain)
+
+
+def test_account_history_remove_and_lookup():
+    history = AccountHistory()
+    history.append('alice', 1, 90.0, 1)
+    history.append('alice', 4, 80.0, 2)
+    history.append('alice', 7, 85.0, 1)
+    assert history.count('alice') == 4
+    assert history.balance_at('alice', 0) is None
+    assert history.balance_at('alice', 5) == 80.0
+    assert history.blocks('alice', 1, 3) == [(4, 3)]
+    assert history.blocks('alice', 0, 4) == [(1, 1), (4, 3), (7, 4)]
+    history.remove('alice', 7)
+    assert history.count('alice') == 3
+    assert history.balance_at('alice', 9) == 80.0
+    assert history.count('bob') == 0
+
+
+@pytest.mark.parametrize('query', [
+    {'type': 'balance', 'wallet': 'alice', 'height': 1e400},
+    {'type': 'history', 'wallet': 'alice', 'page': 1e400},
+    {'type': 'history', 'wallet': 'alice', 'page_size': -1e400},
+    {'type': 'history', 'wallet': 'alice', 'page': 10 ** 30},
+])
+def test_queries_with_numbers_too_large_are_answered_with_an_error(miner, chain, query):
+    random_blocks(chain, 3, seed=4)
+    miner.blockchain = chain
+    answer = json.loads(miner.answer_query(json.dumps(query)))
+    if 'error' not in answer:
+        # a page past the end of the history is just empty
+        assert answer['transactions'] == [] and not answer['more']
+    balance = json.loads(miner.answer_query(json.dumps({'type': 'balance', 'wallet': 'alice'})))
+    assert balance['balance'] == chain.get_balance('alice')
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from mempool import Mempool
+from transaction import Transaction
+from conftest import transfer
+
+
+def trans_id(data):
+    return Transaction.deserialize(data).trans_id
+
+
+def test_batches_keep_arrival_order():
+    mempool = Mempool()
+    transfers = [transfer('alice', 'bob', float(i)) for i in range(1, 6)]
+    for data in transfers:
+        assert mempool.add(data, None, 'ok')
+    assert mempool.ids() == [trans_id(data) for data in transfers]
+    assert mempool.wait_for_batch(3, 60) == transfers[:3]
+    mempool.remove(trans_id(transfers[1]))
+    assert mempool.wait_for_batch(3, 60) == [transfers[0], transfers[2], transfers[3]]
+
+
+def test_a_duplicate_is_ignored():
+    mempool = Mempool()
+    data = transfer('alice', 'bob', 10.0)
+    assert mempool.add(data, 'first', 'ok')
+    assert not mempool.add(data, 'second', 'ok')
+    assert len(mempool) == 1
+    assert mempool.pending_spend('alice') == 10.0
+    assert mempool.remove(trans_id(data)) == ('first', 'ok')
+    assert mempool.pending_spend('alice') == 0.0
+    assert 'alice' not in mempool.spending
+    assert mempool.remove(trans_id(data)) is None
+
+
+def test_pending_spend_per_sender():
+    mempool = Mempool()
+    first = transfer('alice', 'bob', 10.0)
+    mempool.add(first, None, 'ok')
+    mempool.add(transfer('alice', 'carol', 2.5), None, 'ok')
+    mempool.add(transfer('bob', 'alice', 4.0), None, 'ok')
+    assert mempool.pending_spend('alice') == 12.5
+    assert mempool.pending_spend('bob') == 4.0
+    assert mempool.pending_spend('carol') == 0.0
+    mempool.remove(trans_id(first))
+    assert mempool.pending_spend('alice') == 2.5
+
+
+def test_wait_for_batch_returns_a_full_batch_at_once():
+    mempool = Mempool()
+    batches = []
+    thread = threading.Thread(target=lambda: batches.append(mempool.wait_for_batch(2, 60)))
+    thread.start()
+    transfers = [transfer('alice', 'bob', 1.0), transfer('alice', 'bob', 2.0)]
+    for data in transfers:
+        mempool.add(data, None, 'ok')
+    thread.join(5)
+    assert batches == [transfers]
+
+
+def test_wait_for_batch_returns_a_partial_batch_after_the_interval():
+    mempool = Mempool()
+    data = transfer('alice', 'bob', 1.0)
+    mempool.add(data, None, 'ok')
+    start = time.monotonic()
+    assert mempool.wait_for_batch(16, 0.1) == [data]
+    assert time.monotonic() - start >= 0.05
@@ -0,0 +1,64 @@
+import urllib.request
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_render_text_format():
+    registry = Registry()
+    requests = Counter('requests_total', 'requests handled', 'kind', registry=registry)
+    requests.inc(2, 'b"\n')
+    requests.inc(1, 'a')
+    Counter('errors_total', 'errors', registry=registry)
+    Gauge('peers', 'connected peers', lambda: 3, registry=registry)
+    Gauge('queues', 'queued messages', lambda: {'out': 1.5}, label='queue', registry=registry)
+    latency = Histogram('latency_seconds', 'latency', buckets=(0.1, 1.0), registry=registry)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5.0)
+
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total requests handled',
+        '# TYPE requests_total counter',
+        'requests_total{kind="a"} 1',
+        'requests_total{kind="b\\"\\n"} 2',
+        '# HELP errors_total errors',
+        '# TYPE errors_total counter',
+        'errors_total 0',
+        '# HELP peers connected peers',
+        '# TYPE peers gauge',
+        'peers 3',
+        '# HELP queues queued messages',
+        '# TYPE queues gauge',
+        'queues{queue="out"} 1.5',
+        '# HELP latency_seconds latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+    ]) + '\n'
+
+
+def test_a_failing_gauge_leaves_the_rest_of_the_scrape():
+    registry = Registry()
+    Counter('before_total', 'before', registry=registry).inc()
+
+    def broken():
+        raise RuntimeError('gone')
+    Gauge('broken', 'raises', broken, registry=registry)
+    Gauge('unreadable', 'not a number', lambda: None, registry=registry)
+    Gauge('after', 'after', lambda: 2, registry=registry)
+
+    server = metrics.serve(0, registry=registry)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.status == 200
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert body == ('# HELP before_total before\n# TYPE before_total counter\nbefore_total 1\n'
+                    '# HELP after after\n# TYPE after gauge\nafter 2\n')
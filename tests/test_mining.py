@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+import mining
+from blockchain import Block, Blockchain
+from miner import ParallelMiner
+from transaction import Transaction
+from conftest import FakeConnection, transfer
+
+
+def test_parallel_search_finds_valid_nonce():
+    miner = ParallelMiner(2)
+    try:
+        block = Block(1, 0, ['GENESIS'], '')
+        nonce, hash, attempts = miner.search(block.header(), 1)
+        block.nonce = nonce
+        assert hash.startswith('0') and block.calculate_hash() == hash
+        assert attempts >= 1
+    finally:
+        miner.pool.terminate()
+
+
+def test_parallel_search_releases_lock_when_pool_fails():
+    miner = ParallelMiner(1)
+    miner.pool.terminate()
+    header = Block(1, 0, ['GENESIS'], '').header()
+    with pytest.raises(ValueError):
+        # a terminated pool refuses new work
+        miner.search(header, 1)
+    assert miner.search_lock.acquire(timeout=1)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_block_from_a_peer_cancels_the_search_and_mining_moves_to_its_tip(miner):
+    miner.blockchain = Blockchain()
+    miner.batch_interval = 0.01
+
+    def stalled_search(header, difficulty, start=0, stop=None, cancel=None):
+        # a difficulty no search finishes, until it is cancelled
+        return mining.search(header, 64, start, stop, cancel)
+    miner.search = stalled_search
+    threading.Thread(target=miner.mining_loop, daemon=True).start()
+    data = transfer('alice', 'bob', 5.0)
+    miner.mempool.add(data, FakeConnection(), 'Transaction verified')
+    wait_until(lambda: miner.mining_jobs)
+    # the job already holds the stalled search, the next one finishes
+    miner.search = mining.search
+
+    peer = Blockchain(list(miner.blockchain.blockchain))
+    peer_block, added = peer.mine([transfer('carol', 'dave', 2.0)])
+    assert added
+    miner.handle_block(FakeConnection(), peer_block)
+
+    wait_until(lambda: len(miner.blockchain.blockchain) == 3)
+    assert miner.mining_cancelled.values.get(None) == 1
+    assert miner.blockchain.blockchain[1].hash == peer_block.hash
+    mined = miner.blockchain.blockchain[2]
+    assert mined.prev_hash == peer_block.hash
+    assert list(mined.transactions) == [data]
+    wait_until(lambda: not miner.mempool.contains(Transaction.deserialize(data).trans_id))
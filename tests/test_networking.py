@@ -0,0 +1,244 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import networking
+from blockchain import Block, Blockchain
+from networking import FramedReader, frame
+from conftest import FakeConnection, transfer
+
+
+@pytest.fixture
+def sockets():
+    sender, receiver = socket.socketpair()
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+def send_in_pieces(sock, data, size):
+    """
+    send data a few bytes at a time from another thread, so the reader sees
+    partial headers and payloads
+    """
+    def run():
+        for i in range(0, len(data), size):
+            sock.sendall(data[i:i + size])
+            time.sleep(0.001)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_reads_messages_split_across_sends(sockets):
+    sender, receiver = sockets
+    thread = send_in_pieces(sender, frame('hello', 3) + frame(b'\x00\x01\x02', 13) + frame('', 6), 2)
+    reader = FramedReader(receiver)
+    assert reader.recv() == ('hello', 3)
+    data, indicator = reader.recv()
+    assert indicator == 13 and isinstance(data, memoryview) and bytes(data) == b'\x00\x01\x02'
+    assert reader.recv() == ('', 6)
+    thread.join()
+
+
+def test_grows_buffer_for_large_messages(sockets):
+    sender, receiver = sockets
+    payload = 'x' * (3 * networking.INITIAL_BUFFER_SIZE + 1)
+    thread = send_in_pieces(sender, frame(payload, 2), 65536)
+    assert FramedReader(receiver).recv() == (payload, 2)
+    thread.join()
+
+
+def test_drops_large_buffer_after_the_message(sockets, monkeypatch):
+    monkeypatch.setattr(networking, 'MAX_KEPT_BUFFER_SIZE', 8192)
+    sender, receiver = sockets
+    payload = b'y' * 20000
+    thread = send_in_pieces(sender, frame(payload, 14) + frame('after', 3), 65536)
+    reader = FramedReader(receiver)
+    data, indicator = reader.recv()
+    assert bytes(data) == payload
+    assert reader.recv() == ('after', 3)
+    assert len(reader.buffer) == networking.INITIAL_BUFFER_SIZE
+    thread.join()
+
+
+def test_oversize_frame_closes_the_connection(sockets):
+    sender, receiver = sockets
+    sender.sendall(frame('z' * 100, 3))
+    assert FramedReader(receiver, max_frame_size=99).recv() == ('', 0)
+
+
+def test_connection_closed_mid_message(sockets):
+    sender, receiver = sockets
+    sender.sendall(frame('hello', 3)[:7])
+    sender.close()
+    assert FramedReader(receiver).recv() == ('', 0)
+
+
+def test_timeouts_are_retried_unless_disabled(sockets):
+    sender, receiver = sockets
+    receiver.settimeout(0.01)
+    assert FramedReader(receiver, retry_timeouts=False).recv() == ('', 0)
+    threading.Timer(0.05, sender.sendall, args=(frame('late', 3),)).start()
+    assert FramedReader(receiver).recv() == ('late', 3)
+
+
+def test_seen_cache_reports_duplicates():
+    cache = networking.SeenCache()
+    assert cache.add('a')
+    assert not cache.add('a')
+    assert cache.add('b')
+    assert cache.suppressed == 1
+
+
+def test_seen_cache_evicts_least_recently_seen():
+    cache = networking.SeenCache(max_size=2)
+    cache.add('a')
+    cache.add('b')
+    # seeing a again makes b the least recently seen
+    cache.add('a')
+    cache.add('c')
+    assert len(cache) == 2
+    assert cache.add('b')
+    assert not cache.add('c')
+
+
+def test_seen_cache_forgets_expired_keys(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(networking.time, 'monotonic', lambda: now[0])
+    cache = networking.SeenCache(ttl=10)
+    cache.add('a')
+    now[0] += 5
+    assert not cache.add('a')
+    now[0] += 11
+    assert cache.add('a')
+
+
+def test_miner_relays_a_block_once(miner):
+    peer = Blockchain()
+    peer.mine([transfer('alice', 'bob', 1.0)])
+    miner.blockchain = Blockchain(list(peer.blockchain[:1]))
+    relay = FakeConnection()
+    miner.connections.append(relay)
+    miner.handle_block(FakeConnection(), peer.blockchain[1])
+    miner.handle_block(FakeConnection(), peer.blockchain[1])
+    assert relay.indicators() == [1]
+    assert miner.seen_blocks.suppressed == 1
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_peer_writer_closes_a_peer_whose_queue_fills(sockets):
+    sender, receiver = sockets
+    # the receiver never reads, so the writer thread stalls on the first
+    # message and the rest wait in the queue
+    writer = networking.PeerWriter(sender, queue_size=2, send_timeout=60)
+    message = frame(b'\x00' * (1 << 20), 13)
+    start = time.monotonic()
+    for _ in range(10):
+        writer.sendall(message)
+        if writer.closed:
+            break
+    assert writer.closed
+    assert time.monotonic() - start < 1
+    # sending to a closed peer is a no-op
+    writer.sendall(message)
+
+
+def test_peer_writer_closes_a_peer_that_stalls_past_the_send_timeout(sockets):
+    sender, receiver = sockets
+    writer = networking.PeerWriter(sender, queue_size=16, send_timeout=0.1)
+    writer.sendall(frame(b'\x00' * (4 << 20), 13))
+    assert not writer.closed
+    wait_until(lambda: writer.closed)
+    # the reader sees the connection as closed
+    assert FramedReader(receiver).recv() == ('', 0)
+
+
+class FakeStreamWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_async_peer_closes_when_its_queue_fills():
+    loop = asyncio.new_event_loop()
+    try:
+        stream = FakeStreamWriter()
+        peer = networking.AsyncPeer(loop, stream, queue_size=2)
+        peer.sendall(b'first')
+        peer.sendall(b'second')
+        loop.run_until_complete(asyncio.sleep(0))
+        assert not peer.closed and peer.queue.qsize() == 2
+        peer.sendall(b'third')
+        loop.run_until_complete(asyncio.sleep(0))
+        assert peer.closed and stream.closed
+        # the queued messages are dropped and the writer task is woken
+        assert peer.queue.get_nowait() is None
+        peer.sendall(b'fourth')
+        loop.run_until_complete(asyncio.sleep(0))
+        assert peer.queue.empty()
+    finally:
+        loop.close()
+
+
+def test_broadcast_frames_once_and_sends_to_every_peer():
+    peers = [FakeConnection() for _ in range(3)]
+    messages = networking.MESSAGES_SENT.value(13)
+    sent = networking.BYTES_SENT.value(13)
+    networking.broadcast(peers, b'\x01\x02\x03', 13)
+    assert [peer.sent for peer in peers] == [[(13, b'\x01\x02\x03')]] * 3
+    assert networking.MESSAGES_SENT.value(13) - messages == 3
+    assert networking.BYTES_SENT.value(13) - sent == 3 * 8
+
+
+def test_broadcast_to_a_slow_peer_doesnt_hold_up_the_others(sockets):
+    sender, receiver = sockets
+    slow = networking.PeerWriter(sender, queue_size=2, send_timeout=60)
+    fast = FakeConnection()
+    message = b'\x00' * (1 << 20)
+    start = time.monotonic()
+    for _ in range(10):
+        networking.broadcast([slow, fast], message, 13)
+    assert time.monotonic() - start < 1
+    assert slow.closed
+    assert len(fast.sent) == 10
+
+
+def test_seen_cache_check_doesnt_mark():
+    cache = networking.SeenCache()
+    assert cache.check('a')
+    assert cache.check('a')
+    assert cache.add('a')
+    assert not cache.check('a')
+    assert cache.suppressed == 1
+
+
+def test_invalid_block_with_a_valid_hash_doesnt_suppress_the_valid_block(miner):
+    peer = Blockchain()
+    peer.mine([transfer('alice', 'bob', 1.0)])
+    miner.blockchain = Blockchain(list(peer.blockchain[:1]))
+    relay = FakeConnection()
+    miner.connections.append(relay)
+    block = peer.blockchain[1]
+    forged = Block(block.index, block.nonce, [transfer('alice', 'mallory', 50.0)], block.prev_hash, block.hash,
+                   block.merkle_root)
+    sender = FakeConnection()
+    miner.handle_block(sender, forged)
+    assert len(miner.blockchain.blockchain) == 1
+    assert relay.indicators() == []
+    assert miner.blocks_rejected.value() == 1
+    miner.handle_block(FakeConnection(), block)
+    assert miner.blockchain.blockchain[-1].hash == block.hash
+    assert relay.indicators() == [1]
+    assert miner.seen_blocks.suppressed == 0
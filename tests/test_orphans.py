@@ -0,0 +1,95 @@
+import time
+
+import miner as miner_module
+from blockchain import Blockchain
+from orphans import OrphanPool
+from conftest import FakeConnection, transfer
+
+
+def chain_of(length):
+    chain = Blockchain()
+    for i in range(length - 1):
+        chain.mine([transfer('alice', 'bob', float(i + 1))])
+    return chain
+
+
+def test_children_are_popped_oldest_first():
+    chain = chain_of(4)
+    sibling = Blockchain(list(chain.blockchain[:2]))
+    sibling.mine([transfer('bob', 'carol', 9.0)])
+    pool = OrphanPool()
+    assert pool.add(chain.blockchain[2])
+    assert not pool.add(chain.blockchain[2])
+    assert pool.add(sibling.blockchain[2])
+    assert pool.add(chain.blockchain[3])
+    assert len(pool) == 3
+    children = pool.pop_children(chain.blockchain[1].hash)
+    assert [b.hash for b in children] == [chain.blockchain[2].hash, sibling.blockchain[2].hash]
+    assert pool.pop_children(chain.blockchain[1].hash) == []
+    assert len(pool) == 1
+
+
+def test_oldest_orphan_is_evicted_when_full():
+    chain = chain_of(5)
+    pool = OrphanPool(max_size=2)
+    for block in chain.blockchain[2:]:
+        pool.add(block)
+    assert len(pool) == 2
+    assert pool.remove(chain.blockchain[2].hash) is None
+    assert pool.pop_children(chain.blockchain[1].hash) == []
+    assert pool.remove(chain.blockchain[3].hash) is chain.blockchain[3]
+    assert pool.remove(chain.blockchain[3].hash) is None
+    assert len(pool) == 1
+
+
+def test_miner_attaches_orphans_when_the_parent_arrives(miner):
+    peer = chain_of(4)
+    miner.blockchain = Blockchain(list(peer.blockchain[:2]))
+    conn = FakeConnection()
+    # blocks 3 then 2: the first waits in the pool for its parent
+    miner.handle_block(conn, peer.blockchain[3])
+    assert len(miner.orphans) == 1
+    miner.handle_block(conn, peer.blockchain[2])
+    assert [b.hash for b in miner.blockchain.blockchain] == [b.hash for b in peer.blockchain]
+    assert len(miner.orphans) == 0
+    assert miner.blocks_accepted.value() == 2
+    # nothing was fetched from the peer
+    assert 11 not in conn.indicators()
+
+
+def test_miner_fetches_blocks_when_an_orphan_expires(miner, monkeypatch):
+    monkeypatch.setattr(miner_module, 'ORPHAN_TIMEOUT', 0.05)
+    peer = chain_of(4)
+    miner.blockchain = Blockchain(list(peer.blockchain[:2]))
+    conn = FakeConnection()
+    miner.handle_block(conn, peer.blockchain[3])
+    deadline = time.monotonic() + 2
+    while 11 not in conn.indicators() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 11 in conn.indicators()
+    assert len(miner.orphans) == 0
+
+
+def test_miner_fetches_blocks_when_an_orphan_was_evicted(miner, monkeypatch):
+    monkeypatch.setattr(miner_module, 'ORPHAN_TIMEOUT', 60)
+    miner.orphans = OrphanPool(max_size=1)
+    peer = chain_of(6)
+    miner.blockchain = Blockchain(list(peer.blockchain[:2]))
+    first, second = FakeConnection(), FakeConnection()
+    miner.handle_block(first, peer.blockchain[3])
+    # a newer orphan from another peer pushes the first one out
+    miner.handle_block(second, peer.blockchain[5])
+    assert len(miner.orphans) == 1
+    miner.check_orphan(first, peer.blockchain[3].hash, 3)
+    assert first.indicators() == [11]
+
+
+def test_miner_doesnt_fetch_an_attached_orphan(miner, monkeypatch):
+    monkeypatch.setattr(miner_module, 'ORPHAN_TIMEOUT', 60)
+    peer = chain_of(4)
+    miner.blockchain = Blockchain(list(peer.blockchain[:2]))
+    conn = FakeConnection()
+    miner.handle_block(conn, peer.blockchain[3])
+    miner.handle_block(conn, peer.blockchain[2])
+    miner.check_orphan(conn, peer.blockchain[3].hash, 3)
+    assert 11 not in conn.indicators()
@@ -0,0 +1,80 @@
+import json
+import struct
+
+import pytest
+
+from blockchain import Blockchain
+from miner import Miner
+from conftest import FakeConnection, transfer
+
+
+@pytest.fixture
+def peer():
+    node = Miner(0)
+    yield node
+    node.socket.close()
+
+
+def extend(chain, blocks, sender='alice', recipient='bob'):
+    for i in range(blocks):
+        block, added = chain.mine([transfer(sender, recipient, float(i + 1))])
+        assert added
+
+
+def sync(miner, peer, binary):
+    """
+    run one locator exchange: miner asks peer for blocks, peer answers and
+    miner handles the answer
+
+    returns:
+    height of the first block the peer sent
+    """
+    to_peer, to_miner = FakeConnection(), FakeConnection()
+    if binary:
+        peer.binary_peers.add(to_miner)
+    miner.request_blocks(to_peer)
+    assert to_peer.indicators() == [11]
+    peer.handle_message(to_miner, str(to_peer.sent[0][1], 'utf-8'), 11)
+    [(indicator, data)] = to_miner.sent
+    if binary:
+        assert indicator == 15
+        miner.handle_message(to_peer, data, 15)
+        return struct.unpack_from('>Q', data)[0]
+    assert indicator == 12
+    data = str(data, 'utf-8')
+    miner.handle_message(to_peer, data, 12)
+    return json.loads(data)['start']
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_sync_from_a_shared_ancestor(miner, peer, binary):
+    miner.blockchain = Blockchain()
+    # the chains share the blocks up to height 14, 12 blocks below our tip
+    # where the locator's steps have grown past one block
+    extend(miner.blockchain, 14)
+    peer.blockchain = Blockchain(list(miner.blockchain.blockchain))
+    extend(miner.blockchain, 12, sender='bob', recipient='carol')
+    extend(peer.blockchain, 15, sender='carol', recipient='alice')
+
+    # the peer sends from after the highest shared block in the locator
+    assert [11, miner.blockchain.blockchain[11].hash] in miner.blockchain.get_locator()
+    assert [14, miner.blockchain.blockchain[14].hash] not in miner.blockchain.get_locator()
+    assert sync(miner, peer, binary) == 12
+    assert [b.hash for b in miner.blockchain.blockchain] == [b.hash for b in peer.blockchain.blockchain]
+    assert miner.blockchain.balances == Blockchain(list(peer.blockchain.blockchain)).balances
+    assert miner.chain_replacements.value() == 1
+    assert miner.fork_depth.sum == 12
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_sync_with_no_common_blocks(miner, peer, binary):
+    miner.blockchain = Blockchain()
+    extend(miner.blockchain, 3)
+    # a different genesis block
+    peer.blockchain = Blockchain()
+    extend(peer.blockchain, 5, sender='bob', recipient='carol')
+
+    assert sync(miner, peer, binary) == 0
+    assert [b.hash for b in miner.blockchain.blockchain] == [b.hash for b in peer.blockchain.blockchain]
+    assert miner.blockchain.balances == peer.blockchain.balances
+    assert miner.blockchain.get_balance('alice') == 100.0
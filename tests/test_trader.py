@@ -0,0 +1,249 @@
+import json
+import socket
+import threading
+import time
+
+import networking
+import trader
+from trader import Trader
+
+
+class FakeMiner:
+    """
+    listens on localhost and answers each message with answer(data,
+    indicator), which returns a list of (data, indicator) to send back, or
+    None to drop the connection
+    """
+    def __init__(self, answer):
+        self.answer = answer
+        self.connections = []
+        self.received = []
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.addr = self.server.getsockname()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            self.connections.append(conn)
+            threading.Thread(target=self.read_loop, args=(conn,), daemon=True).start()
+
+    def read_loop(self, conn):
+        reader = networking.FramedReader(conn)
+        while True:
+            data, indicator = reader.recv()
+            if indicator == 0:
+                break
+            self.received.append((data, indicator))
+            answers = self.answer(data, indicator)
+            if answers is None:
+                break
+            for answer, answer_indicator in answers:
+                networking.send_custom(conn, answer, answer_indicator)
+        conn.close()
+
+    def close(self):
+        # wakes the accept thread, closing alone leaves the port listening
+        self.server.shutdown(socket.SHUT_RDWR)
+        self.server.close()
+        for conn in self.connections:
+            conn.close()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def answer_queries(data, indicator):
+    if indicator == 17:
+        return [(json.dumps({'query': json.loads(data)}), 18)]
+    if indicator == 3:
+        answer = {'id': json.loads(data)['id'], 'message': 'Transaction verified'}
+        return [(json.dumps(answer), 7)]
+    return []
+
+
+def make_trader(*miners):
+    node = Trader('alice')
+    node.miners = [miner.addr for miner in miners]
+    return node
+
+
+def test_queries_reuse_the_pooled_connection():
+    miner = FakeMiner(answer_queries)
+    node = make_trader(miner)
+    try:
+        assert node.get_balance() == {'query': {'type': 'balance', 'wallet': 'alice'}}
+        assert node.get_transaction_status('ab')['query'] == {'type': 'status', 'id': 'ab'}
+        future = node.pool.submit(trader.Transaction('alice', 'bob', 1.0), node.miners)
+        assert future.result(5) == 'Transaction verified'
+        assert node.get_history(page=2)['query']['page'] == 2
+        assert len(miner.connections) == 1
+    finally:
+        node.pool.close()
+        node.socket.close()
+        miner.close()
+
+
+def test_query_tries_the_next_miner_when_one_drops_the_connection():
+    dropping = FakeMiner(lambda data, indicator: None)
+    answering = FakeMiner(answer_queries)
+    node = make_trader(dropping, answering)
+    try:
+        assert node.get_balance(height=3)['query']['height'] == 3
+        assert [indicator for _, indicator in dropping.received] == [17]
+        assert not node.pool.queries.get(node.pool.connections.get(dropping.addr))
+    finally:
+        node.pool.close()
+        node.socket.close()
+        dropping.close()
+        answering.close()
+
+
+def test_query_gives_none_when_no_miner_answers(monkeypatch):
+    monkeypatch.setattr(trader, 'QUERY_TIMEOUT', 0.2)
+    silent = FakeMiner(lambda data, indicator: [])
+    node = make_trader(silent)
+    try:
+        assert node.get_balance() is None
+    finally:
+        node.pool.close()
+        node.socket.close()
+        silent.close()
+
+
+def answer(data, message):
+    return json.dumps({'id': json.loads(data)['id'], 'message': message}), 7
+
+
+def test_answers_out_of_order_resolve_their_own_transactions():
+    held = []
+
+    def answer_in_reverse(data, indicator):
+        # hold the transactions and answer all three newest first
+        held.append(data)
+        if len(held) < 3:
+            return []
+        return [answer(data, f'answer {i}') for i, data in reversed(list(enumerate(held)))]
+
+    miner = FakeMiner(answer_in_reverse)
+    pool = trader.MinerPool()
+    try:
+        transactions = [trader.Transaction('alice', 'bob', float(i)) for i in range(3)]
+        futures = [pool.submit(t, [miner.addr]) for t in transactions]
+        assert [future.result(5) for future in futures] == ['answer 0', 'answer 1', 'answer 2']
+        assert not pool.pending
+    finally:
+        pool.close()
+        miner.close()
+
+
+def test_a_dropped_connection_is_opened_again_on_the_next_submit():
+    drop = [True]
+
+    def drop_first(data, indicator):
+        if drop[0]:
+            drop[0] = False
+            return None
+        return [answer(data, 'Transaction verified')]
+
+    miner = FakeMiner(drop_first)
+    pool = trader.MinerPool()
+    try:
+        lost = pool.submit(trader.Transaction('alice', 'bob', 1.0), [miner.addr])
+        wait_until(lambda: miner.addr not in pool.connections)
+        # the dropped miner never answers, the trader gives up after its timeout
+        assert not lost.done()
+        future = pool.submit(trader.Transaction('alice', 'bob', 2.0), [miner.addr])
+        assert future.result(5) == 'Transaction verified'
+        assert len(miner.connections) == 2
+    finally:
+        pool.close()
+        miner.close()
+
+
+def test_another_miner_answers_when_one_drops_the_connection():
+    dropping = FakeMiner(lambda data, indicator: None)
+    answering = FakeMiner(lambda data, indicator: [answer(data, 'Transaction verified')])
+    pool = trader.MinerPool()
+    try:
+        future = pool.submit(trader.Transaction('alice', 'bob', 1.0), [dropping.addr, answering.addr])
+        assert future.result(5) == 'Transaction verified'
+        wait_until(lambda: dropping.addr not in pool.connections)
+        assert answering.addr in pool.connections
+    finally:
+        pool.close()
+        dropping.close()
+        answering.close()
+
+
+def test_submit_fails_when_no_miner_can_be_reached():
+    miner = FakeMiner(answer_queries)
+    addr = miner.addr
+    miner.close()
+    pool = trader.MinerPool()
+    future = pool.submit(trader.Transaction('alice', 'bob', 1.0), [addr])
+    assert isinstance(future.exception(1), ConnectionError)
+    assert not pool.pending
+    # the miner isn't tried again until RECONNECT_DELAY has passed
+    assert pool.connection(addr) is None
+
+
+def test_percentile():
+    assert trader.percentile([], 0.5) is None
+    values = [1.0, 2.0, 3.0, 4.0]
+    assert trader.percentile(values, 0.5) == 2.0
+    assert trader.percentile(values, 0.51) == 3.0
+    assert trader.percentile(values, 0.0) == 1.0
+    assert trader.percentile(values, 1.0) == 4.0
+    assert trader.percentile([7.0], 0.99) == 7.0
+    assert trader.percentile(list(range(1, 101)), 0.9) == 90
+
+
+def test_run_batch_summary(monkeypatch):
+    node = Trader('alice')
+    forgotten = []
+    monkeypatch.setattr(node.pool, 'forget', forgotten.append)
+
+    def submit_transaction(transaction):
+        future = trader.concurrent.futures.Future()
+        if transaction.recipient == 'bob':
+            future.set_result('Transaction verified')
+        elif transaction.recipient == 'carol':
+            future.set_result('TRANSACTION FAILED: insufficient balance')
+        elif transaction.recipient == 'dave':
+            future.set_exception(ConnectionError('no miner could be reached'))
+        # erin's transactions are never answered
+        return future
+    monkeypatch.setattr(node, 'submit_transaction', submit_transaction)
+
+    lines = ['# recipient amount', 'bob 1', '', 'carol, 2', 'dave 3', 'erin 4', 'bob',
+             'bob -1', 'alice bob 5 6', 'frank bob 2.5', 'bob x']
+    try:
+        results = node.run_batch(lines, max_in_flight=2, timeout=0.05)
+    finally:
+        node.socket.close()
+    assert {key: results[key] for key in ('sent', 'accepted', 'rejected', 'unanswered', 'skipped')} == \
+        {'sent': 5, 'accepted': 2, 'rejected': 1, 'unanswered': 2, 'skipped': 4}
+    assert len(forgotten) == 2
+    assert results['seconds'] > 0
+    assert results['throughput'] == 3 / results['seconds']
+    latencies = [results[f'latency_{name}'] for name in ('p50', 'p90', 'p99', 'max')]
+    assert all(latency is not None for latency in latencies)
+    assert latencies == sorted(latencies)
+
+
+def test_run_batch_with_nothing_answered():
+    node = Trader('alice')
+    try:
+        results = node.run_batch(['# nothing to send'])
+    finally:
+        node.socket.close()
+    assert results['sent'] == 0 and results['skipped'] == 0
+    assert results['latency_p50'] is None and results['latency_max'] is None
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from tracker import Tracker
+from conftest import FakeConnection
+
+
+def snapshot(version, wallets, active):
+    return json.dumps({'version': version, 'wallets': wallets, 'active': active})
+
+
+def update(version, *changes):
+    return json.dumps({'version': version, 'changes': [list(change) for change in changes]})
+
+
+def test_miner_applies_updates_in_order(miner):
+    miner.tracker_socket = FakeConnection()
+    miner.load_wallets(snapshot(2, ['alice', 'bob'], ['alice']))
+    miner.update_wallets(update(3, ('active', 'bob')))
+    miner.update_wallets(update(4, ('add', 'carol'), ('active', 'carol'), ('inactive', 'alice')))
+    assert miner.wallets == ({'alice', 'bob', 'carol'}, {'bob', 'carol'})
+    assert miner.wallet_version == 4
+    # an update already part of the state is ignored
+    miner.update_wallets(update(3, ('inactive', 'bob')))
+    assert 'bob' in miner.wallets[1]
+    assert miner.tracker_socket.sent == []
+
+
+def test_miner_asks_for_a_snapshot_once_after_a_gap(miner):
+    miner.tracker_socket = FakeConnection()
+    miner.load_wallets(snapshot(1, ['alice'], ['alice']))
+    miner.update_wallets(update(3, ('add', 'bob')))
+    miner.update_wallets(update(4, ('add', 'carol')))
+    assert miner.tracker_socket.sent == [(21, b'1')]
+    assert miner.wallets == ({'alice'}, {'alice'})
+
+    # the snapshot catches up, and updates after it apply again
+    miner.load_wallets(snapshot(4, ['alice', 'bob', 'carol'], ['alice']))
+    miner.update_wallets(update(5, ('active', 'bob')))
+    assert miner.wallets == ({'alice', 'bob', 'carol'}, {'alice', 'bob'})
+    miner.update_wallets(update(7, ('add', 'dave')))
+    assert [indicator for indicator, _ in miner.tracker_socket.sent] == [21, 21]
+
+
+def test_miner_ignores_an_older_snapshot(miner):
+    miner.load_wallets(snapshot(5, ['alice', 'bob'], ['bob']))
+    miner.load_wallets(snapshot(3, ['alice'], []))
+    assert miner.wallets == ({'alice', 'bob'}, {'bob'})
+    assert miner.wallet_version == 5
+
+
+@pytest.fixture
+def tracker():
+    node = Tracker(0)
+    yield node
+    node.socket.close()
+
+
+def test_tracker_sends_versioned_changes(tracker):
+    peer = FakeConnection()
+    tracker.peer_list.append([peer, '5000'])
+    tracker.update_wallets('add', 'alice')
+    # a second trader with the same wallet changes nothing miners see
+    tracker.update_wallets('add', 'alice')
+    tracker.update_wallets('remove', 'alice')
+    tracker.update_wallets('remove', 'alice')
+    messages = [json.loads(data) for indicator, data in peer.sent if indicator == 20]
+    assert messages == [
+        {'version': 1, 'changes': [['add', 'alice'], ['active', 'alice']]},
+        {'version': 2, 'changes': [['inactive', 'alice']]},
+    ]
+
+    tracker.send_wallet_snapshot(peer)
+    indicator, data = peer.sent[-1]
+    assert indicator == 19
+    assert json.loads(data) == {'version': 2, 'wallets': ['alice'], 'active': []}
+    assert tracker.wallet_updates.value() == 2
+    assert tracker.wallet_snapshots.value() == 1
+
+
+def test_miner_follows_the_tracker(tracker, miner):
+    peer = FakeConnection()
+    tracker.peer_list.append([peer, '5000'])
+    miner.tracker_socket = FakeConnection()
+    for change, wallet in (('add', 'alice'), ('add', 'bob'), ('remove', 'alice')):
+        tracker.update_wallets(change, wallet)
+    for indicator, data in peer.sent:
+        miner.update_wallets(data.decode())
+    assert miner.wallets == (tracker.wallets, set(tracker.active_wallets))
+    assert miner.wallet_version == tracker.wallet_version
@@ -0,0 +1,126 @@
+import json
+import math
+
+from blockchain import Block, Blockchain, blocks_from_bytes, blocks_to_bytes
+from transaction import Transaction
+from conftest import transfer
+
+
+def mined_block(transactions, prev_hash='', index=1):
+    block = Block(index, 0, transactions, prev_hash)
+    block.solve()
+    return block
+
+
+def assert_same_block(decoded, block):
+    assert decoded.index == block.index
+    assert decoded.nonce == block.nonce
+    assert decoded.prev_hash == block.prev_hash
+    assert decoded.merkle_root == block.merkle_root
+    assert decoded.hash == block.hash
+    assert decoded.transactions == block.transactions
+    assert decoded.is_valid_block()
+
+
+def test_transaction_binary_round_trip():
+    transaction = Transaction('alice', 'bob', 12.5)
+    decoded, end = Transaction.from_bytes(transaction.to_bytes())
+    assert end == len(transaction.to_bytes())
+    assert decoded.serialize() == transaction.serialize()
+    # decoding from a memoryview doesn't copy or change anything
+    decoded, _ = Transaction.from_bytes(memoryview(b'xx' + transaction.to_bytes()), 2)
+    assert decoded.trans_id == transaction.trans_id
+
+
+def test_block_binary_round_trip():
+    block = mined_block([transfer('alice', 'bob', 1.5), transfer('bob', 'carol', 0.25)], 'ab' * 32)
+    decoded, end = Block.from_bytes(block.to_bytes())
+    assert end == len(block.to_bytes())
+    assert_same_block(decoded, block)
+    assert [t.trans_id for t in decoded.parsed_transactions] == [t.trans_id for t in block.parsed_transactions]
+
+
+def test_block_keeps_one_copy_of_each_transaction():
+    block = Block.deserialize(mined_block([transfer('alice', 'bob', 1.5), transfer('bob', 'carol', 0.5)]).serialize())
+    # the strings are rebuilt from the Transactions instead of being kept
+    assert all(isinstance(t, Transaction) for t in block._transactions)
+    assert block._parsed is None
+    assert block.parsed_transactions is block._transactions
+    # and the Merkle root was hashed from the received strings
+    assert block._root is block.merkle_root
+
+
+def test_block_json_round_trip():
+    block = mined_block([transfer('alice', 'bob', 1.5)])
+    assert_same_block(Block.deserialize(block.serialize()), block)
+
+
+def test_inexact_transactions_fall_back_to_raw_strings():
+    # an integer amount and a non-transaction string can't be rebuilt
+    # from the binary fields, they must travel as their exact strings
+    integer = json.dumps({'sender': 'alice', 'recipient': 'bob', 'amount': 5, 'timestamp': 1.0, 'id': 'ab' * 32})
+    block = mined_block(['GENESIS', integer, transfer('alice', 'bob', 1.0)])
+    decoded, _ = Block.from_bytes(block.to_bytes())
+    assert_same_block(decoded, block)
+    assert decoded.transactions[:2] == ('GENESIS', integer)
+    assert len(decoded.parsed_transactions) == 2
+
+
+def test_chain_round_trip():
+    chain = Blockchain()
+    for amount in (1.0, 2.0, 3.0):
+        chain.mine([transfer('alice', 'bob', amount)])
+    decoded = blocks_from_bytes(blocks_to_bytes(chain.blockchain))
+    assert [block.hash for block in decoded] == [block.hash for block in chain.blockchain]
+    assert Blockchain(decoded).is_valid_chain()
+
+
+def test_non_finite_amounts_serialize_like_json_dumps():
+    transaction = Transaction('alice', 'bob', math.nan)
+    expected = json.dumps({'sender': 'alice', 'recipient': 'bob', 'amount': math.nan,
+                           'timestamp': transaction.timestamp, 'id': transaction.trans_id})
+    assert transaction.serialize() == expected
+    block = mined_block([transaction])
+    decoded, _ = Block.from_bytes(block.to_bytes())
+    assert decoded.transactions == block.transactions
+
+
+def test_non_finite_amounts_are_rejected():
+    chain = Blockchain()
+    wallets = ({'alice', 'bob'}, {'alice', 'bob'})
+    for amount in (math.nan, math.inf, -math.inf):
+        result = chain.verify_transaction(Transaction('alice', 'bob', amount).serialize(), wallets)
+        assert result.startswith('TRANSACTION FAILED: invalid amount')
+    assert 'Transaction complete' in chain.verify_transaction(transfer('alice', 'bob', 1.0), wallets)
+
+
+def test_transactions_the_binary_fields_cant_hold_fall_back_to_raw_strings(tmp_path):
+    from blockstore import BlockStore
+
+    def with_fields(**fields):
+        data = {'sender': 'alice', 'recipient': 'bob', 'amount': 1.0, 'timestamp': 1.0, 'id': 'ab' * 32}
+        data.update(fields)
+        return json.dumps(data)
+
+    # IDs that aren't 64 lowercase hex digits would decode as a different
+    # ID, or not encode at all, and a sender this long overflows its
+    # 2-byte length prefix
+    unencodable = [with_fields(id='AB' * 32), with_fields(id='ab' * 8), with_fields(id='xy' * 32),
+                   with_fields(id='ab ' * 31 + 'ab'), with_fields(sender='a' * 70000),
+                   with_fields(sender='é' * 40000)]
+    block = mined_block(unencodable + [transfer('alice', 'bob', 1.0)])
+    decoded, _ = Block.from_bytes(block.to_bytes())
+    assert_same_block(decoded, block)
+    # so do Transactions passed to a block as objects
+    transaction = Transaction('alice', 'bob', 2.0)
+    transaction.trans_id = transaction.trans_id.upper()
+    assert not transaction.has_binary_encoding()
+    block = mined_block([transaction])
+    assert_same_block(Block.from_bytes(block.to_bytes())[0], block)
+
+    store = BlockStore(str(tmp_path))
+    try:
+        store.append(mined_block(unencodable, index=0))
+        assert store.get(0).transactions == tuple(unencodable)
+    finally:
+        store.close()
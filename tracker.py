@@ -1,7 +1,9 @@
 import argparse
+import json
 import socket
 import threading
 import sys
+import metrics
 import networking
 
 
@@ -15,13 +17,35 @@ class Tracker:
         """
         self.peer_list = []
         self.trader_list = []
-        self.wallet_list = []
+        # every wallet that has registered, and wallet -> number of
+        # connected traders using it
+        self.wallets = set()
+        self.active_wallets = {}
+        # bumped on every change of the wallet registry, miners use it to
+        # notice updates they missed
+        self.wallet_version = 0
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         self.socket.bind(('', port))
         self.peer_list_lock = threading.Lock()
         self.trader_list_lock = threading.Lock()
+        self.wallet_lock = threading.Lock()
+        self.register_metrics()
         print(f'Tracker IP: {socket.gethostbyname(socket.gethostname())}')
 
+    def register_metrics(self):
+        """
+        create the tracker's metrics, served with metrics.serve
+        """
+        self.wallet_updates = metrics.Counter('tracker_wallet_updates_total',
+                                              'wallet registry updates broadcast to miners')
+        self.wallet_snapshots = metrics.Counter('tracker_wallet_snapshots_total',
+                                                'wallet registry snapshots sent to miners')
+        metrics.Gauge('tracker_miners', 'registered miners', lambda: len(self.peer_list))
+        metrics.Gauge('tracker_traders', 'connected traders', lambda: len(self.trader_list))
+        metrics.Gauge('tracker_wallets', 'wallets that ever registered', lambda: len(self.wallets))
+        metrics.Gauge('tracker_active_wallets', 'wallets of connected traders', lambda: len(self.active_wallets))
+        metrics.Gauge('tracker_wallet_version', 'version of the wallet registry', lambda: self.wallet_version)
+
     def update_peers(self, type, peer):
         """
         update peer list and send updated list to all peers on network
@@ -47,19 +71,20 @@ class Tracker:
         
         packet = self.format_peer_list_packet()
 
+        # send updated list to all miners and traders, sends are queued on
+        # each connection's writer so the locks are only held for the copy
         self.peer_list_lock.acquire()
-        # send updated list to all miners
-        for p in self.peer_list:
-            networking.send_custom(p[0], packet, 4)
+        connections = [p[0] for p in self.peer_list]
         self.peer_list_lock.release()
 
         self.trader_list_lock.acquire()
-        # send updated list to all traders
         for trader in self.trader_list:
             print(f'trader: {trader}')
-            sys.stdout.flush()
-            networking.send_custom(trader[0], packet, 4)
+            connections.append(trader[0])
         self.trader_list_lock.release()
+        sys.stdout.flush()
+
+        networking.broadcast(connections, packet, 4)
 
         if type == 'add':
             print(f'\nPeer joined network')
@@ -85,45 +110,69 @@ class Tracker:
 
         if type == 'remove':
             self.trader_list_lock.acquire()
-            for t in self.trader_list:
-                t_info = [t[0].getpeername()[0], t[1].split(',')[0]]
-                if t_info == trader_info:
-                    self.trader_list.remove(t)
+            leaving = [t for t in self.trader_list
+                       if [t[0].getpeername()[0], t[1].split(',')[0]] == trader_info]
+            self.trader_list = [t for t in self.trader_list if t not in leaving]
             self.trader_list_lock.release()
+            for t in leaving:
+                self.update_wallets('remove', t[1].split(',')[1])
         
         else:
             self.trader_list_lock.acquire()
             self.trader_list.append(trader)
             self.trader_list_lock.release()
-        
-        self.send_wallet_addresses()
+            self.update_wallets('add', trader[1].split(',')[1])
 
-    def send_wallet_addresses(self):
+    def update_wallets(self, type, wallet):
         """
-        sends up-to-date wallet address list to peers
+        record a trader's wallet joining or leaving, and send the change to
+        all miners as a versioned update
+
+        args:
+        type of update
+        the trader's wallet address
         """
+        changes = []
+        self.wallet_lock.acquire()
+        count = self.active_wallets.get(wallet, 0)
+        if type == 'add':
+            if wallet not in self.wallets:
+                self.wallets.add(wallet)
+                changes.append(['add', wallet])
+            self.active_wallets[wallet] = count + 1
+            if count == 0:
+                changes.append(['active', wallet])
+        elif count == 1:
+            del self.active_wallets[wallet]
+            changes.append(['inactive', wallet])
+        elif count > 1:
+            self.active_wallets[wallet] = count - 1
 
-        current_wallets = ''
-        self.trader_list_lock.acquire()
-        for t in self.trader_list:
-            if current_wallets != '':
-                current_wallets += (',')
-            current_wallets += (t[1].split(',')[1])
-            if t[1].split(',')[1] not in self.wallet_list:
-                self.wallet_list.append(t[1].split(',')[1])
-        self.trader_list_lock.release()
+        if changes:
+            self.wallet_version += 1
+            self.peer_list_lock.acquire()
+            connections = [p[0] for p in self.peer_list]
+            self.peer_list_lock.release()
+            # queued while holding the lock, so every miner receives the
+            # updates and snapshots in version order
+            networking.broadcast(connections, json.dumps({'version': self.wallet_version, 'changes': changes}), 20)
+            self.wallet_updates.inc()
+        self.wallet_lock.release()
 
-        all_wallets = ''
-        for w in self.wallet_list:
-            if all_wallets != '':
-                all_wallets += ','
-            all_wallets += w
-        
-        self.peer_list_lock.acquire()
-        # send to all miners
-        for p in self.peer_list:
-            networking.send_custom(p[0], all_wallets+';'+current_wallets, 9)
-        self.peer_list_lock.release()
+    def send_wallet_snapshot(self, conn):
+        """
+        send the whole wallet registry to a miner that just joined or
+        missed an update
+
+        args:
+        connection of the miner
+        """
+        self.wallet_lock.acquire()
+        snapshot = {'version': self.wallet_version, 'wallets': list(self.wallets),
+                    'active': list(self.active_wallets)}
+        networking.send_custom(conn, json.dumps(snapshot), 19)
+        self.wallet_lock.release()
+        self.wallet_snapshots.inc()
 
 
     def handle_new_peer(self, client_socket):
@@ -137,10 +186,13 @@ class Tracker:
 
         client_info = None
         client_port = None
+        reader = networking.FramedReader(client_socket)
+        # sends to the client are queued on its own writer thread
+        client_socket = networking.PeerWriter(client_socket)
         while True:
             try:
                 # receive from client
-                msg, indicator = networking.recv_custom(client_socket)
+                msg, indicator = reader.recv()
                 client_info = [client_socket, msg]
                 print(f'client_info: {client_info}')
                 print(f'indicator: {indicator}')
@@ -151,7 +203,7 @@ class Tracker:
                     sys.stdout.flush()
                     self.update_peers('add', client_info)
                     client_port = msg
-                    self.send_wallet_addresses()
+                    self.send_wallet_snapshot(client_socket)
                 elif indicator == 8:
                     # New trader connected
                     print("TRADER CONNECTED")
@@ -166,6 +218,9 @@ class Tracker:
                     print(f"client_info = {client_info}")
                     sys.stdout.flush()
                     self.update_traders('remove', client_info)
+                elif indicator == 21:
+                    # Miner missed a wallet registry update
+                    self.send_wallet_snapshot(client_socket)
                 elif indicator == 0:
                     # if client connection is forcibly closed (CTRL+C)
                     client_socket.close()
@@ -202,10 +257,13 @@ if __name__ == "__main__":
     # accepts commandline arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('tracker_port', type=int)
+    parser.add_argument('--metrics-port', type=int, help='serve metrics in the Prometheus text format on this localhost port')
     args = parser.parse_args()
 
     #initialize a tracker
     tracker = Tracker(args.tracker_port)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
 
     #accept connections from peers, start handler thread for each connection
     tracker.socket.listen(15)
@@ -1,12 +1,226 @@
 import argparse
+import collections
+import concurrent.futures
 import socket
 import json
+import math
 import threading
 import time
 import networking
 import sys
 from transaction import Transaction
 
+QUERY_TIMEOUT = 5.0  # seconds to wait for a miner to answer a query
+CONNECT_TIMEOUT = 5.0  # seconds to wait for a miner to accept a connection
+RESPONSE_TIMEOUT = 60.0  # seconds to wait for a miner to answer a transaction
+SUBMIT_QUEUE_SIZE = 4096  # transactions that can wait to be sent to one miner
+RECONNECT_DELAY = 2.0  # seconds before connecting again to a miner that couldn't be reached
+BATCH_IN_FLIGHT = 256  # transactions a batch keeps waiting for an answer at once
+
+
+class MinerPool:
+    def __init__(self, queue_size=SUBMIT_QUEUE_SIZE):
+        """
+        Constructor for MinerPool class
+
+        Persistent connections to the miners, opened on first use and
+        opened again after a miner drops them. Transactions are sent to
+        every miner over these connections, and the first answer (matched
+        by transaction ID) resolves the transaction's future. Queries go to
+        one miner over the same connection, which answers them in order.
+
+        arguments:
+        queue_size -- number of messages that can wait to be sent to one miner
+        """
+        self.queue_size = queue_size
+        # miner address -> PeerWriter
+        self.connections = {}
+        # miner address -> time a connection to it last failed
+        self.failures = {}
+        # held while connecting, so slow connections don't hold up answers
+        self.connect_lock = threading.Lock()
+        # transaction ID -> future of its first answer
+        self.pending = {}
+        # PeerWriter -> futures of the queries sent over it, oldest first
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def connection(self, miner_addr):
+        """
+        get the open connection to a miner, connecting if there is none
+
+        arguments:
+        miner_addr -- (ip, port) of the miner
+
+        returns:
+        PeerWriter of the connection, None if the miner can't be reached or
+        failed less than RECONNECT_DELAY seconds ago
+        """
+        self.connect_lock.acquire()
+        try:
+            conn = self.connections.get(miner_addr)
+            if conn is not None and not conn.closed:
+                return conn
+            if time.monotonic() - self.failures.get(miner_addr, -RECONNECT_DELAY) < RECONNECT_DELAY:
+                return None
+            try:
+                s = socket.create_connection(miner_addr, timeout=CONNECT_TIMEOUT)
+            except OSError:
+                self.failures[miner_addr] = time.monotonic()
+                return None
+            self.failures.pop(miner_addr, None)
+            conn = networking.PeerWriter(s, self.queue_size)
+            self.connections[miner_addr] = conn
+        finally:
+            self.connect_lock.release()
+        threading.Thread(target=self.read_loop, args=(miner_addr, conn), daemon=True).start()
+        return conn
+
+    def read_loop(self, miner_addr, conn):
+        """
+        target function for the thread reading answers from one miner,
+        until the connection closes
+
+        arguments:
+        miner_addr -- (ip, port) of the miner
+        conn -- PeerWriter of the connection
+        """
+        reader = networking.FramedReader(conn.socket)
+        while True:
+            data, indicator = reader.recv()
+            if indicator == 0:
+                break
+            if indicator == 7:
+                self.resolve(data)
+            elif indicator == 18:
+                self.lock.acquire()
+                queries = self.queries.get(conn)
+                future = queries.popleft() if queries else None
+                self.lock.release()
+                if future is not None:
+                    future.set_result(json.loads(data))
+        conn.close()
+        self.connect_lock.acquire()
+        if self.connections.get(miner_addr) is conn:
+            del self.connections[miner_addr]
+        self.connect_lock.release()
+        # queries still waiting on the connection won't be answered
+        self.lock.acquire()
+        queries = self.queries.pop(conn, ())
+        self.lock.release()
+        for future in queries:
+            future.set_exception(ConnectionError('miner closed the connection'))
+
+    def resolve(self, data):
+        """
+        hand a miner's answer to whoever is waiting on the transaction,
+        later answers from other miners are dropped
+
+        arguments:
+        data -- JSON answer with the transaction ID and message
+        """
+        answer = json.loads(data)
+        self.lock.acquire()
+        future = self.pending.pop(answer['id'], None)
+        self.lock.release()
+        if future is not None:
+            future.set_result(answer['message'])
+
+    def submit(self, transaction, miners):
+        """
+        send a transaction to every miner without waiting for an answer
+
+        arguments:
+        transaction -- the Transaction
+        miners -- list of (ip, port) of the miners
+
+        returns:
+        concurrent.futures.Future resolved with the first answer, failed
+        with ConnectionError if no miner could be reached
+        """
+        future = concurrent.futures.Future()
+        self.lock.acquire()
+        self.pending[transaction.trans_id] = future
+        self.lock.release()
+        message = networking.frame(transaction.serialize(), 3)
+        sent = False
+        for miner_addr in miners:
+            conn = self.connection(miner_addr)
+            if conn is not None:
+                conn.sendall(message)
+                sent = True
+        if not sent:
+            self.forget(transaction.trans_id)
+            future.set_exception(ConnectionError('no miner could be reached'))
+        return future
+
+    def query(self, request, miner_addr):
+        """
+        send a read-only query to a miner without waiting for the answer
+
+        arguments:
+        request -- dict of the query, see Miner.answer_query
+        miner_addr -- (ip, port) of the miner
+
+        returns:
+        concurrent.futures.Future resolved with the answer, failed with
+        ConnectionError if the miner can't be reached or drops the
+        connection first
+        """
+        future = concurrent.futures.Future()
+        conn = self.connection(miner_addr)
+        if conn is None:
+            future.set_exception(ConnectionError('miner could not be reached'))
+            return future
+        self.lock.acquire()
+        # checked under the lock, the read loop fails the waiting queries
+        # under it after closing the connection
+        closed = conn.closed
+        if not closed:
+            self.queries.setdefault(conn, collections.deque()).append(future)
+        self.lock.release()
+        if closed:
+            future.set_exception(ConnectionError('miner closed the connection'))
+            return future
+        conn.sendall(networking.frame(json.dumps(request), 17))
+        return future
+
+    def forget(self, trans_id):
+        """
+        stop waiting for answers about a transaction
+
+        arguments:
+        trans_id -- ID of the transaction
+        """
+        self.lock.acquire()
+        self.pending.pop(trans_id, None)
+        self.lock.release()
+
+    def close(self):
+        self.connect_lock.acquire()
+        connections = list(self.connections.values())
+        self.connections.clear()
+        self.connect_lock.release()
+        for conn in connections:
+            conn.close()
+
+
+def percentile(values, fraction):
+    """
+    nearest-rank percentile
+
+    arguments:
+    values -- sorted list of numbers
+    fraction -- percentile as a fraction, 0.5 for the median
+
+    returns:
+    the value, None if the list is empty
+    """
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
 class Trader:
     def __init__(self, wallet_address):
         self.running = False
@@ -14,7 +228,10 @@ class Trader:
         self.miners = []
         self.miner_list_lock = threading.Lock()
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.miner_response = None
+        # set while the miner list isn't empty
+        self.miners_available = threading.Event()
+        # persistent connections transactions are sent over
+        self.pool = MinerPool()
     
     def register(self, tracker_ip, tracker_port, client_port):
         """
@@ -49,8 +266,12 @@ class Trader:
         """
         receives initial miner list from tracker
         """
+        reader = networking.FramedReader(self.tracker_socket)
         while self.running:
-            payload, _ = networking.recv_custom(self.tracker_socket) 
+            payload, indicator = reader.recv()
+            if indicator == 0:
+                # tracker closed the connection
+                break
             print(f"New miner list received")
             sys.stdout.flush()
 
@@ -73,6 +294,7 @@ class Trader:
                 self.miner_list_lock.acquire()
                 self.miners.append(miner_addr)
                 self.miner_list_lock.release()
+            self.miners_available.set()
 
     def handle_connection(self, conn):
         """
@@ -94,10 +316,11 @@ class Trader:
                 self.miner_list_lock.acquire()
                 self.miners.append(miner_addr)
                 self.miner_list_lock.release()
+            self.miners_available.set()
             print(self.miners)
         elif indicator == 7:
             # MINER RESPONSE TO TRANSACTION REQUEST RECIEVED
-            self.miner_response = data
+            self.pool.resolve(data)
         else:
             print("unknown indicator: " + str(indicator))
         sys.stdout.flush()
@@ -125,49 +348,275 @@ class Trader:
 
     
 
+    def submit_transaction(self, transaction):
+        """
+        send a transaction to every miner over the pooled connections
+        without waiting for an answer
+
+        arguments:
+        transaction -- the Transaction
+
+        returns:
+        concurrent.futures.Future resolved with the first miner's answer
+        """
+        self.miner_list_lock.acquire()
+        miners = list(self.miners)
+        self.miner_list_lock.release()
+        return self.pool.submit(transaction, miners)
+
+    def send_transaction(self, transaction, timeout=RESPONSE_TIMEOUT):
+        """
+        send a transaction to every miner over the pooled connections and
+        wait for the first answer
+
+        arguments:
+        transaction -- the Transaction
+        timeout -- seconds to wait for an answer
+
+        returns:
+        the first miner's answer, None if no miner answered in time
+        """
+        future = self.submit_transaction(transaction)
+        try:
+            return future.result(timeout)
+        except (concurrent.futures.TimeoutError, ConnectionError):
+            self.pool.forget(transaction.trans_id)
+            return None
+
+    def parse_batch_line(self, line):
+        """
+        build a transaction from one line of a batch: "recipient amount",
+        or "sender recipient amount" to replay other wallets' transactions.
+        Fields are separated by spaces or commas.
+
+        arguments:
+        line -- the line
+
+        returns:
+        the Transaction, None for a blank line or a comment (#)
+        """
+        fields = line.replace(',', ' ').split()
+        if not fields or fields[0].startswith('#'):
+            return None
+        if len(fields) == 2:
+            sender = self.wallet_address
+            recipient, amount = fields
+        elif len(fields) == 3:
+            sender, recipient, amount = fields
+        else:
+            raise ValueError(f'expected 2 or 3 fields, got {len(fields)}')
+        amount = float(amount)
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        return Transaction(sender, recipient, amount)
+
+    def run_batch(self, lines, max_in_flight=BATCH_IN_FLIGHT, timeout=RESPONSE_TIMEOUT, rate=None):
+        """
+        send the transactions read from lines of text, pipelined: new
+        transactions are sent while up to max_in_flight earlier ones are
+        still waiting for an answer
+
+        arguments:
+        lines -- iterable of lines, see parse_batch_line
+        max_in_flight -- most transactions waiting for an answer at once
+        timeout -- seconds to wait for each transaction's answer
+        rate -- transactions to send per second, None to send as fast as
+                the in-flight limit allows
+
+        returns:
+        dict with the number of transactions sent, accepted, rejected,
+        unanswered and of lines skipped, the seconds taken, transactions
+        answered per second, and latency percentiles in seconds
+        """
+        results = {'sent': 0, 'accepted': 0, 'rejected': 0, 'unanswered': 0, 'skipped': 0}
+        # seconds from sending each answered transaction to its answer,
+        # appended by the pool's reader threads
+        latencies = []
+        # (transaction ID, time sent, future) of the transactions in flight, oldest first
+        in_flight = collections.deque()
+
+        def record(future, sent_at):
+            if future.exception() is None:
+                latencies.append(time.perf_counter() - sent_at)
+
+        def finish_oldest():
+            trans_id, sent_at, future = in_flight.popleft()
+            try:
+                response = future.result(max(sent_at + timeout - time.perf_counter(), 0))
+            except (concurrent.futures.TimeoutError, ConnectionError):
+                self.pool.forget(trans_id)
+                results['unanswered'] += 1
+                return
+            if 'TRANSACTION FAILED' in response:
+                results['rejected'] += 1
+            else:
+                results['accepted'] += 1
+
+        start = time.perf_counter()
+        for number, line in enumerate(lines, 1):
+            try:
+                transaction = self.parse_batch_line(line)
+            except ValueError as e:
+                print(f"Skipping line {number}: {e}", file=sys.stderr)
+                results['skipped'] += 1
+                continue
+            if transaction is None:
+                continue
+            while len(in_flight) >= max_in_flight:
+                finish_oldest()
+            if rate:
+                delay = start + results['sent'] / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent_at = time.perf_counter()
+            future = self.submit_transaction(transaction)
+            future.add_done_callback(lambda future, sent_at=sent_at: record(future, sent_at))
+            in_flight.append((transaction.trans_id, sent_at, future))
+            results['sent'] += 1
+        while in_flight:
+            finish_oldest()
+        elapsed = time.perf_counter() - start
+
+        answered = results['accepted'] + results['rejected']
+        results['seconds'] = elapsed
+        results['throughput'] = answered / elapsed if elapsed > 0 else 0.0
+        latencies.sort()
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            results[f'latency_{name}'] = percentile(latencies, fraction)
+        return results
+
+    def query(self, request):
+        """
+        send a read-only query to a miner and wait for its answer, trying
+        the next miner if one doesn't answer
+
+        arguments:
+        request -- dict of the query, see Miner.answer_query
+
+        returns:
+        dict of the answer, None if no miner answered
+        """
+        self.miner_list_lock.acquire()
+        miners = list(self.miners)
+        self.miner_list_lock.release()
+        for miner_addr in miners:
+            # over the pooled connection transactions are sent on
+            future = self.pool.query(request, miner_addr)
+            try:
+                return future.result(QUERY_TIMEOUT)
+            except (ConnectionError, concurrent.futures.TimeoutError):
+                continue
+        return None
+
+    def get_balance(self, wallet=None, height=None):
+        """
+        ask a miner for the balance of a wallet
+
+        arguments:
+        wallet -- wallet address, our own if None
+        height -- height of the block to give the balance after, None for the tip
+        """
+        request = {'type': 'balance', 'wallet': wallet or self.wallet_address}
+        if height is not None:
+            request['height'] = height
+        return self.query(request)
+
+    def get_history(self, wallet=None, page=0, page_size=10):
+        """
+        ask a miner for one page of a wallet's transactions, newest first
+
+        arguments:
+        wallet -- wallet address, our own if None
+        page -- number of the page, 0 for the newest transactions
+        page_size -- transactions per page
+        """
+        return self.query({'type': 'history', 'wallet': wallet or self.wallet_address,
+                           'page': page, 'page_size': page_size})
+
+    def get_transaction_status(self, trans_id):
+        """
+        ask a miner whether a transaction is confirmed, pending or unknown
+
+        arguments:
+        trans_id -- ID of the transaction
+        """
+        return self.query({'type': 'status', 'id': trans_id})
+
+    def print_query(self, command):
+        """
+        run a BALANCE [height], HISTORY [page] or STATUS <id> command from the
+        command line and print the answer
+
+        arguments:
+        command -- the command's words
+        """
+        if command[0] == "BALANCE":
+            answer = self.get_balance(height=int(command[1]) if len(command) > 1 else None)
+        elif command[0] == "HISTORY":
+            answer = self.get_history(page=int(command[1]) if len(command) > 1 else 0)
+        elif len(command) > 1:
+            answer = self.get_transaction_status(command[1])
+        else:
+            print("Usage: STATUS <transaction id>")
+            return
+        if answer is None:
+            print("No miner answered the query")
+        elif 'error' in answer:
+            print(f"Query failed: {answer['error']}")
+        elif command[0] == "BALANCE":
+            print(f"Balance: {answer['balance']} (at height {answer['height']})")
+        elif command[0] == "HISTORY":
+            for t in answer['transactions']:
+                print(f"{t['height']}: {t['sender']} -> {t['recipient']} {t['amount']} ({t['id']})")
+            if not answer['transactions']:
+                print("No transactions")
+            elif answer['more']:
+                print(f"More on page {answer['page'] + 1}")
+        elif answer['status'] == 'confirmed':
+            print(f"Confirmed in block {answer['height']} ({answer['confirmations']} confirmations)")
+        else:
+            print(f"Transaction is {answer['status']}")
+
     def accept_transactions(self):
         """
         function that takes in transactions from the command line, checks to see if 
         they are valid, and if so, sends them to miners
         """
         while self.running:
-            if self.miners:
-                # get transaction from command line
-                recipient = input("Enter recipient's wallet address: ")
-                if recipient == "EXIT":
-                    self.running = False
-                    continue
-                # check inputs
-                amount = input("Enter amount to send: ")
-                if amount == "":
+            if not self.miners:
+                print("No miners available, waiting for updates...")
+                self.miners_available.wait()
+                continue
+            # get transaction from command line
+            recipient = input("Enter recipient's wallet address: ")
+            if recipient == "EXIT":
+                self.running = False
+                continue
+            command = recipient.split()
+            if command and command[0] in ("BALANCE", "HISTORY", "STATUS"):
+                try:
+                    self.print_query(command)
+                except ValueError:
                     print("Invalid input. Please try again.")
-                    continue
-                amount = float(amount)
-                if recipient and amount > 0:
-                    # create transaction
-                    transaction = Transaction(self.wallet_address, recipient, amount)
-                    self.miner_response = None
-                    # iterate through all miners in peer list
-                    for miner_ip, miner_port in self.miners:
-                        try:
-                            # connect to miner
-                            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            s.connect((miner_ip, miner_port))
-                            # send transaction to miner
-                            networking.send_custom(s, transaction.serialize(), 3)
-                            threading.Thread(target=self.handle_connection, args=(s,)).start()
-                        except Exception as e:
-                            print(f"Failed to send transaction to {miner_ip}:{miner_port}: {e}")
-                    while self.miner_response == None:
-                        continue
-                    print(self.miner_response)
-                    self.miner_response = None
+                continue
+            # check inputs
+            amount = input("Enter amount to send: ")
+            if amount == "":
+                print("Invalid input. Please try again.")
+                continue
+            amount = float(amount)
+            if recipient and amount > 0:
+                # create transaction
+                transaction = Transaction(self.wallet_address, recipient, amount)
+                print(f"Transaction ID: {transaction.trans_id}")
+                response = self.send_transaction(transaction)
+                if response is None:
+                    print("No miner answered the transaction in time")
                 else:
-                    print("Invalid input. Please try again.")
+                    print(response)
             else:
-                print("No miners available, waiting for updates...")
-            
-            time.sleep(0.5)
+                print("Invalid input. Please try again.")
+        self.pool.close()
 
 
 if __name__ == "__main__":
@@ -176,6 +625,11 @@ if __name__ == "__main__":
     parser.add_argument('tracker_port', type=int)
     parser.add_argument('client_port', type=int)
     parser.add_argument('username', type=str)
+    parser.add_argument('--batch', metavar='FILE', help="send the transactions in FILE ('-' for stdin) instead of asking for them, then exit")
+    parser.add_argument('--in-flight', type=int, default=BATCH_IN_FLIGHT, help='most batch transactions waiting for an answer at once')
+    parser.add_argument('--timeout', type=float, default=RESPONSE_TIMEOUT, help='seconds to wait for a miner to answer a transaction')
+    parser.add_argument('--rate', type=float, help='batch transactions to send per second (default: as fast as --in-flight allows)')
+    parser.add_argument('--json', action='store_true', help='print the batch results as JSON')
     args = parser.parse_args()
     
     trader = Trader(args.username)
@@ -183,18 +637,36 @@ if __name__ == "__main__":
     trader.register(args.tracker_ip, args.tracker_port, args.client_port)
 
     #start thread to accept incomding connections from the tracker or miners
-    tracker_thread = threading.Thread(target=trader.tracker_thread)
+    tracker_thread = threading.Thread(target=trader.tracker_thread, daemon=True)
     tracker_thread.start()
 
     #start thread to accept incomding connections from the tracker or miners
-    listen_thread = threading.Thread(target=trader.listen_for_updates, args=(args.client_port,))
+    listen_thread = threading.Thread(target=trader.listen_for_updates, args=(args.client_port,), daemon=True)
     listen_thread.start()
 
-    #start thread to accept inputs for new transactions
-    transaction_thread = threading.Thread(target=trader.accept_transactions)
-    transaction_thread.start()
-
-    while trader.running:
-        pass
+    if args.batch is not None:
+        trader.miners_available.wait()
+        if args.batch == '-':
+            results = trader.run_batch(sys.stdin, args.in_flight, args.timeout, args.rate)
+        else:
+            with open(args.batch) as lines:
+                results = trader.run_batch(lines, args.in_flight, args.timeout, args.rate)
+        trader.running = False
+        trader.pool.close()
+        if args.json:
+            print(json.dumps(results))
+        else:
+            print(f"Sent {results['sent']} transactions in {results['seconds']:.2f}s: "
+                  f"{results['accepted']} accepted, {results['rejected']} rejected, "
+                  f"{results['unanswered']} unanswered, {results['skipped']} lines skipped")
+            print(f"Throughput: {results['throughput']:.1f} transactions/sec")
+            if results['latency_max'] is not None:
+                print('Latency: ' + ', '.join(f"{name} {results[f'latency_{name}'] * 1000:.1f}ms"
+                                              for name in ('p50', 'p90', 'p99', 'max')))
+    else:
+        #start thread to accept inputs for new transactions
+        transaction_thread = threading.Thread(target=trader.accept_transactions)
+        transaction_thread.start()
+        transaction_thread.join()
 
-    trader.unregister(args.tracker_ip, args.tracker_port, args.client_port)
\ No newline at end of file
+    trader.unregister(args.tracker_ip, args.tracker_port, args.client_port)
@@ -1,8 +1,36 @@
 import json
+from json.encoder import encode_basestring_ascii
 import time
 import hashlib
+import math
+import struct
+import sys
+
+LENGTH = struct.Struct('>H')  # length prefix of the sender and recipient in the binary format
+AMOUNT_TIMESTAMP = struct.Struct('>dd')  # amount and timestamp in the binary format
+MAX_FIELD_LENGTH = 0xffff  # longest sender or recipient, in bytes, the length prefix can hold
+
+def serialize_fields(sender, recipient, amount, timestamp, trans_id):
+    """
+    Serialize the fields of a transaction
+
+    Formatted directly rather than through json.dumps, which gives the
+    same output for finite floats, because blocks decoded from the binary
+    wire format rebuild every transaction string. Other values go
+    through json.dumps so the string (and the Merkle root over it)
+    stays the same as before.
+    """
+    if type(amount) is float and type(timestamp) is float and math.isfinite(amount) and math.isfinite(timestamp):
+        return '{"sender": %s, "recipient": %s, "amount": %r, "timestamp": %r, "id": "%s"}' % (
+            encode_basestring_ascii(sender), encode_basestring_ascii(recipient), amount, timestamp, trans_id)
+    return json.dumps({'sender': sender, 'recipient': recipient, 'amount': amount, 'timestamp': timestamp,
+                       'id': trans_id})
+
 
 class Transaction:
+    # no per-instance dict, blocks keep one of these per transaction
+    __slots__ = ('sender', 'recipient', 'amount', 'timestamp', 'trans_id')
+
     def __init__(self, sender, recipient, amount):
         """
         create a transaction dataect
@@ -23,15 +51,9 @@ class Transaction:
     
     def serialize(self):
         """
-        Serialize the transaction for transmission
+        Serialize the transaction for transmission, see serialize_fields
         """
-        return json.dumps({
-            'sender': self.sender,
-            'recipient': self.recipient,
-            'amount': self.amount,
-            'timestamp': self.timestamp,
-            'id': self.trans_id
-        })
+        return serialize_fields(self.sender, self.recipient, self.amount, self.timestamp, self.trans_id)
     
     @classmethod
     def deserialize(cls, block_data):
@@ -42,8 +64,117 @@ class Transaction:
         block_data: JSON string representing a transaction.
         """
         data = json.loads(block_data)
-        transaction = Transaction(data['sender'], data['recipient'], data['amount'])
+        # skip the constructor, the ID and timestamp come from the data
+        transaction = cls.__new__(cls)
+        # wallet addresses repeat across transactions, share one copy
+        transaction.sender = sys.intern(data['sender'])
+        transaction.recipient = sys.intern(data['recipient'])
+        transaction.amount = data['amount']
         transaction.timestamp = data['timestamp']
-        transaction.id = data['id']
+        transaction.trans_id = data['id']
         return transaction
 
+    def has_binary_encoding(self):
+        """
+        Check that to_bytes can encode the transaction and that from_bytes
+        gives back a transaction that serializes to the same string: finite
+        float amount and timestamp, an ID of 64 lowercase hex digits, and a
+        sender and recipient that fit their length prefixes
+        """
+        if not (type(self.amount) is float and type(self.timestamp) is float and
+                math.isfinite(self.amount) and math.isfinite(self.timestamp)):
+            return False
+        if type(self.trans_id) is not str:
+            return False
+        try:
+            # also rejects uppercase, short and space separated IDs, which
+            # would decode as a different string
+            if bytes.fromhex(self.trans_id).hex() != self.trans_id or len(self.trans_id) != 64:
+                return False
+        except ValueError:
+            return False
+        for wallet in (self.sender, self.recipient):
+            if type(wallet) is not str:
+                return False
+            if wallet.isascii():
+                if len(wallet) > MAX_FIELD_LENGTH:
+                    return False
+                continue
+            try:
+                if len(wallet.encode()) > MAX_FIELD_LENGTH:
+                    return False
+            except UnicodeEncodeError:
+                # lone surrogates, e.g. from a "\ud800" escape in the JSON
+                return False
+        return True
+
+    def to_bytes(self):
+        """
+        Encode the transaction in the compact binary wire format:
+        length-prefixed sender and recipient, amount and timestamp as
+        doubles, and the raw 32-byte ID. Only for transactions where
+        has_binary_encoding() is True.
+        """
+        sender = self.sender.encode()
+        recipient = self.recipient.encode()
+        return b''.join((LENGTH.pack(len(sender)), sender, LENGTH.pack(len(recipient)), recipient,
+                         AMOUNT_TIMESTAMP.pack(self.amount, self.timestamp), bytes.fromhex(self.trans_id)))
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """
+        Decode a transaction from the binary wire format
+
+        arguments:
+        data: bytes holding the transaction
+        offset: position of the transaction in data
+
+        returns:
+        (transaction, position after the transaction)
+        """
+        sender, recipient, amount, timestamp, trans_id, offset = decode_fields(data, offset)
+        # skip the constructor, the ID and timestamp come from the data
+        transaction = cls.__new__(cls)
+        transaction.sender = sys.intern(sender)
+        transaction.recipient = sys.intern(recipient)
+        transaction.amount = amount
+        transaction.timestamp = timestamp
+        transaction.trans_id = trans_id
+        return transaction, offset
+
+    @staticmethod
+    def serialized_from_bytes(data, offset=0):
+        """
+        The string serialize() gives for a transaction in the binary wire
+        format, without building the Transaction
+
+        arguments:
+        data: bytes holding the transaction
+        offset: position of the transaction in data
+
+        returns:
+        (string, position after the transaction)
+        """
+        sender, recipient, amount, timestamp, trans_id, offset = decode_fields(data, offset)
+        return serialize_fields(sender, recipient, amount, timestamp, trans_id), offset
+
+
+def decode_fields(data, offset):
+    """
+    Decode the fields of a transaction in the binary wire format, straight
+    from data (bytes or a memoryview) without copying slices first
+
+    returns:
+    (sender, recipient, amount, timestamp, ID, position after the transaction)
+    """
+    length, = LENGTH.unpack_from(data, offset)
+    offset += 2
+    sender = str(data[offset:offset + length], 'utf-8')
+    offset += length
+    length, = LENGTH.unpack_from(data, offset)
+    offset += 2
+    recipient = str(data[offset:offset + length], 'utf-8')
+    offset += length
+    amount, timestamp = AMOUNT_TIMESTAMP.unpack_from(data, offset)
+    offset += 16
+    return sender, recipient, amount, timestamp, data[offset:offset + 32].hex(), offset + 32